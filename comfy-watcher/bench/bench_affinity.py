@@ -0,0 +1,71 @@
+"""Benchmark: arrival order vs model-affinity scheduling of a mixed-model queue.
+
+Fills a PrefetchReceiver's buffer with jobs for randomly mixed models and
+renders them one after another on a fake ComfyUI that adds --switch-time
+whenever a prompt loads different checkpoints than the previous one. Reports
+model switches, throughput and how long jobs waited in the buffer.
+
+    python bench/bench_affinity.py --jobs 40 --window 8 --render-time 0.1 --switch-time 0.4
+"""
+import argparse
+import json
+import logging
+import random
+import tempfile
+import time
+
+from fake_comfyui import FakeComfyUI
+from watcher_module import load_watcher
+
+MODELS = ("flux", "hidream", "omnigen", "sd3.5")
+
+
+def run(watcher, fake, args, window):
+    watcher.MODEL_AFFINITY_WINDOW = window
+    watcher.backend_pool = watcher.BackendPool([fake.url])
+    watcher.start_comfy_listener()
+    watcher.backend_pool.backends[0].listener.connected.wait(5)
+    receiver = watcher.PrefetchReceiver([watcher.QueuePolicy("bench", 1, 0, 30)])
+    rng = random.Random(args.seed)
+    start = time.time()
+    for i in range(args.jobs):
+        body = {"id": f"bench-{i}", "model": rng.choice(MODELS), "prompt": "a cat", "seed": i + 1}
+        msg = {"ReceiptHandle": f"rh-{i}", "Body": json.dumps(body), "MessageId": str(i)}
+        receiver.prefetchers[0].buffer.append(("bench", msg, start))
+
+    switches_before = fake.model_switches
+    waits = []
+    while True:
+        job = watcher.next_job(receiver, 0)
+        if job is None:
+            break
+        waits.append(time.time() - start)
+        for stage in (watcher.prepare_job, watcher.submit_job, watcher.await_job):
+            assert watcher.run_job_stage(stage, job), job.tti_input.id
+    elapsed = time.time() - start
+    waits.sort()
+    return fake.model_switches - switches_before, elapsed, waits[int(len(waits) * 0.95) - 1], waits[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--window", type=int, default=8)
+    parser.add_argument("--render-time", type=float, default=0.1)
+    parser.add_argument("--switch-time", type=float, default=0.4)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    watcher = load_watcher(logging.ERROR)
+    fake = FakeComfyUI(render_time=args.render_time, output_dir=tempfile.mkdtemp(prefix="fake-comfyui-"),
+                       switch_time=args.switch_time).start()
+
+    print(f"{'window':>6} {'switches':>9} {'seconds':>8} {'jobs/s':>7} {'p95 wait':>9} {'max wait':>9}")
+    for window in (1, args.window):
+        switches, elapsed, p95, worst = run(watcher, fake, args, window)
+        print(f"{window:>6} {switches:>9} {elapsed:>8.2f} {args.jobs / elapsed:>7.2f} {p95:>8.2f}s {worst:>8.2f}s")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
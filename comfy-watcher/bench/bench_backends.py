@@ -0,0 +1,126 @@
+"""Benchmark: routing jobs across several ComfyUI backends.
+
+Starts fake ComfyUI servers in-process and runs jobs through the watcher's
+prepare/submit/await stages (no SQS or S3) with two jobs in flight per
+backend, the same as the default pipeline. Reports throughput with one
+backend and with all of them, how each balance mode spreads work when one
+backend is slower than the rest, and ejection/re-admission during an outage.
+
+    python bench/bench_backends.py --backends 3 --jobs 30 --render-time 0.5
+"""
+import argparse
+import json
+import logging
+import queue
+import tempfile
+import threading
+import time
+
+from fake_comfyui import FakeComfyUI
+from watcher_module import load_watcher
+
+
+def make_job(watcher, i):
+    body = {"id": f"bench-{i}", "model": "flux", "prompt": "a cat", "seed": i + 1}
+    return watcher.Job("bench", "bench", {"ReceiptHandle": f"rh-{i}", "Body": json.dumps(body)})
+
+
+def run_jobs(watcher, jobs, workers, during=None):
+    """Render every job, retrying failures like an SQS redelivery; return elapsed seconds"""
+    work = queue.Queue()
+    for i in range(jobs):
+        work.put(make_job(watcher, i))
+    done = threading.Semaphore(0)
+
+    def worker():
+        while True:
+            job = work.get()
+            if job is None:
+                return
+            if all(watcher.run_job_stage(stage, job) for stage in (watcher.prepare_job, watcher.submit_job, watcher.await_job)):
+                done.release()
+            else:
+                watcher.release_job(job)
+                time.sleep(0.05)
+                work.put(make_job(watcher, int(job.tti_input.id.split("-")[1])))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    if during:
+        threading.Thread(target=during, daemon=True).start()
+    for _ in range(jobs):
+        done.acquire()
+    elapsed = time.time() - start
+    for _ in threads:
+        work.put(None)
+    return elapsed
+
+
+def use_backends(watcher, fakes):
+    watcher.backend_pool = watcher.BackendPool([fake.url for fake in fakes])
+    watcher.start_comfy_listener()
+    for backend in watcher.backend_pool.backends:
+        backend.listener.connected.wait(5)
+    watcher.backend_pool.start()
+    return watcher.backend_pool
+
+
+def print_backends(pool):
+    for backend in pool.backends:
+        print(f"    {backend.url}: {backend.completed} completed, {backend.failed} failed, "
+              f"{backend.ejections} ejections")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=30)
+    parser.add_argument("--render-time", type=float, default=0.5)
+    args = parser.parse_args()
+
+    watcher = load_watcher(logging.ERROR)
+    watcher.COMFYUI_HEALTH_INTERVAL = 0.2
+    output_dir = tempfile.mkdtemp(prefix="fake-comfyui-")
+    fakes = [FakeComfyUI(render_time=args.render_time, output_dir=output_dir).start()
+             for _ in range(args.backends)]
+
+    use_backends(watcher, fakes[:1])
+    elapsed = run_jobs(watcher, args.jobs, 2)
+    single = args.jobs / elapsed
+    print(f"1 backend:  {single:.2f} jobs/s")
+
+    pool = use_backends(watcher, fakes)
+    elapsed = run_jobs(watcher, args.jobs, 2 * args.backends)
+    print(f"{args.backends} backends: {args.jobs / elapsed:.2f} jobs/s ({args.jobs / elapsed / single:.1f}x)")
+    print_backends(pool)
+
+    # One backend three times slower than the others
+    fakes[0].render_time = args.render_time * 3
+    for mode in ("queue", "inflight"):
+        watcher.COMFYUI_BALANCE_MODE = mode
+        pool = use_backends(watcher, fakes)
+        elapsed = run_jobs(watcher, args.jobs, 2 * args.backends)
+        print(f"slow first backend, {mode} balancing: {args.jobs / elapsed:.2f} jobs/s")
+        print_backends(pool)
+    fakes[0].render_time = args.render_time
+
+    def outage():
+        time.sleep(args.render_time * 2)
+        fakes[0].healthy = False
+        time.sleep(args.render_time * 4)
+        fakes[0].healthy = True
+
+    watcher.COMFYUI_BALANCE_MODE = "queue"
+    pool = use_backends(watcher, fakes)
+    elapsed = run_jobs(watcher, args.jobs, 2 * args.backends, during=outage)
+    print(f"outage on first backend: {args.jobs / elapsed:.2f} jobs/s")
+    print_backends(pool)
+
+    for fake in fakes:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
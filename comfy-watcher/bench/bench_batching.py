@@ -0,0 +1,80 @@
+"""Benchmark: one prompt per job vs batching compatible jobs into one prompt.
+
+Fills a PrefetchReceiver's buffer with seed-0 jobs spread over a few distinct
+prompts, then takes jobs with next_job and renders them one after another
+on a fake ComfyUI (prepare/submit/await, no S3). The fake's batch_scaling
+sets how much each extra batch image adds to the render time; measure it on
+the real GPU to make the numbers meaningful.
+
+    python bench/bench_batching.py --jobs 32 --prompts 4 --batch-size 4 --batch-scaling 0.4
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+
+from fake_comfyui import FakeComfyUI
+from watcher_module import load_watcher
+
+
+def fill_buffer(watcher, receiver, jobs, prompts, model):
+    prefetcher = receiver.prefetchers[0]
+    for i in range(jobs):
+        body = {"id": f"bench-{i}", "model": model, "prompt": f"prompt {i % prompts}", "seed": 0}
+        msg = {"ReceiptHandle": f"rh-{i}", "Body": json.dumps(body), "MessageId": str(i)}
+        prefetcher.buffer.append(("bench", msg, time.time()))
+
+
+def run(watcher, fake, args, batch_size):
+    watcher.BATCH_MAX_SIZE = batch_size
+    watcher.backend_pool = watcher.BackendPool([fake.url])
+    watcher.start_comfy_listener()
+    watcher.backend_pool.backends[0].listener.connected.wait(5)
+    receiver = watcher.PrefetchReceiver([watcher.QueuePolicy("bench", 1, 0, 30)])
+    fill_buffer(watcher, receiver, args.jobs, args.prompts, args.model)
+
+    prompts = images = 0
+    start = time.time()
+    while True:
+        job = watcher.next_job(receiver, 0)
+        if job is None:
+            break
+        for stage in (watcher.prepare_job, watcher.submit_job, watcher.await_job):
+            assert watcher.run_job_stage(stage, job), job.tti_input.id
+        # Each job in the batch gets its own image
+        assigned = dict(zip((member.tti_input.id for member in job.batch), job.poll_response["9"]["images"]))
+        assert len(assigned) == len(job.batch)
+        prompts += 1
+        images += len(assigned)
+    elapsed = time.time() - start
+    assert images == args.jobs
+    return prompts, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--prompts", type=int, default=4, help="Distinct prompts among the jobs")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--render-time", type=float, default=0.25)
+    parser.add_argument("--batch-scaling", type=float, default=0.4)
+    parser.add_argument("--model", default="sd3.5")
+    args = parser.parse_args()
+
+    watcher = load_watcher(logging.ERROR)
+    fake = FakeComfyUI(render_time=args.render_time, output_dir=tempfile.mkdtemp(prefix="fake-comfyui-"),
+                       batch_scaling=args.batch_scaling).start()
+
+    print(f"{'batch size':>10} {'prompts':>8} {'seconds':>8} {'jobs/s':>7}")
+    baseline = None
+    for batch_size in (1, args.batch_size):
+        prompts, elapsed = run(watcher, fake, args, batch_size)
+        rate = args.jobs / elapsed
+        baseline = baseline or rate
+        print(f"{batch_size:>10} {prompts:>8} {elapsed:>8.2f} {rate:>7.2f} ({rate / baseline:.1f}x)")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Benchmark: circuit breakers vs the global poll interval backoff they replaced.
+
+Renders jobs one after another on a fake ComfyUI, like the main loop does.
+"poison" mixes in jobs ComfyUI rejects with a 400 (a bad workflow), which
+only fail themselves. "outage" makes ComfyUI fail every prompt for --outage
+seconds part way through. The old policy is emulated: every failed job
+doubled one global interval, up to 15 times --poll-interval, and the loop
+slept that long before the next job; a success reset it. Reports throughput,
+prompts sent during the outage and how long after ComfyUI came back the
+first job succeeded.
+
+    python bench/bench_breakers.py --jobs 40 --poison-every 4 --outage 6 --render-time 0.1
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from fake_comfyui import FakeComfyUI
+from watcher_module import load_watcher
+
+POISON = "POISON"
+
+
+def make_messages(count, poison_every):
+    messages = []
+    for i in range(count):
+        prompt = POISON if poison_every and i % poison_every == poison_every - 1 else "a cat"
+        body = {"id": f"bench-{i}", "model": "flux", "prompt": prompt, "seed": i + 1}
+        messages.append({"ReceiptHandle": f"rh-{i}", "Body": json.dumps(body)})
+    return messages
+
+
+def render(watcher, job):
+    for stage in (watcher.prepare_job, watcher.submit_job, watcher.await_job):
+        if not watcher.run_job_stage(stage, job):
+            watcher.release_job(job)
+            return False
+    return True
+
+
+def run(watcher, fake, args, policy, outage):
+    watcher.breakers = {name: watcher.CircuitBreaker(name) for name in ("comfyui", "sqs", "s3")}
+    messages = collections.deque(make_messages(args.jobs, args.poison_every))
+    interval = args.poll_interval
+    events = {"restored": None, "recovered": None}
+    sent_during_outage = [0]
+    if outage:
+        def fail():
+            fake.healthy = False
+            time.sleep(outage)
+            fake.healthy = True
+            events["restored"] = time.time()
+        threading.Timer(args.outage_start, fail).start()
+
+    done = 0
+    start = time.time()
+    while messages:
+        if policy == "breakers":
+            delay = watcher.job_start_delay()
+            if delay:
+                time.sleep(delay)
+                continue
+        elif interval > args.poll_interval:
+            time.sleep(interval)
+
+        msg = messages.popleft()
+        job = watcher.Job("bench", "bench", msg)
+        poisoned = job.tti_input.prompt == POISON
+        if not fake.healthy:
+            sent_during_outage[0] += 1
+        ok = render(watcher, job)
+        if ok:
+            done += 1
+            interval = args.poll_interval
+            if events["restored"] and not events["recovered"]:
+                events["recovered"] = time.time()
+        else:
+            interval = min(interval * 2, args.poll_interval * 15)
+            # SQS would redeliver it; poisoned jobs fail every time, so drop them
+            if not poisoned:
+                messages.append(msg)
+    elapsed = time.time() - start
+    lag = events["recovered"] - events["restored"] if events["restored"] and events["recovered"] else None
+    return done, elapsed, sent_during_outage[0], lag
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--poison-every", type=int, default=4, help="Every Nth job is rejected by ComfyUI, 0 for none")
+    parser.add_argument("--outage", type=float, default=6.0, help="Seconds ComfyUI fails every prompt")
+    parser.add_argument("--outage-start", type=float, default=1.0)
+    parser.add_argument("--render-time", type=float, default=0.1)
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+                        help="Base interval of the emulated global backoff; breakers use the same reset timeout")
+    args = parser.parse_args()
+
+    # Keep the only backend in the pool so the outage is handled by the breaker alone
+    os.environ.setdefault("COMFYUI_EJECT_FAILURES", "1000000")
+    os.environ["BREAKER_RESET_TIMEOUT"] = str(args.poll_interval)
+    os.environ["BREAKER_MAX_RESET_TIMEOUT"] = str(args.poll_interval * 15)
+    watcher = load_watcher(logging.CRITICAL)
+    fake = FakeComfyUI(render_time=args.render_time, output_dir=tempfile.mkdtemp(prefix="fake-comfyui-"),
+                       reject_marker=POISON).start()
+    watcher.backend_pool = watcher.BackendPool([fake.url])
+    watcher.start_comfy_listener()
+    watcher.backend_pool.backends[0].listener.connected.wait(5)
+
+    print(f"{'scenario':>8} {'policy':>9} {'jobs':>5} {'seconds':>8} {'jobs/s':>7} {'sent in outage':>15} {'recovery lag':>13}")
+    for scenario, poison_every, outage in (("poison", args.poison_every, 0), ("outage", 0, args.outage)):
+        run_args = argparse.Namespace(**dict(vars(args), poison_every=poison_every))
+        for policy in ("backoff", "breakers"):
+            done, elapsed, sent, lag = run(watcher, fake, run_args, policy, outage)
+            lag_text = f"{lag:.2f}s" if lag is not None else "-"
+            print(f"{scenario:>8} {policy:>9} {done:>5} {elapsed:>8.2f} {done / elapsed:>7.2f} "
+                  f"{sent if outage else '-':>15} {lag_text:>13}")
+    summary = watcher.breakers["comfyui"].recovery_stats.summary()
+    if summary["count"]:
+        print(f"ComfyUI outage as measured by the breaker: {summary['max']:.2f}s from opening to closing")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Benchmark: the whole watcher, end to end, against local stand-ins.
+
+Runs comfy-watcher's main() unchanged, with SQS, S3, SSM, STS and Lambda
+replaced by the in-process fakes of fake_aws.py and ComfyUI by fake ComfyUI
+processes. Jobs are put on the fake queues (with their request JSON in the
+fake bucket, as the website does), all at once or at --rate jobs/s, and the
+watcher is sent SIGTERM once every job was published or dead-lettered.
+
+Reports throughput, watcher CPU time per job (the AWS fakes run in the same
+process and are included), end-to-end latency from send to _final.json,
+AWS calls per job and the watcher's own stage latencies. --json saves the
+results and --baseline compares them with saved ones, so a change can be
+measured against the commit before it:
+
+    python bench/bench_e2e.py --jobs 200 --backends 2 --render-time 0.2 --json before.json
+    python bench/bench_e2e.py --jobs 200 --backends 2 --render-time 0.2 --baseline before.json
+
+Failures are injected with --reject-rate (ComfyUI refuses the workflow with
+a 400), --fail-rate (ComfyUI answers a 500) and --aws-error-rate (SQS and
+S3 calls are throttled). Watcher settings can be overridden with --env.
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from bench_engines import start_fakes
+from fake_aws import BUCKET, FAST_QUEUE, SLOW_QUEUE, FakeAWS
+from watcher_module import load_watcher
+
+POISON = "POISON"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, like the watcher's LatencyStats"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100.0 * len(values)) - 1))]
+
+
+def make_bodies(args):
+    models = args.models.split(",")
+    bodies = []
+    for i in range(args.jobs):
+        poisoned = args.reject_rate and i % round(1 / args.reject_rate) == 0
+        bodies.append({
+            "id": f"e2e-{i}",
+            "model": models[i % len(models)],
+            "prompt": POISON if poisoned else "a cat in a hat",
+            "seed": 0,
+        })
+    return bodies
+
+
+def send_jobs(aws, args, bodies, sent_at):
+    """Put the jobs on the queues like the website would, without counting them as watcher calls"""
+    interval = 1 / args.rate if args.rate else 0
+    start = time.time()
+    for i, body in enumerate(bodies):
+        if interval:
+            time.sleep(max(0.0, start + i * interval - time.time()))
+        queue_name = SLOW_QUEUE if args.slow_share and i % round(1 / args.slow_share) == 0 else FAST_QUEUE
+        group_id = f"group-{i % args.groups}" if args.groups else body["id"]
+        aws.s3._store(f"{body['id']}.json", json.dumps(body))
+        sent_at[body["id"]] = time.time()
+        aws.sqs._send(aws.sqs.queue_url(queue_name), json.dumps(body), group_id)
+
+
+def run(args, aws, watcher):
+    """Run the watcher until every job is settled; return the measurements"""
+    bodies = make_bodies(args)
+    sent_at = {}
+    result = {}
+
+    def drive():
+        cpu_start, start = time.process_time(), time.time()
+        sender = threading.Thread(target=send_jobs, args=(aws, args, bodies, sent_at), daemon=True)
+        sender.start()
+        finals = {body["id"]: f"{body['id']}_final.json" for body in bodies}
+        peak_threads = threading.active_count()
+        while time.time() - start < args.timeout:
+            published = [job_id for job_id, key in finals.items() if key in aws.s3.written_at]
+            dead = {json.loads(message["Body"])["id"] for message in aws.sqs.dead_letters()}
+            peak_threads = max(peak_threads, threading.active_count())
+            if len(published) + len(dead) >= len(bodies):
+                break
+            time.sleep(0.02)
+        cpu = time.process_time() - cpu_start
+        # Throughput counts up to the last publish, not the wait for poison jobs to be dead-lettered
+        elapsed = max([aws.s3.written_at[finals[job_id]] for job_id in published] or [time.time()]) - start
+        result.update(
+            elapsed=elapsed, cpu=cpu, peak_threads=peak_threads, dead=len(dead),
+            latencies=[aws.s3.written_at[finals[job_id]] - sent_at[job_id] for job_id in published],
+            calls=aws.calls(),
+        )
+        # Long polls return at once, then the watcher drains as on a real SIGTERM
+        aws.sqs.close()
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=drive, name="bench-driver", daemon=True).start()
+    # main() reads its subcommand from the command line
+    sys.argv = [watcher.__file__]
+    watcher.main()
+    return result
+
+
+def summarize(args, result, watcher):
+    published = len(result["latencies"])
+    jobs = max(published, 1)
+    outcomes = collections.Counter()
+    for (queue_name, model, outcome), count in watcher.job_counters.outcomes.items():
+        outcomes[outcome] += count
+    return {
+        "jobs": args.jobs,
+        "published": published,
+        "dead_lettered": result["dead"],
+        "seconds": round(result["elapsed"], 3),
+        "jobs_per_second": round(published / result["elapsed"], 3),
+        "cpu_ms_per_job": round(result["cpu"] / jobs * 1000, 3),
+        "peak_threads": result["peak_threads"],
+        "latency": {f"p{pct}": round(percentile(result["latencies"], pct), 3) for pct in (50, 95, 99, 100)},
+        "calls_per_job": {name: round(count / jobs, 3) for name, count in sorted(result["calls"].items())},
+        "outcomes": dict(outcomes),
+        "stages": {stage: stats.summary() for stage, stats in sorted(watcher.stage_latency.items())},
+    }
+
+
+def compare(label, value, baseline, lower_is_better=True):
+    if baseline is None:
+        return f"{label:<34} {value:>10}"
+    change = (value - baseline) / baseline * 100 if baseline else 0.0
+    better = change < 0 if lower_is_better else change > 0
+    return f"{label:<34} {value:>10} {baseline:>10} {change:>+8.1f}%{'' if not change else ' better' if better else ' worse'}"
+
+
+def report(summary, baseline):
+    print(f"{summary['jobs']} jobs: {summary['published']} published, {summary['dead_lettered']} dead-lettered, "
+          f"outcomes {summary['outcomes']}")
+    base = baseline or {}
+    print(f"{'':<34} {'now':>10} {'baseline':>10}" if baseline else "")
+    print(compare("jobs/s", summary["jobs_per_second"], base.get("jobs_per_second"), lower_is_better=False))
+    print(compare("CPU ms/job", summary["cpu_ms_per_job"], base.get("cpu_ms_per_job")))
+    print(compare("peak threads", summary["peak_threads"], base.get("peak_threads")))
+    for name, value in summary["latency"].items():
+        print(compare(f"end-to-end {name} s", value, base.get("latency", {}).get(name)))
+    print("AWS calls per job")
+    for name, value in summary["calls_per_job"].items():
+        print(compare(f"  {name}", value, base.get("calls_per_job", {}).get(name)))
+    print("watcher stages (p50 / p95 / p99 s)")
+    for stage, stats in summary["stages"].items():
+        print(f"  {stage:<26} {stats['p50']:>8} {stats['p95']:>8} {stats['p99']:>8}   count {stats['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0.0, help="Jobs sent per second, 0 sends them all at once")
+    parser.add_argument("--backends", type=int, default=2)
+    parser.add_argument("--render-time", type=float, default=0.2, help="Mean render seconds per image")
+    parser.add_argument("--render-distribution", default="fixed",
+                        choices=("fixed", "uniform", "exponential", "lognormal"))
+    parser.add_argument("--models", default="flux", help="Comma-separated models the jobs cycle through")
+    parser.add_argument("--slow-share", type=float, default=0.0, help="Fraction of jobs sent to the slow queue")
+    parser.add_argument("--groups", type=int, default=0, help="FIFO message groups, 0 gives every job its own")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Fraction of jobs ComfyUI rejects with a 400")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of prompts ComfyUI fails with a 500")
+    parser.add_argument("--aws-latency", type=float, default=0.0, help="Seconds added to every SQS and S3 call")
+    parser.add_argument("--aws-error-rate", type=float, default=0.0, help="Fraction of SQS and S3 calls throttled")
+    parser.add_argument("--max-receives", type=int, default=3, help="Receives before a message is dead-lettered")
+    parser.add_argument("--engine", default="threads", choices=("threads", "asyncio"))
+    parser.add_argument("--pipeline", action="store_true", help="Use the staged pipeline with the threads engine")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Watcher setting, may be repeated")
+    parser.add_argument("--timeout", type=float, default=600, help="Stop waiting for jobs after this many seconds")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for render times and injected failures")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare with results written by --json")
+    parser.add_argument("--log-level", default="CRITICAL")
+    args = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp(prefix="fake-comfyui-")
+    fake_args = ["--render-distribution", args.render_distribution, "--fail-rate", str(args.fail_rate),
+                 "--reject-marker", POISON, "--seed", str(args.seed)]
+    processes, urls = start_fakes(args.backends, args.render_time, fake_args, output_dir)
+    try:
+        # Failed jobs come back after the visibility timeout, so keep it short
+        os.environ.update({
+            "COMFYUI_URL": ",".join(urls),
+            "OUTPUT_FOLDER": output_dir,
+            "STATE_DIR": tempfile.mkdtemp(prefix="watcher-state-"),
+            "STATUS_PORT": "0",
+            "WATCHER_ENGINE": args.engine,
+            "PIPELINE_ENABLED": str(args.pipeline).lower(),
+            "RESULT_CACHE_ENABLED": "true",
+            "SQS_VISIBILITY_TIMEOUT": "5",
+            "SQS_HEARTBEAT_INTERVAL": "2",
+        })
+        os.environ.update(dict(pair.split("=", 1) for pair in args.env))
+        watcher = load_watcher(getattr(logging, args.log_level.upper()))
+        aws = FakeAWS(latency=args.aws_latency, error_rate=args.aws_error_rate,
+                      max_receives=args.max_receives, seed=args.seed)
+        aws.install(watcher)
+
+        summary = summarize(args, run(args, aws, watcher), watcher)
+        assert watcher.S3_BUCKET == BUCKET
+    finally:
+        for process in processes:
+            process.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Benchmark: per-job overhead of the threads engine vs the asyncio engine.
+
+Starts fake ComfyUI servers in subprocesses and renders the same jobs
+(prepare/submit/await, no SQS or S3) with a given number of jobs in flight.
+The threads engine is measured with one worker thread per job in flight,
+as the pipeline would be configured; the asyncio engine with the same
+number of tasks. Reports throughput, watcher CPU time per job and the
+number of threads used. With --render-time 0 the numbers are dominated
+by the watcher's own overhead.
+
+    python bench/bench_engines.py --backends 4 --jobs 400 --in-flight 32 --render-time 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from watcher_module import load_watcher
+
+FAKE_COMFYUI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_comfyui.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fakes(count, render_time, extra_args=(), output_dir=None):
+    """Start fake ComfyUI processes and wait until they answer"""
+    output_dir = output_dir or tempfile.mkdtemp(prefix="fake-comfyui-")
+    processes, urls = [], []
+    for _ in range(count):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, FAKE_COMFYUI, "--port", str(port), "--render-time", str(render_time),
+             "--output-dir", output_dir, *extra_args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+        urls.append(f"http://127.0.0.1:{port}")
+    for url in urls:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/system_stats", timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.1)
+    return processes, urls
+
+
+def make_jobs(watcher, count):
+    jobs = []
+    for i in range(count):
+        body = {"id": f"bench-{i}", "model": "flux", "prompt": "a cat", "seed": i + 1}
+        jobs.append(watcher.Job("bench", "bench", {"ReceiptHandle": f"rh-{i}", "Body": json.dumps(body)}))
+    return jobs
+
+
+def use_backends(watcher, urls):
+    watcher.backend_pool = watcher.BackendPool(urls)
+    watcher.start_comfy_listener()
+    for backend in watcher.backend_pool.backends:
+        backend.listener.connected.wait(5)
+
+
+def run_threads(watcher, jobs, in_flight):
+    work = queue.Queue()
+    for job in jobs:
+        work.put(job)
+    peak = [threading.active_count()]
+
+    def worker():
+        while True:
+            try:
+                job = work.get_nowait()
+            except queue.Empty:
+                return
+            for stage in (watcher.prepare_job, watcher.submit_job, watcher.await_job):
+                assert watcher.run_job_stage(stage, job), job.tti_input.id
+            peak[0] = max(peak[0], threading.active_count())
+
+    threads = [threading.Thread(target=worker) for _ in range(in_flight)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return peak[0]
+
+
+def run_asyncio(watcher, jobs, in_flight):
+    engine = watcher.AsyncEngine()
+    peak = [threading.active_count()]
+
+    async def main():
+        slots = asyncio.Semaphore(in_flight)
+
+        async def one(job):
+            async with slots:
+                assert await engine.render(job), job.tti_input.id
+                peak[0] = max(peak[0], threading.active_count())
+
+        async with watcher.aiohttp.ClientSession() as engine.session:
+            await asyncio.gather(*(one(job) for job in jobs))
+
+    asyncio.run(main())
+    return peak[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=400)
+    parser.add_argument("--in-flight", type=int, default=32)
+    parser.add_argument("--render-time", type=float, default=0.0)
+    parser.add_argument("--balance-mode", default="inflight", choices=("queue", "inflight"))
+    args = parser.parse_args()
+
+    watcher = load_watcher(logging.ERROR)
+    watcher.COMFYUI_BALANCE_MODE = args.balance_mode
+    processes, urls = start_fakes(args.backends, args.render_time)
+    try:
+        print(f"{'engine':>8} {'jobs/s':>8} {'CPU ms/job':>11} {'threads':>8}")
+        for name, run in (("threads", run_threads), ("asyncio", run_asyncio)):
+            use_backends(watcher, urls)
+            jobs = make_jobs(watcher, args.jobs)
+            cpu_start, start = time.process_time(), time.time()
+            threads = run(watcher, jobs, args.in_flight)
+            elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+            print(f"{name:>8} {args.jobs / elapsed:>8.1f} {cpu / args.jobs * 1000:>11.2f} {threads:>8}")
+            for backend in watcher.backend_pool.backends:
+                backend.listener.stop()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark: host metrics sampling cost, skipped uploads and concurrent list.json updates.
+
+Times ProcHostSource.sample() on this machine, then runs publishers against an
+in-memory bucket that honours IfMatch/IfNoneMatch like S3. Reports how many
+of the ticks were uploaded at a given tolerance, and whether list.json keeps
+every host when several hosts update it at the same time.
+
+    python bench/bench_host_metrics.py --ticks 600 --tolerance 1.0 --hosts 8
+"""
+import argparse
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+HOST_METRICS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host-metrics.py")
+
+
+def load_host_metrics():
+    spec = importlib.util.spec_from_file_location("host_metrics", HOST_METRICS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.logger.setLevel(logging.ERROR)
+    return module
+
+
+class MemoryBucket:
+    """put_object/get_object with S3's conditional write semantics"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.puts = 0
+        self.conflicts = 0
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            if Key not in self.objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            body, etag = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        body = Body.encode("utf-8")
+        time.sleep(0.002)  # request latency, so concurrent updates overlap
+        with self.lock:
+            current = self.objects.get(Key)
+            if (IfMatch and (current is None or current[1] != IfMatch)) or (IfNoneMatch and current is not None):
+                self.conflicts += 1
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            self.objects[Key] = (body, '"%s"' % hashlib.md5(body).hexdigest())
+            self.puts += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ticks", type=int, default=600)
+    parser.add_argument("--tolerance", type=float, default=1.0)
+    parser.add_argument("--step", type=float, default=0.5, help="Fake source random-walk step per tick")
+    parser.add_argument("--hosts", type=int, default=8)
+    args = parser.parse_args()
+
+    hm = load_host_metrics()
+
+    if os.path.exists("/proc/stat"):
+        source = hm.ProcHostSource(1.0)
+        samples = 200
+        start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(samples):
+            source.sample()
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        print(f"proc sample: {wall / samples * 1000:.2f} ms wall, {cpu / samples * 1000:.2f} ms CPU")
+
+    # Ticks are simulated, so max age is counted in ticks of one second
+    clock = [0.0]
+    hm.time.time = lambda: clock[0]
+    hm.HOST_METRICS_MAX_AGE = 30
+    for tolerance in (0.0, args.tolerance):
+        hm.HOST_METRICS_TOLERANCE = tolerance
+        bucket = MemoryBucket()
+        publisher = hm.HostMetricsPublisher(bucket, "bench", "host", hm.FakeHostSource(seed=1, step=args.step))
+        for tick in range(args.ticks):
+            clock[0] = tick
+            publisher.tick()
+        print(f"tolerance {tolerance}: {publisher.uploads} uploads for {args.ticks} ticks, "
+              f"{bucket.puts - publisher.uploads} list.json writes")
+    hm.time.time = time.time
+
+    bucket = MemoryBucket()
+    publishers = [hm.HostMetricsPublisher(bucket, "bench", f"host-{i}", hm.FakeHostSource(seed=i))
+                  for i in range(args.hosts)]
+    threads = [threading.Thread(target=publisher.tick) for publisher in publishers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    hosts = hm.json.loads(bucket.objects[hm.LIST_KEY][0])
+    print(f"{args.hosts} hosts updating list.json together: {len(hosts)} listed, {bucket.conflicts} conflicts retried")
+    assert len(hosts) == args.hosts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Microbenchmark: per-job workflow preparation, re-parsing vs compiled templates.
+
+The "reparse" path is what the watcher used to do for every message: open and
+json.load workflows/<model>.json and <model>.mapping.json, then walk the
+mapping with apply_workflow_mapping below. The "compiled" path fetches the cached
+template from the WorkflowRegistry and instantiates a per-job copy.
+
+    python bench/bench_templates.py --iterations 2000
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from watcher_module import load_watcher
+
+
+def apply_workflow_mapping(watcher, workflow, tti_input, mapping):
+    """The watcher's former per-job mapping walk, kept here as the baseline"""
+    seed = watcher.choose_seed(tti_input)
+    input_values = watcher.build_input_values(tti_input, seed)
+
+    for param, value in input_values.items():
+        if param in mapping:
+            mapping_config = mapping[param]
+
+            # Handle both single mappings and arrays of mappings
+            if isinstance(mapping_config, list):
+                for config in mapping_config:
+                    apply_single_mapping(watcher, workflow, config, value)
+            else:
+                apply_single_mapping(watcher, workflow, mapping_config, value)
+
+    return seed
+
+
+def apply_single_mapping(watcher, workflow, config, value):
+    node_id = config["node"]
+    input_name = config["input"]
+    is_optional = config.get("optional", False)
+    default_value = config.get("default")
+
+    # Use default value if provided and current value is None
+    if value is None and default_value is not None:
+        value = default_value
+
+    # Skip if value is None and mapping is optional
+    if value is None and is_optional:
+        return
+
+    # Check if the node and input exist before setting
+    if node_id in workflow:
+        if "inputs" in workflow[node_id]:
+            if not is_optional or input_name in workflow[node_id]["inputs"]:
+                workflow[node_id]["inputs"][input_name] = value
+                watcher.logger.debug(f"Set {node_id}.inputs.{input_name} = {value}")
+        else:
+            watcher.logger.warning(f"Node {node_id} has no inputs section")
+    else:
+        watcher.logger.warning(f"Node {node_id} not found in workflow")
+
+
+def prepare_reparse(watcher, tti_input):
+    workflow_path = os.path.join(watcher.WORKFLOW_DIR, tti_input.model + ".json")
+    mapping_path = os.path.join(watcher.WORKFLOW_DIR, tti_input.model + ".mapping.json")
+    with open(workflow_path, "r") as f:
+        workflow = json.load(f)
+    with open(mapping_path, "r") as f:
+        mapping = json.load(f)
+    apply_workflow_mapping(watcher, workflow, tti_input, mapping)
+    return workflow
+
+
+def prepare_compiled(watcher, tti_input):
+    template = watcher.workflow_registry.get(tti_input.model)
+    seed = watcher.choose_seed(tti_input)
+    return template.instantiate(watcher.build_input_values(tti_input, seed))
+
+
+def time_per_job(fn, watcher, tti_input, iterations):
+    fn(watcher, tti_input)  # warm up caches
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(watcher, tti_input)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    # The legacy path warns for every job about nodes missing from a workflow
+    watcher = load_watcher(logging.ERROR)
+    models = sorted(name[:-len(".mapping.json")] for name in os.listdir(watcher.WORKFLOW_DIR)
+                    if name.endswith(".mapping.json"))
+
+    print(f"{'model':<10} {'reparse us/job':>15} {'compiled us/job':>16} {'speedup':>8}")
+    for model in models:
+        tti_input = watcher.TTI_input({"id": "bench", "model": model, "prompt": "a cat", "seed": 1234})
+        # Both paths must produce the same workflow
+        assert prepare_reparse(watcher, tti_input) == prepare_compiled(watcher, tti_input), model
+        before = time_per_job(prepare_reparse, watcher, tti_input, args.iterations)
+        after = time_per_job(prepare_compiled, watcher, tti_input, args.iterations)
+        print(f"{model:<10} {before * 1e6:>15.1f} {after * 1e6:>16.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""In-process stand-ins for the AWS services comfy-watcher uses.
+
+FakeSQS models what the watcher depends on: visibility timeouts, a new
+receipt handle per receive (only the latest one deletes or extends a
+message), FIFO message groups that stay blocked while one of their
+messages is in flight, long polls, ApproximateReceiveCount and a redrive
+to a dead-letter list after max_receives receives. FakeS3 keeps objects in
+memory and honours IfMatch/IfNoneMatch. FakeSSM, FakeSTS and FakeLambda
+answer the calls made at startup and by Trello ingest.
+
+Every call is counted per operation and can be slowed down by latency
+seconds or failed with a throttling error at error_rate, both of which
+FakeAWS applies to all services. install(watcher) makes a loaded watcher
+module create its clients from these fakes:
+
+    aws = FakeAWS(latency=0.005)
+    aws.install(watcher)
+    aws.sqs.send_message(QueueUrl=aws.sqs.queue_url(FAST_QUEUE), MessageBody="{}")
+"""
+import collections
+import datetime
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+BUCKET = "bench-bucket"
+FAST_QUEUE = "bench-fast.fifo"
+SLOW_QUEUE = "bench-slow.fifo"
+SSM_VALUES = {"/ai/bucket": BUCKET, "/ai/sqs-fast": FAST_QUEUE, "/ai/sqs-slow": SLOW_QUEUE}
+
+
+class FakeService:
+    """Call counting, latency and error injection shared by the fakes"""
+
+    error_code = "ThrottlingException"
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.calls_lock = threading.Lock()
+
+    def _call(self, operation):
+        with self.calls_lock:
+            self.calls[operation] += 1
+            fail = self.error_rate and self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise ClientError({"Error": {"Code": self.error_code, "Message": "injected failure"}}, operation)
+
+
+class FakeQueue:
+    def __init__(self, name):
+        self.name = name
+        self.url = f"https://sqs.fake/000000000000/{name}"
+        self.messages = []  # in send order
+        self.dead_letters = []
+
+
+class FakeSQS(FakeService):
+    def __init__(self, max_receives=3, **kwargs):
+        super().__init__(**kwargs)
+        self.max_receives = max_receives
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.closed = False
+
+    def create_queue(self, name):
+        with self.condition:
+            queue = self.queues.setdefault(name, FakeQueue(name))
+        return queue.url
+
+    def queue_url(self, name):
+        return self.queues[name].url
+
+    def close(self):
+        """Make long polls return at once, so a draining watcher is not held up by them"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _queue(self, queue_url):
+        return self.queues[queue_url.rsplit("/", 1)[-1]]
+
+    def get_queue_url(self, QueueName):
+        self._call("GetQueueUrl")
+        if QueueName not in self.queues:
+            raise ClientError({"Error": {"Code": "AWS.SimpleQueueService.NonExistentQueue"}}, "GetQueueUrl")
+        return {"QueueUrl": self.queues[QueueName].url}
+
+    def _send(self, queue_url, body, group_id=None):
+        message = {
+            "MessageId": str(uuid.uuid4()),
+            "Body": body,
+            "GroupId": group_id,
+            "SentTimestamp": int(time.time() * 1000),
+            "ReceiveCount": 0,
+            "VisibleAt": 0.0,
+            "ReceiptHandle": None,
+        }
+        with self.condition:
+            self._queue(queue_url).messages.append(message)
+            self.condition.notify_all()
+        return message["MessageId"]
+
+    def send_message(self, QueueUrl, MessageBody, MessageGroupId=None, **kwargs):
+        self._call("SendMessage")
+        return {"MessageId": self._send(QueueUrl, MessageBody, MessageGroupId)}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call("SendMessageBatch")
+        return {"Successful": [
+            {"Id": entry["Id"], "MessageId": self._send(QueueUrl, entry["MessageBody"], entry.get("MessageGroupId"))}
+            for entry in Entries
+        ], "Failed": []}
+
+    def _take(self, queue, max_messages, visibility_timeout, now):
+        """Receive up to max_messages visible messages, skipping groups with a message in flight"""
+        blocked = {message["GroupId"] for message in queue.messages
+                   if message["GroupId"] is not None and message["VisibleAt"] > now}
+        taken = []
+        for message in list(queue.messages):
+            if len(taken) >= max_messages:
+                break
+            if message["VisibleAt"] > now or message["GroupId"] in blocked:
+                continue
+            if message["ReceiveCount"] >= self.max_receives:
+                queue.messages.remove(message)
+                queue.dead_letters.append(message)
+                continue
+            message["ReceiveCount"] += 1
+            message["VisibleAt"] = now + visibility_timeout
+            message["ReceiptHandle"] = uuid.uuid4().hex
+            taken.append(message)
+        return taken
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        self._call("ReceiveMessage")
+        queue = self._queue(QueueUrl)
+        deadline = time.time() + WaitTimeSeconds
+        with self.condition:
+            while True:
+                now = time.time()
+                taken = self._take(queue, MaxNumberOfMessages, VisibilityTimeout, now)
+                if taken or now >= deadline or self.closed:
+                    break
+                # Wake up for new messages, or when the next in-flight one becomes visible again
+                hidden = [message["VisibleAt"] for message in queue.messages if message["VisibleAt"] > now]
+                self.condition.wait(min([deadline] + hidden) - now)
+            return {"Messages": [{
+                "MessageId": message["MessageId"],
+                "ReceiptHandle": message["ReceiptHandle"],
+                "Body": message["Body"],
+                "Attributes": {
+                    "SentTimestamp": str(message["SentTimestamp"]),
+                    "ApproximateReceiveCount": str(message["ReceiveCount"]),
+                },
+            } for message in taken]}
+
+    def _find(self, queue, receipt_handle):
+        for message in queue.messages:
+            if message["ReceiptHandle"] == receipt_handle:
+                return message
+        return None
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call("DeleteMessageBatch")
+        successful, failed = [], []
+        with self.condition:
+            queue = self._queue(QueueUrl)
+            for entry in Entries:
+                message = self._find(queue, entry["ReceiptHandle"])
+                if message is None:
+                    failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "Message": "stale receipt handle"})
+                    continue
+                queue.messages.remove(message)
+                successful.append({"Id": entry["Id"]})
+            self.condition.notify_all()
+        return {"Successful": successful, "Failed": failed}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        response = self.delete_message_batch(QueueUrl, [{"Id": "0", "ReceiptHandle": ReceiptHandle}])
+        if response["Failed"]:
+            raise ClientError({"Error": {"Code": "ReceiptHandleIsInvalid"}}, "DeleteMessage")
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._call("ChangeMessageVisibilityBatch")
+        successful, failed = [], []
+        with self.condition:
+            queue = self._queue(QueueUrl)
+            now = time.time()
+            for entry in Entries:
+                message = self._find(queue, entry["ReceiptHandle"])
+                if message is None or message["VisibleAt"] <= now:
+                    failed.append({"Id": entry["Id"], "Code": "MessageNotInflight", "Message": "message not in flight"})
+                    continue
+                message["VisibleAt"] = now + entry["VisibilityTimeout"]
+                successful.append({"Id": entry["Id"]})
+            self.condition.notify_all()
+        return {"Successful": successful, "Failed": failed}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self._call("GetQueueAttributes")
+        with self.condition:
+            queue = self._queue(QueueUrl)
+            now = time.time()
+            visible = sum(1 for message in queue.messages if message["VisibleAt"] <= now)
+            return {"Attributes": {
+                "ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(len(queue.messages) - visible),
+            }}
+
+    def dead_letters(self):
+        with self.condition:
+            return [message for queue in self.queues.values() for message in queue.dead_letters]
+
+
+class FakeS3(FakeService):
+    error_code = "SlowDown"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.objects = {}  # key -> (body, etag)
+        self.written_at = {}  # key -> time of the last write
+
+    def _store(self, Key, body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        with self.lock:
+            self.objects[Key] = (body, etag)
+            self.written_at[Key] = time.time()
+        return {"ETag": etag}
+
+    def _missing(self, operation):
+        return ClientError({"Error": {"Code": "NoSuchKey" if operation == "GetObject" else "404"}}, operation)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self._call("PutObject")
+        with self.lock:
+            current = self.objects.get(Key)
+        if (IfMatch and (current is None or current[1] != IfMatch)) or (IfNoneMatch and current is not None):
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        return self._store(Key, Body.read() if hasattr(Body, "read") else Body)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call("GetObject")
+        with self.lock:
+            if Key not in self.objects:
+                raise self._missing("GetObject")
+            body, etag = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ETag": etag, "ContentLength": len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call("HeadObject")
+        with self.lock:
+            if Key not in self.objects:
+                raise self._missing("HeadObject")
+            body, etag = self.objects[Key]
+        return {"ETag": etag, "ContentLength": len(body)}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call("CopyObject")
+        with self.lock:
+            if CopySource["Key"] not in self.objects:
+                raise self._missing("CopyObject")
+            body = self.objects[CopySource["Key"]][0]
+        return {"CopyObjectResult": self._store(Key, body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("DeleteObject")
+        with self.lock:
+            self.objects.pop(Key, None)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        # A managed transfer is one PutObject below the multipart threshold
+        self._call("PutObject")
+        with open(Filename, "rb") as f:
+            self._store(Key, f.read())
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        self._call("PutObject")
+        self._store(Key, Fileobj.read())
+
+
+class FakeSSM(FakeService):
+    def get_parameters(self, Names, **kwargs):
+        self._call("GetParameters")
+        return {
+            "Parameters": [{"Name": name, "Value": SSM_VALUES[name]} for name in Names if name in SSM_VALUES],
+            "InvalidParameters": [name for name in Names if name not in SSM_VALUES],
+        }
+
+
+class FakeSTS(FakeService):
+    def get_caller_identity(self):
+        self._call("GetCallerIdentity")
+        return {"Account": "000000000000", "Arn": "arn:aws:iam::000000000000:user/bench"}
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self._call("AssumeRole")
+        return {"Credentials": {
+            "AccessKeyId": "ASIABENCH",
+            "SecretAccessKey": "bench",
+            "SessionToken": "bench",
+            "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+        }}
+
+
+class FakeLambda(FakeService):
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=None, **kwargs):
+        self._call("Invoke")
+        if InvocationType == "Event":
+            return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+        body = json.dumps({"message": "No new cards", "cardsProcessed": 0})
+        return {"StatusCode": 200, "Payload": io.BytesIO(json.dumps({"statusCode": 200, "body": body}).encode())}
+
+
+class FakeAWS:
+    """One fake per service, with the job queues already created"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, max_receives=3, seed=None):
+        options = dict(latency=latency, error_rate=error_rate, seed=seed)
+        self.sqs = FakeSQS(max_receives=max_receives, **options)
+        self.s3 = FakeS3(**options)
+        # Startup and ingest calls are not what is being measured
+        self.ssm = FakeSSM()
+        self.sts = FakeSTS()
+        self.lambda_client = FakeLambda()
+        self.sqs.create_queue(FAST_QUEUE)
+        self.sqs.create_queue(SLOW_QUEUE)
+
+    def client(self, service_name, **kwargs):
+        return {"sqs": self.sqs, "s3": self.s3, "ssm": self.ssm, "sts": self.sts,
+                "lambda": self.lambda_client}[service_name]
+
+    def install(self, watcher):
+        """Make the watcher's boto3 calls return these fakes"""
+        aws = self
+
+        class Session:
+            def __init__(self, **kwargs):
+                pass
+
+            def client(self, service_name, **kwargs):
+                return aws.client(service_name)
+
+        watcher.boto3 = type("boto3", (), {"client": staticmethod(self.client), "Session": Session})
+
+    def calls(self):
+        """Call counts of every service by "service.Operation\""""
+        counts = collections.Counter()
+        for name in ("sqs", "s3", "ssm", "sts", "lambda_client"):
+            for operation, count in getattr(self, name).calls.items():
+                counts[f"{name.replace('_client', '')}.{operation}"] += count
+        return counts
@@ -0,0 +1,369 @@
+"""Fake ComfyUI server for exercising comfy-watcher without a GPU.
+
+Implements the parts of the ComfyUI API the watcher uses: POST /prompt,
+GET /history/<prompt_id>, GET /view, GET /queue, GET /system_stats and the
+/ws event socket.
+Prompts are rendered one at a time, like ComfyUI, by sleeping for the
+configured render time and writing a small PNG per batch image into the
+output folder. Each extra image in a batch adds batch_scaling times the
+render time, and a prompt whose checkpoints differ from the previous one
+adds switch_time for the model reload. The render time is fixed or drawn
+from a uniform, exponential or lognormal distribution with the same mean.
+Prompts containing reject_marker are refused with a 400, as ComfyUI does
+for workflows that fail validation, and fail_rate of the other prompts get
+a 500 as if ComfyUI had a transient error.
+
+Run standalone and point the watcher at it:
+
+    python bench/fake_comfyui.py --port 8188 --render-time 2 --output-dir output
+    COMFYUI_URL=http://127.0.0.1:8188 OUTPUT_FOLDER=output python comfy-watcher.py
+
+or start it in-process with FakeComfyUI(...).start().
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger("fake_comfyui")
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# 1x1 transparent PNG
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+class FakeComfyUI:
+    """In-process fake ComfyUI backend"""
+
+    def __init__(self, host="127.0.0.1", port=0, render_time=1.0, output_dir="output",
+                 ws_drop_every=0, batch_scaling=1.0, switch_time=0.0, reject_marker=None,
+                 render_distribution="fixed", fail_rate=0.0, seed=None):
+        self.render_time = render_time
+        self.render_distribution = render_distribution
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.batch_scaling = batch_scaling
+        self.switch_time = switch_time
+        self.reject_marker = reject_marker
+        self.loaded_model = None
+        self.model_switches = 0
+        self.output_dir = output_dir
+        self.ws_drop_every = ws_drop_every
+        self.healthy = True  # set False to fail /prompt and /system_stats
+        self.lock = threading.Lock()
+        self.history = {}
+        self.pending = queue.Queue()
+        self.running = None
+        self.sockets = {}  # client_id -> list of (wfile, lock)
+        self.completed = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.stopped = False
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._render_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.pending.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def submit(self, body):
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            number = len(self.history) + self.pending.qsize()
+        self.pending.put((prompt_id, body))
+        return {"prompt_id": prompt_id, "number": number, "node_errors": {}}
+
+    def queue_status(self):
+        """ComfyUI's /queue response; only the prompt ids are filled in"""
+        running = self.running
+        pending = [item[0] for item in list(self.pending.queue) if item]
+        return {
+            "queue_running": [[0, running, {}, {}, []]] if running else [],
+            "queue_pending": [[i + 1, prompt_id, {}, {}, []] for i, prompt_id in enumerate(pending)],
+        }
+
+    def batch_size(self, body):
+        """Largest batch_size input in the prompt's workflow"""
+        sizes = [node.get("inputs", {}).get("batch_size", 1) for node in body.get("prompt", {}).values()
+                 if isinstance(node, dict)]
+        return max(sizes + [1])
+
+    def model_files(self, body):
+        """The checkpoint, unet and clip files a prompt's workflow loads"""
+        return tuple(sorted(
+            value for node in body.get("prompt", {}).values() if isinstance(node, dict)
+            for name, value in node.get("inputs", {}).items()
+            if name in ("ckpt_name", "unet_name") or name.startswith("clip_name")
+        ))
+
+    def sample_render_time(self):
+        """One image's render time, drawn from the configured distribution around render_time"""
+        if not self.render_time or self.render_distribution == "fixed":
+            return self.render_time
+        if self.render_distribution == "uniform":
+            return self.random.uniform(0.5, 1.5) * self.render_time
+        if self.render_distribution == "exponential":
+            return self.random.expovariate(1 / self.render_time)
+        if self.render_distribution == "lognormal":
+            # sigma 0.75 gives a long tail; mu is chosen so the mean stays render_time
+            return self.random.lognormvariate(math.log(self.render_time) - 0.75 ** 2 / 2, 0.75)
+        raise ValueError(f"Unknown render distribution {self.render_distribution}")
+
+    def render_seconds(self, body):
+        """Render time for a prompt; override for custom distributions"""
+        seconds = self.sample_render_time() * (1 + self.batch_scaling * (self.batch_size(body) - 1))
+        model = self.model_files(body)
+        if model != self.loaded_model:
+            if self.loaded_model is not None:
+                self.model_switches += 1
+            self.loaded_model = model
+            seconds += self.switch_time
+        return seconds
+
+    def outputs_for(self, prompt_id, body):
+        """Write the rendered images and return the history outputs for a prompt"""
+        images = []
+        for i in range(self.batch_size(body)):
+            filename = f"ComfyUI_{prompt_id[:8]}_{i + 1:05d}_.png"
+            with open(os.path.join(self.output_dir, filename), "wb") as f:
+                f.write(PNG_BYTES)
+            images.append({"filename": filename, "subfolder": "", "type": "output"})
+        return {"9": {"images": images}}
+
+    def _render_loop(self):
+        while not self.stopped:
+            item = self.pending.get()
+            if item is None:
+                break
+            prompt_id, body = item
+            self.running = prompt_id
+            client_id = body.get("client_id")
+            self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+            steps = 4
+            seconds = self.render_seconds(body)
+            for step in range(steps):
+                time.sleep(seconds / steps)
+                self._send(client_id, "progress",
+                           {"value": step + 1, "max": steps, "prompt_id": prompt_id, "node": "3"})
+            outputs = self.outputs_for(prompt_id, body)
+            with self.lock:
+                self.history[prompt_id] = {
+                    "prompt": [0, prompt_id, body.get("prompt", {}), {}, ["9"]],
+                    "outputs": outputs,
+                    "status": {"status_str": "success", "completed": True, "messages": []},
+                }
+                self.completed += 1
+                self.running = None
+                drop = self.ws_drop_every and self.completed % self.ws_drop_every == 0
+            if drop:
+                self._drop_sockets()
+            self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    def _send(self, client_id, event_type, data):
+        payload = json.dumps({"type": event_type, "data": data}).encode("utf-8")
+        with self.lock:
+            targets = list(self.sockets.get(client_id, [])) if client_id else \
+                [s for sockets in self.sockets.values() for s in sockets]
+        for wfile, lock in targets:
+            try:
+                with lock:
+                    wfile.write(_ws_frame(payload))
+                    wfile.flush()
+            except Exception:
+                pass
+
+    def _drop_sockets(self):
+        with self.lock:
+            targets = [s for sockets in self.sockets.values() for s in sockets]
+        for wfile, lock in targets:
+            try:
+                with lock:
+                    wfile.write(_ws_frame(b"", opcode=0x8))
+                    wfile.flush()
+            except Exception:
+                pass
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/prompt" and not fake.healthy:
+                    self._json(500, {"error": "injected failure"})
+                elif self.path == "/prompt" and fake.reject_marker and fake.reject_marker in json.dumps(body):
+                    self._json(400, {"error": {"type": "prompt_outputs_failed_validation"}})
+                elif self.path == "/prompt" and fake.fail_rate and fake.random.random() < fake.fail_rate:
+                    self._json(500, {"error": "injected failure"})
+                elif self.path == "/prompt":
+                    self._json(200, fake.submit(body))
+                else:
+                    self._json(404, {})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/ws":
+                    self._websocket(parse_qs(url.query).get("clientId", [""])[0])
+                elif url.path.startswith("/history/"):
+                    prompt_id = url.path[len("/history/"):]
+                    with fake.lock:
+                        entry = fake.history.get(prompt_id)
+                    self._json(200, {prompt_id: entry} if entry else {})
+                elif url.path == "/view":
+                    self._view(parse_qs(url.query))
+                elif url.path == "/queue":
+                    self._json(200, fake.queue_status())
+                elif url.path == "/system_stats" and not fake.healthy:
+                    self._json(503, {})
+                elif url.path == "/system_stats":
+                    self._json(200, {"system": {"os": "fake"}, "devices": []})
+                else:
+                    self._json(404, {})
+
+            def _view(self, query):
+                filename = os.path.basename(query.get("filename", [""])[0])
+                path = os.path.join(fake.output_dir, query.get("subfolder", [""])[0], filename)
+                if not filename or not os.path.isfile(path):
+                    self._json(404, {})
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.send_response(101, "Switching Protocols")
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                entry = (self.wfile, threading.Lock())
+                with fake.lock:
+                    fake.sockets.setdefault(client_id, []).append(entry)
+                fake._send(client_id, "status", {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id})
+                try:
+                    while _ws_read_frame(self.rfile) not in (None, 0x8):
+                        pass
+                finally:
+                    with fake.lock:
+                        fake.sockets.get(client_id, []).remove(entry)
+                self.close_connection = True
+
+        return Handler
+
+
+def _ws_frame(payload, opcode=0x1):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack("!H", length)
+    else:
+        header += bytes([127]) + struct.pack("!Q", length)
+    return header + payload
+
+
+def _ws_read_frame(rfile):
+    """Read one (masked) client frame and return its opcode, or None on EOF"""
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None
+    opcode = head[0] & 0x0F
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    if head[1] & 0x80:
+        rfile.read(4)
+    rfile.read(length)
+    return opcode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--render-time", type=float, default=1.0, help="Seconds per prompt")
+    parser.add_argument("--output-dir", default="output", help="Where rendered images are written")
+    parser.add_argument("--ws-drop-every", type=int, default=0,
+                        help="Close all websockets after every Nth completed prompt")
+    parser.add_argument("--batch-scaling", type=float, default=1.0,
+                        help="Extra render time per additional batch image, as a fraction of --render-time")
+    parser.add_argument("--switch-time", type=float, default=0.0,
+                        help="Extra seconds when a prompt loads different models than the previous one")
+    parser.add_argument("--reject-marker", default=None,
+                        help="Refuse prompts containing this string with a 400")
+    parser.add_argument("--render-distribution", default="fixed",
+                        choices=("fixed", "uniform", "exponential", "lognormal"),
+                        help="Distribution of render times around --render-time")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Fraction of prompts answered with a 500")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for render times and failures")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    fake = FakeComfyUI(args.host, args.port, args.render_time, args.output_dir, args.ws_drop_every,
+                       args.batch_scaling, args.switch_time, args.reject_marker,
+                       args.render_distribution, args.fail_rate, args.seed)
+    logger.info(f"Fake ComfyUI listening on {fake.url}")
+    fake.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Load comfy-watcher.py as a module so benchmarks can call into it."""
+import importlib.util
+import logging
+import os
+
+WATCHER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "comfy-watcher.py")
+
+
+def load_watcher(log_level=logging.WARNING):
+    """Import comfy-watcher.py under the name comfy_watcher"""
+    # Benchmarks reuse job ids, which the job ledger would treat as redeliveries
+    os.environ.setdefault("STATE_DIR", "")
+    # and explicit seeds the result cache would look up in S3
+    os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+    spec = importlib.util.spec_from_file_location("comfy_watcher", WATCHER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.logger.setLevel(log_level)
+    return module
@@ -1,6 +1,7 @@
 from fileinput import filename
 import logging
 import threading
+import queue
 import datetime
 
 
@@ -10,9 +11,38 @@ import os
 import sys
 import time
 import json
+import math
+import argparse
+import random
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
 import requests
 import secrets
+import hmac
+import hashlib
+import uuid
+import signal
+import socket
+import sqlite3
+import collections
+import itertools
+import asyncio
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # Set logging level based on LOG_LEVEL env var
 log_level = logging.DEBUG if os.environ.get("LOG_LEVEL") == "DEBUG" else logging.INFO
@@ -28,8 +58,9 @@ lambda_client = None
 S3_BUCKET = None
 FAST_QUEUE = None
 SLOW_QUEUE = None
-role_refresh_timer = None
-iteration_counter = 0
+sts_client = None
+ssm_refresh_timer = None
+credentials_expiration = None  # when the assumed role credentials expire (epoch seconds)
 
 # AWS Region
 AWS_REGION = os.getenv("COMFY_AWS_DEFAULT_REGION") or os.getenv("AWS_DEFAULT_REGION", "us-west-2")
@@ -82,99 +113,178 @@ def get_initial_aws_credentials():
     return access_key, secret_key
 
 def assume_dnd_role():
-    """Assume the configured AWS role and return session with temporary credentials"""
-    global aws_session, s3, sqs, ssm, lambda_client, S3_BUCKET, FAST_QUEUE, SLOW_QUEUE
-    
+    """Create the AWS clients on credentials for the configured role that botocore refreshes before they expire"""
+    global aws_session, s3, sqs, ssm, lambda_client, sts_client
+
     logger.info(f"Assuming {AWS_ROLE_NAME}...")
-    
+
     # Get initial credentials for assuming role
     initial_access_key, initial_secret_key = get_initial_aws_credentials()
-    
-    # Create initial STS client
+
+    # Create initial STS client, kept to assume the role again on every refresh
     sts_client = boto3.client(
         'sts',
         aws_access_key_id=initial_access_key,
         aws_secret_access_key=initial_secret_key,
         region_name=AWS_REGION
     )
-    
+
     try:
         # Get caller identity to determine account ID
         caller_identity = sts_client.get_caller_identity()
         account_id = caller_identity['Account']
         logger.debug(f"Current account ID: {account_id}")
-        
-        # Assume the configured role
+
         role_arn = f'arn:aws:iam::{account_id}:role/{AWS_ROLE_NAME}'
-        response = sts_client.assume_role(
-            RoleArn=role_arn,
-            RoleSessionName='comfy-watcher-session'
+        credentials = RefreshableCredentials.create_from_metadata(
+            metadata=fetch_role_credentials(role_arn),
+            refresh_using=lambda: fetch_role_credentials(role_arn),
+            method="sts-assume-role",
         )
-        
-        credentials = response['Credentials']
-        logger.info(f"Successfully assumed {AWS_ROLE_NAME}. Session expires at: {credentials['Expiration']}")
-        
-        # Create session with temporary credentials
-        aws_session = boto3.Session(
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken'],
-            region_name=AWS_REGION
-        )
-        
-        # Initialize AWS clients with the assumed role session
-        s3 = aws_session.client('s3')
+        botocore_session = botocore.session.get_session()
+        # Resolved ahead of the environment, so the session and every client share these credentials
+        botocore_session.get_component("credential_provider").insert_before("env", RoleCredentialProvider(credentials))
+        aws_session = boto3.Session(botocore_session=botocore_session, region_name=AWS_REGION)
+
+        # The clients and their connection pools live as long as the watcher
+        s3 = aws_session.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
         sqs = aws_session.client('sqs')
         ssm = aws_session.client('ssm')
         lambda_client = aws_session.client('lambda')
-        
-        # Get S3 bucket and SQS queue names from SSM
-        S3_BUCKET = get_ssm_parameter('/ai/bucket')
-        FAST_QUEUE = get_ssm_parameter('/ai/sqs-fast')
-        SLOW_QUEUE = get_ssm_parameter('/ai/sqs-slow')
-        
-        if not S3_BUCKET or not FAST_QUEUE or not SLOW_QUEUE:
+
+        if not apply_ssm_config(get_ssm_parameters()):
             logger.error(f"Failed to retrieve required SSM parameters. S3_BUCKET: {S3_BUCKET}, FAST_QUEUE: {FAST_QUEUE}, SLOW_QUEUE: {SLOW_QUEUE}")
             return False
-        
+
         logger.info(f"Retrieved S3 bucket: {S3_BUCKET}")
         logger.info(f"Retrieved fast SQS queue: {FAST_QUEUE}")
         logger.info(f"Retrieved slow SQS queue: {SLOW_QUEUE}")
-        
         return True
-        
+
     except Exception as e:
         logger.error(f"Failed to assume {AWS_ROLE_NAME}: {e}")
         return False
 
-def get_ssm_parameter(parameter_name):
-    """Get parameter value from AWS SSM Parameter Store"""
+
+class RoleCredentialProvider(CredentialProvider):
+    """Hands botocore's credential resolver the refreshable credentials of the assumed role"""
+
+    METHOD = "sts-assume-role"
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+
+def fetch_role_credentials(role_arn):
+    """Assume the role; botocore calls this again shortly before the credentials expire"""
+    global credentials_expiration
+    response = sts_client.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName='comfy-watcher-session'
+    )
+    credentials = response['Credentials']
+    logger.info(f"Successfully assumed {AWS_ROLE_NAME}. Session expires at: {credentials['Expiration']}")
+    credentials_expiration = credentials['Expiration'].timestamp()
+    return {
+        "access_key": credentials['AccessKeyId'],
+        "secret_key": credentials['SecretAccessKey'],
+        "token": credentials['SessionToken'],
+        "expiry_time": credentials['Expiration'].isoformat(),
+    }
+
+
+# SSM configuration. The bucket and queue names are read with one
+# get_parameters call and cached in STATE_DIR/ssm-parameters.json, so a
+# restart within SSM_CACHE_TTL seconds makes no SSM request. A running
+# watcher reads them again each time the TTL expires.
+SSM_PARAMETERS = ('/ai/bucket', '/ai/sqs-fast', '/ai/sqs-slow')
+SSM_CACHE_TTL = int(os.getenv("SSM_CACHE_TTL", "3600"))
+
+
+def get_ssm_parameters():
+    """Values of SSM_PARAMETERS by name, from the disk cache while it is fresh"""
+    cache_path = os.path.join(STATE_DIR, "ssm-parameters.json") if STATE_DIR else None
+    cached = None
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring SSM parameter cache {cache_path}: {e}")
+    if cached and set(SSM_PARAMETERS) <= cached["values"].keys():
+        age = time.time() - cached["fetched_at"]
+        if age < SSM_CACHE_TTL:
+            logger.debug(f"Using SSM parameters cached {age:.0f}s ago")
+            return cached["values"]
+
     try:
-        response = ssm.get_parameter(Name=parameter_name)
-        value = response['Parameter']['Value']
-        logger.debug(f"Retrieved SSM parameter {parameter_name}: {value}")
-        return value
+        response = ssm.get_parameters(Names=list(SSM_PARAMETERS))
     except Exception as e:
-        logger.error(f"Failed to get SSM parameter {parameter_name}: {e}")
-        return None
+        logger.error(f"Failed to get SSM parameters: {e}")
+        if cached:
+            # Stale names are better than none; they rarely change
+            logger.warning(f"Using SSM parameters cached {time.time() - cached['fetched_at']:.0f}s ago")
+            return cached["values"]
+        return {}
+    for name in response.get("InvalidParameters", []):
+        logger.error(f"SSM parameter {name} not found")
+    values = {parameter["Name"]: parameter["Value"] for parameter in response["Parameters"]}
+    logger.debug(f"Retrieved SSM parameters: {values}")
+
+    if cache_path and set(SSM_PARAMETERS) <= values.keys():
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(cache_path + ".tmp", "w") as f:
+                json.dump({"fetched_at": time.time(), "values": values}, f)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write SSM parameter cache {cache_path}: {e}")
+    return values
+
 
-def invoke_trello_lambda():
-    """Invoke the Trello to SQS Lambda function"""
+def apply_ssm_config(values):
+    """Use the bucket and queue names from SSM; False if any is missing"""
+    global S3_BUCKET, FAST_QUEUE, SLOW_QUEUE
+    bucket, fast_queue, slow_queue = (values.get(name) for name in SSM_PARAMETERS)
+    if not bucket or not fast_queue or not slow_queue:
+        return False
+    if (bucket, fast_queue, slow_queue) != (S3_BUCKET, FAST_QUEUE, SLOW_QUEUE) and S3_BUCKET is not None:
+        logger.info(f"SSM configuration changed: bucket {bucket}, queues {fast_queue} and {slow_queue}")
+    S3_BUCKET, FAST_QUEUE, SLOW_QUEUE = bucket, fast_queue, slow_queue
+    return True
+
+
+def invoke_trello_lambda(invocation_type="RequestResponse"):
+    """Invoke the Trello to SQS Lambda function; False if it failed"""
     try:
         logger.info("Invoking Trello to SQS Lambda function...")
         response = lambda_client.invoke(
             FunctionName='ai-trello-to-sqs',
-            InvocationType='RequestResponse',
+            InvocationType=invocation_type,
             Payload=json.dumps({
                 'httpMethod': 'POST',
                 'headers': {},
                 'body': '{}'
             })
         )
-        
+
+        # An Event invocation is only queued; its result is not returned
+        if invocation_type == "Event":
+            if response.get('StatusCode') == 202:
+                logger.info("Trello Lambda invoked asynchronously")
+                return True
+            logger.error(f"Trello Lambda invocation failed with status: {response.get('StatusCode')}")
+            return False
+
         # Parse the response
         payload = json.loads(response['Payload'].read())
-        if response.get('StatusCode') == 200:
+        if response.get('StatusCode') == 200 and 'FunctionError' not in response:
             if 'body' in payload:
                 body = json.loads(payload['body'])
                 logger.info(f"Trello Lambda executed successfully: {body.get('message', 'Unknown result')}")
@@ -182,62 +292,210 @@ def invoke_trello_lambda():
                     logger.info(f"Cards processed: {body['cardsProcessed']}")
             else:
                 logger.info("Trello Lambda executed successfully")
-        else:
-            logger.error(f"Trello Lambda execution failed with status: {response.get('StatusCode')}")
-            if 'errorMessage' in payload:
-                logger.error(f"Error message: {payload['errorMessage']}")
+            return True
+        logger.error(f"Trello Lambda execution failed with status: {response.get('StatusCode')}")
+        if 'errorMessage' in payload:
+            logger.error(f"Error message: {payload['errorMessage']}")
+        return False
     except Exception as e:
         logger.error(f"Failed to invoke Trello Lambda function: {e}")
+        return False
 
-def refresh_role():
-    """Refresh the assumed role credentials"""
-    logger.info(f"Refreshing {AWS_ROLE_NAME} credentials...")
-    success = assume_dnd_role()
-    if success:
-        # Schedule next refresh in 59 minutes
-        schedule_role_refresh()
-    else:
-        logger.error("Failed to refresh role, retrying in 5 minutes...")
-        # Retry in 5 minutes if failed
-        global role_refresh_timer
-        role_refresh_timer = threading.Timer(300, refresh_role)  # 5 minutes
-        role_refresh_timer.daemon = True
-        role_refresh_timer.start()
-
-def schedule_role_refresh():
-    """Schedule role refresh in 59 minutes"""
-    global role_refresh_timer
+
+def refresh_ssm_config():
+    """Read the bucket and queue names again once the cached values have expired"""
+    try:
+        if not apply_ssm_config(get_ssm_parameters()):
+            logger.error("Failed to refresh SSM parameters, keeping the current configuration")
+    finally:
+        schedule_ssm_refresh()
+
+
+def schedule_ssm_refresh():
+    """Schedule refresh_ssm_config when the cached SSM values expire"""
+    global ssm_refresh_timer
     # Cancel existing timer if any
-    if role_refresh_timer:
-        role_refresh_timer.cancel()
-    
-    # Schedule refresh in 59 minutes (3540 seconds)
-    role_refresh_timer = threading.Timer(3540, refresh_role)
-    role_refresh_timer.daemon = True
-    role_refresh_timer.start()
-    logger.debug("Scheduled role refresh in 59 minutes")
+    if ssm_refresh_timer:
+        ssm_refresh_timer.cancel()
+    ssm_refresh_timer = threading.Timer(SSM_CACHE_TTL, refresh_ssm_config)
+    ssm_refresh_timer.daemon = True
+    ssm_refresh_timer.start()
+    logger.debug(f"Scheduled SSM parameter refresh in {SSM_CACHE_TTL}s")
 
 # ComfyUI and other configuration
 OUTPUT_FOLDER = os.getenv("OUTPUT_FOLDER", "output")
 COMFYUI_URL = os.getenv("COMFYUI_URL", "http://127.0.0.1:8188")
+# COMFYUI_URL may list several backends, e.g. one ComfyUI process per GPU
+COMFYUI_URLS = [url.strip().rstrip("/") for url in COMFYUI_URL.split(",") if url.strip()]
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "2"))
-ORIGINAL_POLL_INTERVAL = POLL_INTERVAL  # Store original value for reset
-current_poll_interval = POLL_INTERVAL  # Current poll interval (may change with backoff)
 
 
-def apply_backoff():
-    """Apply binary backoff to poll interval, max 30 seconds"""
-    global current_poll_interval
-    current_poll_interval = min(current_poll_interval * 2, 30)
-    logger.info(f"ComfyUI failure detected, increasing poll interval to {current_poll_interval} seconds")
+# Seconds between periodic statistics reports in the log
+STATS_REPORT_INTERVAL = int(os.getenv("STATS_REPORT_INTERVAL", "300"))
+
+
+# Upper bounds in seconds of the cumulative latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class LatencyStats:
+    """Count, total, histogram and a window of recent samples for one latency measurement"""
 
+    def __init__(self, window=1024):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.samples = collections.deque(maxlen=window)
 
-def reset_poll_interval():
-    """Reset poll interval to original value after successful ComfyUI call"""
-    global current_poll_interval
-    if current_poll_interval != ORIGINAL_POLL_INTERVAL:
-        current_poll_interval = ORIGINAL_POLL_INTERVAL
-        logger.info(f"ComfyUI success detected, resetting poll interval to {current_poll_interval} seconds")
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.samples.append(seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+
+    def percentile(self, pct):
+        """Nearest-rank percentile over the recent sample window"""
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, max(0, math.ceil(pct / 100.0 * len(samples)) - 1))
+        return samples[index]
+
+    def summary(self):
+        with self.lock:
+            count, total, maximum = self.count, self.total, self.max
+        return {
+            "count": count,
+            "mean": round(total / count, 3) if count else 0.0,
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+            "max": round(maximum, 3),
+        }
+
+    def snapshot(self):
+        """Summary plus the cumulative histogram, keyed by bucket upper bound"""
+        summary = self.summary()
+        with self.lock:
+            summary["buckets"] = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.buckets)}
+        return summary
+
+
+# Latency of each job stage, published by the MetricsPublisher
+stage_latency = collections.defaultdict(LatencyStats)
+
+
+# Circuit breakers. ComfyUI, SQS and S3 each have a breaker that opens after
+# BREAKER_FAILURE_THRESHOLD failures in a row. While it is open, work that
+# needs the dependency is not started. After BREAKER_RESET_TIMEOUT seconds one
+# probe is let through (half-open): its success closes the breaker, its
+# failure reopens it for twice as long, up to BREAKER_MAX_RESET_TIMEOUT.
+# Failures caused by the job itself, such as a workflow ComfyUI rejects or a
+# missing output, are retried through SQS without counting against anything.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "5"))
+BREAKER_MAX_RESET_TIMEOUT = float(os.getenv("BREAKER_MAX_RESET_TIMEOUT", "60"))
+
+
+class CircuitBreaker:
+    """Closed, open or half-open state of one dependency and how long it took to recover"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.reset_timeout = BREAKER_RESET_TIMEOUT
+        self.opened_at = None  # start of the current outage
+        self.retry_at = 0.0  # when the next half-open probe may start
+        self.opens = 0
+        self.recovery_stats = LatencyStats()
+
+    def allow(self):
+        """Whether work needing the dependency may start; only one probe at a time while half-open"""
+        with self.lock:
+            if self.state == "closed":
+                return True
+            now = time.time()
+            if now < self.retry_at:
+                return False
+            self.state = "half_open"
+            # A probe that never reports back is replaced after the same timeout
+            self.retry_at = now + self.reset_timeout
+        logger.info(f"{self.name} circuit half-open, letting a probe through")
+        return True
+
+    def release_probe(self):
+        """Hand back a half-open probe taken by allow() that was never used"""
+        with self.lock:
+            if self.state == "half_open":
+                self.retry_at = time.time()
+
+    def delay(self):
+        """Seconds until allow() can return True"""
+        with self.lock:
+            if self.state == "closed":
+                return 0.0
+            return max(0.0, self.retry_at - time.time())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            if self.state == "closed":
+                return
+            recovered = time.time() - self.opened_at
+            self.state = "closed"
+            self.opened_at = None
+            self.reset_timeout = BREAKER_RESET_TIMEOUT
+        self.recovery_stats.record(recovered)
+        logger.info(f"{self.name} circuit closed, recovered after {recovered:.1f}s")
+
+    def record_failure(self, reason):
+        with self.lock:
+            self.consecutive_failures += 1
+            now = time.time()
+            if self.state == "half_open":
+                # The probe failed
+                self.reset_timeout = min(self.reset_timeout * 2, BREAKER_MAX_RESET_TIMEOUT)
+            elif self.state == "closed" and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                self.opened_at = now
+                self.opens += 1
+            else:
+                return
+            self.state = "open"
+            self.retry_at = now + self.reset_timeout
+            reset_timeout = self.reset_timeout
+        logger.warning(f"{self.name} circuit open after {reason}, probing again in {reset_timeout:g}s")
+
+
+breakers = {name: CircuitBreaker(name) for name in ("comfyui", "sqs", "s3")}
+
+
+def job_start_delay():
+    """Seconds to wait before starting another job, 0 when ComfyUI and S3 may be used"""
+    for name in ("comfyui", "s3"):
+        delay = breakers[name].delay()
+        if delay:
+            return delay
+    # Both would let a job through. If one refuses after all, the probe the other gave is handed back
+    probes = []
+    for name in ("comfyui", "s3"):
+        breaker = breakers[name]
+        probe = breaker.state != "closed"
+        if not breaker.allow():
+            for taken in probes:
+                taken.release_probe()
+            return breaker.delay()
+        if probe:
+            probes.append(breaker)
+    return 0.0
 
 
 class TTI_input:
@@ -258,22 +516,169 @@ class TTI_input:
         self.model = sqs_body_dict.get("model", "hidream")
 
 
-def send_sqs_message(queue_name, message_body):
+def send_sqs_messages(queue_name, messages):
+    """Enqueue (body, group_id) pairs with send_message_batch; return how many SQS accepted"""
     queue_url = get_sqs_url_by_name(queue_name)
     if not queue_url:
-        logger.debug(f"Queue URL not found for '{queue_name}'.")
-        return
-    response = sqs.send_message(QueueUrl=queue_url, MessageBody=message_body)
-    logger.debug(f"SQS message sent: {response['MessageId']}")
+        logger.error(f"Queue URL not found for '{queue_name}'.")
+        return 0
+    # Group and deduplication ids are only accepted by FIFO queues
+    fifo = queue_name.endswith(".fifo")
+    sent = 0
+    for start in range(0, len(messages), 10):
+        entries = []
+        for i, (body, group_id) in enumerate(messages[start:start + 10]):
+            entry = {"Id": str(i), "MessageBody": json.dumps(body)}
+            if fifo:
+                entry["MessageGroupId"] = group_id
+                entry["MessageDeduplicationId"] = body["id"]
+            entries.append(entry)
+        try:
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            logger.error(f"Failed to send {len(entries)} messages to '{queue_name}': {e}")
+            continue
+        for failure in response.get("Failed", []):
+            logger.error(f"Failed to send message to '{queue_name}': {failure.get('Message')}")
+        sent += len(response.get("Successful", []))
+    return sent
 
 
-def apply_workflow_mapping(workflow, tti_input, mapping):
-    """Apply TTI input parameters to workflow using mapping configuration"""
-    # Use seed from the TTI_input instead of generating a new one
-    seed = tti_input.seed if tti_input.seed != 0 else secrets.randbits(64)
-    
-    # Create a mapping of TTI_input attributes to their values
-    input_values = {
+# Synthetic load for `python comfy-watcher.py send`. Requests are built from
+# weighted mixes such as "flux:3,sd3.5:1" and enqueued ten per
+# send_message_batch call at --rate requests per second, each with its
+# request JSON in the bucket as the website writes it.
+LOAD_PROMPTS = (
+    "a cat in a hat",
+    "a lighthouse on a cliff at sunset, oil painting",
+    "portrait of an old sailor, dramatic lighting",
+    "a futuristic city street in the rain, neon signs",
+    "a bowl of fruit on a wooden table, still life",
+)
+
+
+def parse_mix(text, convert=str):
+    """Parse "a:3,b" into ([a, b], [3.0, 1.0]) for random.choices"""
+    values, weights = [], []
+    for item in text.split(","):
+        value, _, weight = item.strip().partition(":")
+        values.append(convert(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def make_load_request(rng, args, request_id):
+    """A valid TTI_input payload drawn from the configured mixes"""
+    model = rng.choices(*args.models)[0]
+    width, height = rng.choices(*args.sizes)[0]
+    return {
+        "id": request_id,
+        "model": model,
+        "prompt": rng.choice(args.prompt or LOAD_PROMPTS),
+        "width": width,
+        "height": height,
+        "steps": rng.choices(*args.steps)[0],
+        "cfg": args.cfg,
+        "seed": rng.randrange(1, 2 ** 32) if args.explicit_seeds else 0,
+    }
+
+
+def send_load(argv):
+    """Enqueue synthetic requests for load-testing a fleet of watchers"""
+    parser = argparse.ArgumentParser(prog="comfy-watcher.py send", description=send_load.__doc__)
+    parser.add_argument("--count", type=int, default=1, help="Requests to send")
+    parser.add_argument("--queue", choices=("fast", "slow"), default="fast")
+    parser.add_argument("--rate", type=float, default=0, help="Requests per second, 0 sends as fast as possible")
+    parser.add_argument("--models", type=parse_mix, default="flux", help='Weighted model mix, e.g. "flux:3,sd3.5:1"')
+    parser.add_argument("--sizes", type=lambda text: parse_mix(text, parse_size), default="1024x1024",
+                        help='Weighted size mix, e.g. "1024x1024:3,768x1344"')
+    parser.add_argument("--steps", type=lambda text: parse_mix(text, int), default="30",
+                        help='Weighted steps mix, e.g. "20,30:2"')
+    parser.add_argument("--cfg", type=float, default=5.0)
+    parser.add_argument("--prompt", action="append", help="Prompt to draw from, may be repeated")
+    parser.add_argument("--explicit-seeds", action="store_true",
+                        help="Send a random non-zero seed instead of letting the watcher choose one")
+    parser.add_argument("--groups", type=int, default=0,
+                        help="FIFO message groups to spread requests over, 0 gives each request its own")
+    parser.add_argument("--no-request-json", dest="request_json", action="store_false",
+                        help="Do not write {id}.json to the bucket")
+    parser.add_argument("--random-seed", type=int, default=None, help="Seed for the request mix")
+    args = parser.parse_args(argv)
+    for model in args.models[0]:
+        try:
+            workflow_registry.get(model)
+        except FileNotFoundError:
+            parser.error(f"no workflow for model {model} in {WORKFLOW_DIR}")
+
+    queue_name = FAST_QUEUE if args.queue == "fast" else SLOW_QUEUE
+    rng = random.Random(args.random_seed)
+    run_id = uuid.uuid4().hex[:8]
+    batch_size = max(1, min(10, int(args.rate))) if args.rate else 10
+    logger.info(f"Sending {args.count} requests to '{queue_name}'" + (f" at {args.rate:g}/s" if args.rate else ""))
+
+    sent = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as pool:
+        for index in range(0, args.count, batch_size):
+            if args.rate:
+                time.sleep(max(0.0, start + index / args.rate - time.time()))
+            messages = []
+            for i in range(index, min(index + batch_size, args.count)):
+                body = make_load_request(rng, args, f"load-{run_id}-{i:06d}")
+                group_id = f"load-{run_id}-{i % args.groups}" if args.groups else body["id"]
+                messages.append((body, group_id))
+            if args.request_json:
+                list(pool.map(lambda message: put_json_object(f"{message[0]['id']}.json", message[0]), messages))
+            sent += send_sqs_messages(queue_name, messages)
+    elapsed = time.time() - start
+    logger.info(f"Sent {sent} of {args.count} requests to '{queue_name}' in {elapsed:.1f}s "
+                f"({sent / elapsed if elapsed else 0:.1f}/s), ids load-{run_id}-*")
+
+
+# Seed assignment for requests with seed 0. "random" draws a new seed and
+# writes it back into the request JSON after the render; "derived" computes it
+# from the job id and SEED_SALT, so it is known up front and reproducible.
+SEED_MODE = os.getenv("SEED_MODE", "random")
+SEED_SALT = read_secret("/run/secrets/seed_salt") or os.getenv("SEED_SALT")
+
+
+def check_seed_mode():
+    """Fall back to random seeds if derived seeds are requested without a salt"""
+    global SEED_MODE
+    if SEED_MODE == "derived" and not SEED_SALT:
+        logger.error("SEED_MODE=derived requires SEED_SALT or /run/secrets/seed_salt, using random seeds")
+        SEED_MODE = "random"
+    logger.info(f"Using {SEED_MODE} seeds for requests without a seed")
+
+
+def derive_seed(job_id):
+    """Derive a reproducible 64-bit seed from the job id and secret salt"""
+    digest = hmac.new(SEED_SALT.encode("utf-8"), str(job_id).encode("utf-8"), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def choose_seed(tti_input):
+    """Use the seed from the TTI_input, assigning one according to SEED_MODE when it is 0"""
+    if tti_input.seed != 0:
+        return tti_input.seed
+    if SEED_MODE == "derived":
+        return derive_seed(tti_input.id)
+    return secrets.randbits(64)
+
+
+def seed_needs_writeback(tti_input):
+    """Random seeds are only recorded by patching them into the original request JSON"""
+    return tti_input.seed == 0 and SEED_MODE != "derived"
+
+
+def build_input_values(tti_input, seed, batch_size=1):
+    """Create a mapping of TTI_input attributes to their workflow values"""
+    return {
         'prompt': tti_input.prompt,
         'negativePrompt': tti_input.negativePrompt,
         'height': tti_input.height,
@@ -281,344 +686,2881 @@ def apply_workflow_mapping(workflow, tti_input, mapping):
         'steps': tti_input.steps,
         'seed': seed,
         'cfg': tti_input.cfg,
-        'batch_size': 1  # Default value
+        'batch_size': batch_size
     }
-    
-    for param, value in input_values.items():
-        if param in mapping:
-            mapping_config = mapping[param]
-            
-            # Handle both single mappings and arrays of mappings
-            if isinstance(mapping_config, list):
-                for config in mapping_config:
-                    apply_single_mapping(workflow, config, value)
-            else:
-                apply_single_mapping(workflow, mapping_config, value)
-    
-    return seed
-
-def apply_single_mapping(workflow, config, value):
-    """Apply a single parameter mapping to the workflow"""
-    node_id = config["node"]
-    input_name = config["input"]
-    is_optional = config.get("optional", False)
-    default_value = config.get("default")
-    
-    # Use default value if provided and current value is None
-    if value is None and default_value is not None:
-        value = default_value
-    
-    # Skip if value is None and mapping is optional
-    if value is None and is_optional:
-        return
-    
-    # Check if the node and input exist before setting
-    if node_id in workflow:
-        if "inputs" in workflow[node_id]:
-            if not is_optional or input_name in workflow[node_id]["inputs"]:
-                workflow[node_id]["inputs"][input_name] = value
-                logger.debug(f"Set {node_id}.inputs.{input_name} = {value}")
-        else:
-            logger.warning(f"Node {node_id} has no inputs section")
-    else:
-        logger.warning(f"Node {node_id} not found in workflow")
 
 
-def receive_sqs_messages(queue_name):
-    queue_url = get_sqs_url_by_name(queue_name)
-    if not queue_url:
-        logger.debug(f"Queue URL not found for '{queue_name}'.")
-        return
+WORKFLOW_DIR = os.path.join(os.path.dirname(__file__), "workflows")
+WORKFLOW_PARAMS = ('prompt', 'negativePrompt', 'height', 'width', 'steps', 'seed', 'cfg', 'batch_size')
 
-    response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1)
-    messages = response.get("Messages", [])
-    comfy_success = False  # Track if ComfyUI processing was successful
-    
-    for msg in messages:
-        logger.debug(f"SQS received: {msg['Body']}")
-        sqs_body_dict = json.loads(msg["Body"])
-        tti_input = TTI_input(sqs_body_dict)
-        receipt_handle = msg["ReceiptHandle"]  # Store receipt handle for later deletion
-        # Load workflow from model.json
-        try:
-            workflow_path = os.path.join(
-                os.path.dirname(__file__),
-                "workflows",
-                tti_input.model + ".json",
-            )
-            with open(workflow_path, "r") as f:
-                workflow = json.load(f)
-        except FileNotFoundError:
-            logger.error(
-                f"Workflow file not found at {workflow_path}. Please ensure it exists."
-            )
-            # Don't delete message on error, let it retry
-            continue
 
-        # Load mapping configuration for this model
-        try:
-            mapping_path = os.path.join(
-                os.path.dirname(__file__),
-                "workflows",
-                tti_input.model + ".mapping.json",
-            )
-            with open(mapping_path, "r") as f:
-                mapping = json.load(f)
-        except FileNotFoundError:
-            logger.error(
-                f"Mapping file not found at {mapping_path}. Please ensure it exists."
-            )
-            # Don't delete message on error, let it retry
-            continue
+def compile_workflow_mapping(workflow, mapping):
+    """Resolve a mapping configuration against a workflow into a flat list of setters
 
-        try:
-            # Apply TTI input parameters to workflow using mapping
-            logger.debug("Applying workflow mapping...")
-            seed = apply_workflow_mapping(workflow, tti_input, mapping)
-            prompt = {"prompt": workflow}
-            data = json.dumps(prompt).encode("utf-8")
-            logger.info(f"using prompt: {tti_input.prompt}")
-            logger.debug(f"Sending workflow to ComfyUI: {data}")
-            comfy_url = f"{COMFYUI_URL}/prompt"
-            response = requests.post(
-                comfy_url,
-                headers={"Content-Type": "application/json"},
-                data=data,
-                timeout=30  # Add timeout for ComfyUI request
-            )
-            
-            # Check if ComfyUI request was successful
-            if response.status_code != 200:
-                logger.error(f"ComfyUI request failed with status {response.status_code}: {response.text}")
-                # Don't delete message on error, let it retry
-                apply_backoff()
-                continue
-            
-            prompt_id = response.json().get("prompt_id")
-            if not prompt_id:
-                logger.error("ComfyUI response missing prompt_id")
-                # Don't delete message on error, let it retry
-                apply_backoff()
-                continue
-            
-            # Measure time for polling ComfyUI history
-            poll_start_time = time.time()
-            poll_response = poll_comfyui_history(prompt_id)
-            poll_elapsed = time.time() - poll_start_time
-            
-            # Check if polling was successful
-            if poll_response is None:
-                logger.error(f"Failed to get ComfyUI history for prompt_id: {prompt_id}")
-                # Don't delete message on error, let it retry
-                apply_backoff()
+    Each setter is a (param, node_id, input_name, is_optional, default_value)
+    tuple. Checks that only depend on the workflow's structure are done here
+    once instead of for every job.
+    """
+    setters = []
+    for param in WORKFLOW_PARAMS:
+        if param not in mapping:
+            continue
+        mapping_config = mapping[param]
+        configs = mapping_config if isinstance(mapping_config, list) else [mapping_config]
+        for config in configs:
+            node_id = config["node"]
+            input_name = config["input"]
+            is_optional = config.get("optional", False)
+            if node_id not in workflow:
+                logger.warning(f"Node {node_id} not found in workflow")
                 continue
-            
-            logger.debug(f"Poll response: {poll_response}")
-            logger.info(f"ComfyUI polling completed in {poll_elapsed:.2f} seconds")
-            
-            # Check if expected output exists
-            if "9" not in poll_response or "images" not in poll_response["9"] or not poll_response["9"]["images"]:
-                logger.error("ComfyUI output missing expected image data")
-                # Don't delete message on error, let it retry
-                apply_backoff()
+            if "inputs" not in workflow[node_id]:
+                logger.warning(f"Node {node_id} has no inputs section")
                 continue
-        
-            # Upload poll_response to S3 as JSON using the message ID
-            output_json_key = f"{tti_input.id}_output.json"
-            try:
-                s3.put_object(
-                    Bucket=S3_BUCKET,
-                    Key=output_json_key,
-                    Body=json.dumps(poll_response),
-                    ContentType='application/json'
-                )
-                logger.debug(f"Uploaded poll_response to s3://{S3_BUCKET}/{output_json_key}")
-            except Exception as e:
-                logger.error(f"Failed to upload poll_response to S3: {e}")
-                # Don't delete message on S3 error, let it retry
+            if is_optional and input_name not in workflow[node_id]["inputs"]:
                 continue
-            
-            # Upload generated image to S3
-            image_filename = poll_response["9"]["images"][0]["filename"]
-            ext = os.path.splitext(image_filename)[1][1:]
-            image_path = os.path.join(OUTPUT_FOLDER, image_filename)
-            s3_key = tti_input.id + '.' + ext
-            try:
-                s3.upload_file(image_path, S3_BUCKET, s3_key)
-                logger.debug(f"Uploaded {image_path} to s3://{S3_BUCKET}/{s3_key}")
-            except Exception as e:
-                logger.error(f"Failed to upload {image_path} to S3: {e}")
-                # Don't delete message on S3 error, let it retry
+            setters.append((param, node_id, input_name, is_optional, config.get("default")))
+    return setters
+
+
+class WorkflowTemplate:
+    """A parsed workflow with its mapping compiled into setters"""
+
+    def __init__(self, model, workflow_path, mapping_path):
+        self.model = model
+        self.workflow_path = workflow_path
+        self.mapping_path = mapping_path
+        self.mtimes = self._mtimes()
+        with open(workflow_path, "r") as f:
+            self.workflow = json.load(f)
+        with open(mapping_path, "r") as f:
+            mapping = json.load(f)
+        self.setters = compile_workflow_mapping(self.workflow, mapping)
+        self.params = {setter[0] for setter in self.setters}
+        self.mutated_nodes = sorted({setter[1] for setter in self.setters})
+
+    def _mtimes(self):
+        return (os.stat(self.workflow_path).st_mtime_ns, os.stat(self.mapping_path).st_mtime_ns)
+
+    def is_stale(self):
+        """Check whether either file changed on disk since it was loaded"""
+        try:
+            return self._mtimes() != self.mtimes
+        except FileNotFoundError:
+            return True
+
+    def instantiate(self, input_values):
+        """Return a per-job workflow, copying only the nodes the mapping writes to"""
+        workflow = dict(self.workflow)
+        for node_id in self.mutated_nodes:
+            node = dict(workflow[node_id])
+            node["inputs"] = dict(node["inputs"])
+            workflow[node_id] = node
+
+        for param, node_id, input_name, is_optional, default_value in self.setters:
+            value = input_values.get(param)
+            # Use default value if provided and current value is None
+            if value is None and default_value is not None:
+                value = default_value
+            # Skip if value is None and mapping is optional
+            if value is None and is_optional:
                 continue
+            workflow[node_id]["inputs"][input_name] = value
+        return workflow
 
-            # Upload output JSON to S3 with final metadata
-            output_json = {
-                "prompt": tti_input.prompt,
-                "width": tti_input.width,
-                "height": tti_input.height,
-                "seed": seed,
-                "s3_key": s3_key,
-                "cfg": tti_input.cfg,
-                "steps": tti_input.steps,
-                "model": tti_input.model,
-                "negativePrompt": tti_input.negativePrompt,
-                "filename": tti_input.id + "." + ext,
-                "status": "completed",
-                "timestamp": int(time.time()),
-                "elapsed": round(poll_elapsed, 2)
-            }
-            
-            final_json_key = f"{tti_input.id}_final.json"
-            try:
-                s3.put_object(
-                    Bucket=S3_BUCKET,
-                    Key=final_json_key,
-                    Body=json.dumps(output_json),
-                    ContentType='application/json'
+
+class WorkflowRegistry:
+    """Loads each model's workflow template once and reloads it when its files change"""
+
+    def __init__(self, workflow_dir):
+        self.workflow_dir = workflow_dir
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, model):
+        """Return the template for a model; raises FileNotFoundError if it has no workflow"""
+        with self.lock:
+            template = self.templates.get(model)
+            if template is None or template.is_stale():
+                if template is not None:
+                    logger.info(f"Workflow files for {model} changed, reloading template")
+                template = WorkflowTemplate(
+                    model,
+                    os.path.join(self.workflow_dir, model + ".json"),
+                    os.path.join(self.workflow_dir, model + ".mapping.json"),
                 )
-                logger.debug(f"Uploaded final metadata to s3://{S3_BUCKET}/{final_json_key}")
-            except Exception as e:
-                logger.error(f"Failed to upload final metadata to S3: {e}")
-                # Don't delete message on S3 error, let it retry
-                continue
-            
-            # Update the original request JSON with the actual seed used
-            if tti_input.seed == 0:
-                try:
-                    original_json_key = f"{tti_input.id}.json"
-                    # Read the original JSON
-                    original_response = s3.get_object(Bucket=S3_BUCKET, Key=original_json_key)
-                    original_data = json.loads(original_response['Body'].read())
-                    # Update with actual seed
-                    original_data['seed'] = seed
-                    # Write back to S3
-                    s3.put_object(
-                        Bucket=S3_BUCKET,
-                        Key=original_json_key,
-                        Body=json.dumps(original_data),
-                        ContentType='application/json'
-                    )
-                    logger.debug(f"Updated original request JSON with actual seed: {seed}")
-                except Exception as e:
-                    logger.error(f"Failed to update original request JSON with seed: {e}")
-                    # This is non-critical, don't fail the whole process
-            
-            # Only delete the SQS message after successful processing
-            logger.info(f"Successfully processed message {tti_input.id}, deleting from SQS queue")
-            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-            comfy_success = True  # Mark ComfyUI processing as successful
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error communicating with ComfyUI: {e}")
-            # Don't delete message on network error, let it retry
-            apply_backoff()
-            continue
-        except Exception as e:
-            logger.error(f"Unexpected error processing message {tti_input.id}: {e}")
-            # Don't delete message on unexpected error, let it retry
-            apply_backoff()
-            continue
-    
-    # Reset poll interval if ComfyUI processing was successful
-    if comfy_success:
-        reset_poll_interval()
+                self.templates[model] = template
+            return template
 
 
-# Response: {'prompt_id': 'a3bf9763-4cf8-4aef-9d70-36d89d9d03d5', 'number': 0, 'node_errors': {}}
+workflow_registry = WorkflowRegistry(WORKFLOW_DIR)
 
 
-def main():
-    # Initialize AWS role assumption
-    logger.info("Starting comfy-watcher...")
-    if not assume_dnd_role():
-        logger.error(f"Failed to assume {AWS_ROLE_NAME}. Exiting.")
-        sys.exit(1)
-    
-    # Schedule periodic role refresh
-    schedule_role_refresh()
-    
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "send":
-            send_sqs_message(" ".join(sys.argv[2:]) or "Hello from SQS!")
-            return
-        elif sys.argv[1] in ("recv", "receive"):
-            # Check both queues when receiving
-            receive_sqs_messages(FAST_QUEUE)
-            receive_sqs_messages(SLOW_QUEUE)
-            return
-    else:
-        while True:
-            global iteration_counter
-            iteration_counter += 1
-            
-            # Check both queues in the main loop
-            receive_sqs_messages(FAST_QUEUE)
-            receive_sqs_messages(SLOW_QUEUE)
-            
-            # Every 10 iterations, invoke the Trello Lambda function
-            if iteration_counter % 10 == 0:
-                invoke_trello_lambda()
-                logger.debug(f"Completed iteration {iteration_counter}, invoked Trello Lambda")
-            
-            time.sleep(current_poll_interval)
+class JobCounters:
+    """Jobs in flight and finished per queue, model and outcome, for the status endpoint"""
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outcomes = collections.Counter()  # (queue_name, model, outcome) -> jobs
+        self.in_flight = 0
+        self.last_success_at = None
 
-# Utility to look up SQS URL by queue name
-def get_sqs_url_by_name(queue_name):
+    def started(self, job):
+        with self.lock:
+            self.in_flight += 1
+
+    def finished(self, job, outcome):
+        """Count a job as "processed" or "failed"; only the first call for a job counts"""
+        with self.lock:
+            if job.finished:
+                return
+            job.finished = True
+            self.in_flight -= 1
+            self.outcomes[(job.queue_name, job.tti_input.model, outcome)] += 1
+            if outcome == "processed":
+                self.last_success_at = time.time()
+
+    def unparseable(self, queue_name):
+        with self.lock:
+            self.outcomes[(queue_name, "unknown", "failed")] += 1
+
+
+job_counters = JobCounters()
+
+
+# Batching: buffered jobs that differ only in their watcher-assigned seed
+# (same model, prompts, size, steps and cfg, seed 0) are rendered as one
+# prompt with batch_size up to BATCH_MAX_SIZE. The first job waits up to
+# BATCH_MAX_WAIT seconds for more to arrive. Requires prefetch mode.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "1"))  # 1 disables batching
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", "0"))
+
+
+def batch_key(tti_input):
+    """Key shared by jobs that can render in one batch, or None if the job can't be batched"""
+    # An explicit seed only reproduces an image rendered at batch index 0
+    if BATCH_MAX_SIZE <= 1 or tti_input.seed != 0:
+        return None
     try:
-        response = sqs.get_queue_url(QueueName=queue_name)
-        url = response["QueueUrl"]
-        logger.debug(f"SQS URL for '{queue_name}': {url}")
-        return url
-    except Exception as e:
-        logger.debug(f"Error getting SQS URL for '{queue_name}': {e}")
+        template = workflow_registry.get(tti_input.model)
+    except FileNotFoundError:
+        return None
+    if "batch_size" not in template.params:
         return None
+    return (tti_input.model, tti_input.prompt, tti_input.negativePrompt,
+            tti_input.width, tti_input.height, tti_input.steps, tti_input.cfg)
 
 
+def message_batch_key(msg):
+    """batch_key for a raw SQS message, or None if its body can't be parsed"""
+    try:
+        return batch_key(TTI_input(json.loads(msg["Body"])))
+    except (ValueError, AttributeError, TypeError):
+        return None
 
 
-def poll_comfyui_history(prompt_id, base_url=None) -> dict:
-    if base_url is None:
-        base_url = f"{COMFYUI_URL}/history/"
-    url = base_url + str(prompt_id)
-    delay = 1
-    for i in range(600):
-        try:
-            resp = requests.get(url, timeout=10)
-            if resp.status_code == 200:
-                try:
-                    data = resp.json()
-                except Exception:
-                    data = resp.text
-                    logger.debug(f"Error parsing JSON response: {data}")
-                if data != {}:
-                    retval = data[prompt_id]["outputs"]
-                    logger.debug(
-                        f"History for {prompt_id} received after {i+1} seconds."
-                    )
-                    return retval
-            else:
-                logger.debug(f"Non-200 response: {resp.status_code}")
-        except Exception as e:
-            logger.debug(f"Error polling history: {e}")
-        time.sleep(delay)
-        delay = min(delay * 2, 10)  # Exponential backoff, max 10 seconds
-    logger.debug(f"Timeout: No history for {prompt_id} after 600 seconds.")
-    return None
+def message_job_id(msg):
+    """Job id of a raw SQS message, or None if its body can't be parsed"""
+    try:
+        return TTI_input(json.loads(msg["Body"])).id
+    except (ValueError, AttributeError, TypeError):
+        return None
 
 
-if __name__ == "__main__":
-    try:
-        main()
-    except KeyboardInterrupt:
-        logger.info("Received interrupt signal, shutting down...")
-        # Cancel the role refresh timer
-        if role_refresh_timer:
-            role_refresh_timer.cancel()
-        sys.exit(0)
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        # Cancel the role refresh timer
-        if role_refresh_timer:
-            role_refresh_timer.cancel()
+class Job:
+    """State for a single SQS message as it moves through the watcher stages"""
+
+    def __init__(self, queue_name, queue_url, msg):
+        self.queue_name = queue_name
+        self.queue_url = queue_url
+        self.receipt_handle = msg["ReceiptHandle"]  # Store receipt handle for later deletion
+        self.message_id = msg.get("MessageId")
+        self.body = msg["Body"]
+        self.tti_input = TTI_input(json.loads(self.body))
+        self.workflow = None
+        self.seed = None
+        self.backend = None
+        self.prompt_id = None
+        self.poll_response = None
+        self.poll_elapsed = None
+        self.received_at = time.time()
+        self.submitted_at = None
+        self.model_switch = False  # whether ComfyUI had to load a different model for this job
+        self.batch = [self]  # jobs rendered together in this job's prompt, this one first
+        self.batch_index = 0
+        self.finished = False
+        self.receive_count = int(msg.get("Attributes", {}).get("ApproximateReceiveCount", "1"))
+        self.resume = None  # ledger entry of an earlier render whose publishing was interrupted
+        self.cache_key = None  # hash of the mapped workflow when its result can be reused
+        self.cached = None  # result cache entry of an identical earlier render
+        self.render_seconds = None
+
+    def add_to_batch(self, job):
+        job.batch_index = len(self.batch)
+        self.batch.append(job)
+
+
+# Redelivery. Each job's render and uploads are recorded in a SQLite ledger
+# under STATE_DIR (empty disables it). A redelivered message whose job was
+# already published is acked without rendering, and one whose publishing was
+# interrupted only uploads what is missing. Redelivered messages without a
+# ledger entry are checked against the _final.json and image in S3.
+# Submitted prompts are journaled in the same database with their messages,
+# so after a restart the watcher waits for prompts ComfyUI still has instead
+# of submitting them again.
+STATE_DIR = os.getenv("STATE_DIR", "state")
+JOB_LEDGER_RETENTION_DAYS = float(os.getenv("JOB_LEDGER_RETENTION_DAYS", "7"))
+IDEMPOTENCY_S3_CHECK = os.getenv("IDEMPOTENCY_S3_CHECK", "true").lower() == "true"
+
+
+class JobLedger:
+    """Submitted prompts and the renders and uploads of recent jobs, kept across restarts in STATE_DIR/watcher.db"""
+
+    def __init__(self, state_dir):
+        self.path = os.path.join(state_dir, "watcher.db") if state_dir else None
+        self.lock = threading.Lock()
+        self.db = None
+        self.last_prune = 0.0
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, state TEXT NOT NULL, render TEXT, "
+                "uploads TEXT NOT NULL DEFAULT '[]', updated_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS prompts (prompt_id TEXT PRIMARY KEY, backend TEXT NOT NULL, "
+                "stage TEXT NOT NULL, seed INTEGER, messages TEXT NOT NULL, submitted_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, entry TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        if time.time() - self.last_prune > 3600:
+            self.last_prune = time.time()
+            cutoff = time.time() - JOB_LEDGER_RETENTION_DAYS * 86400
+            self.db.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+            self.db.execute("DELETE FROM prompts WHERE submitted_at < ?", (cutoff,))
+            self.db.execute("DELETE FROM results WHERE updated_at < ?", (cutoff,))
+        return self.db
+
+    def get(self, job_id):
+        """The job's state ("rendered" or "published"), render and finished uploads, or None"""
+        if not self.path:
+            return None
+        with self.lock:
+            row = self._connect().execute("SELECT state, render, uploads FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        state, render, uploads = row
+        return {"state": state, "render": json.loads(render) if render else None, "uploads": set(json.loads(uploads))}
+
+    def record_render(self, job_id, render):
+        """Remember what is needed to publish a render without rendering it again"""
+        if not self.path:
+            return
+        with self.lock:
+            self._connect().execute(
+                "INSERT INTO jobs (id, state, render, uploads, updated_at) VALUES (?, 'rendered', ?, '[]', ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = 'rendered', render = excluded.render, uploads = '[]', "
+                "updated_at = excluded.updated_at",
+                (job_id, json.dumps(render), time.time()),
+            )
+
+    def record_upload(self, job_id, kind):
+        if not self.path:
+            return
+        with self.lock:
+            db = self._connect()
+            row = db.execute("SELECT uploads FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            uploads = sorted(set(json.loads(row[0])) | {kind})
+            db.execute("UPDATE jobs SET uploads = ?, updated_at = ? WHERE id = ?", (json.dumps(uploads), time.time(), job_id))
+
+    def record_published(self, job_id):
+        if not self.path:
+            return
+        with self.lock:
+            self._connect().execute(
+                "INSERT INTO jobs (id, state, updated_at) VALUES (?, 'published', ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = 'published', render = NULL, updated_at = excluded.updated_at",
+                (job_id, time.time()),
+            )
+
+
+    def record_submitted(self, job):
+        """Journal a prompt ComfyUI accepted, with the messages of every job in its batch"""
+        if not self.path:
+            return
+        messages = [
+            {"queue_name": member.queue_name, "queue_url": member.queue_url, "message_id": member.message_id,
+             "receipt_handle": member.receipt_handle, "body": member.body}
+            for member in job.batch
+        ]
+        # SQLite integers are signed; random seeds use all 64 bits
+        seed = job.seed - 2 ** 64 if job.seed is not None and job.seed >= 2 ** 63 else job.seed
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO prompts (prompt_id, backend, stage, seed, messages, submitted_at) "
+                "VALUES (?, ?, 'submitted', ?, ?, ?)",
+                (job.prompt_id, job.backend.url, seed, json.dumps(messages), job.submitted_at),
+            )
+
+    def record_prompt_stage(self, prompt_id, stage):
+        if not self.path:
+            return
+        with self.lock:
+            self._connect().execute("UPDATE prompts SET stage = ? WHERE prompt_id = ?", (stage, prompt_id))
+
+    def remove_prompt(self, prompt_id):
+        """Forget a prompt once its jobs are published or given up on"""
+        if not self.path or not prompt_id:
+            return
+        with self.lock:
+            self._connect().execute("DELETE FROM prompts WHERE prompt_id = ?", (prompt_id,))
+
+    def prompts(self):
+        """Journaled prompts, oldest first"""
+        if not self.path:
+            return []
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT prompt_id, backend, stage, seed, messages, submitted_at FROM prompts ORDER BY submitted_at"
+            ).fetchall()
+        return [
+            {"prompt_id": prompt_id, "backend": backend, "stage": stage,
+             "seed": seed + 2 ** 64 if seed is not None and seed < 0 else seed,
+             "messages": json.loads(messages), "submitted_at": submitted_at}
+            for prompt_id, backend, stage, seed, messages, submitted_at in rows
+        ]
+
+    def get_result(self, key):
+        """Local copy of a result cache entry, or None"""
+        if not self.path:
+            return None
+        with self.lock:
+            row = self._connect().execute("SELECT entry FROM results WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_result(self, key, entry):
+        if not self.path:
+            return
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO results (key, entry, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(entry), time.time()),
+            )
+
+    def forget_result(self, key):
+        if not self.path:
+            return
+        with self.lock:
+            self._connect().execute("DELETE FROM results WHERE key = ?", (key,))
+
+
+job_ledger = JobLedger(STATE_DIR)
+recovered_jobs = {}  # job id -> job recovered from the journal at startup
+
+
+def published_in_s3(job_id):
+    """Whether the job's _final.json and the image it names are both in S3"""
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=f"{job_id}_final.json")
+        final = json.loads(response["Body"].read())
+        s3.head_object(Bucket=S3_BUCKET, Key=final["s3_key"])
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404", "NotFound"):
+            logger.warning(f"Could not check S3 for earlier results of {job_id}: {e}")
+        return False
+    except Exception as e:
+        # Rendering again is safe, only slower
+        logger.warning(f"Could not check S3 for earlier results of {job_id}: {e}")
+        return False
+
+
+def check_redelivery(job):
+    """Ack a job that was already published and return False, or set up resuming an interrupted publish"""
+    job_id = job.tti_input.id
+    recovered = recovered_jobs.get(job_id)
+    if recovered is not None and recovered is not job and not recovered.finished:
+        # The message became visible again while its recovered job was still in flight
+        logger.info(f"Job {job_id} is still in flight since the restart, taking over its redelivered message")
+        visibility_heartbeat.untrack(recovered.receipt_handle)
+        recovered.receipt_handle = job.receipt_handle
+        job_counters.finished(job, "duplicate")
+        return False
+
+    entry = job_ledger.get(job_id)
+    published = entry is not None and entry["state"] == "published"
+    if not published and entry is None and job.receive_count > 1 and IDEMPOTENCY_S3_CHECK:
+        published = published_in_s3(job_id)
+        if published:
+            job_ledger.record_published(job_id)
+    if published:
+        logger.info(f"Job {job_id} was already published, deleting redelivered message without rendering")
+        get_queue_handle(job.queue_name).ack(job.receipt_handle)
+        job_counters.finished(job, "duplicate")
+        return False
+
+    if entry is not None and entry["render"]:
+        render = entry["render"]
+        image_path = os.path.join(OUTPUT_FOLDER, render["image"]["filename"])
+        if "image" in entry["uploads"] or (IMAGE_TRANSFER_MODE == "file" and os.path.exists(image_path)):
+            job.resume = dict(render, uploads=entry["uploads"])
+            job.seed = render["metadata"]["seed"]
+            job.poll_response = render["poll_response"]
+            job.poll_elapsed = render["metadata"]["elapsed"]
+            missing = {"output_json", "image", "final_json"} - entry["uploads"]
+            logger.info(f"Resuming publishing of {job_id}, uploading {', '.join(sorted(missing)) or 'nothing'}")
+    return True
+
+
+def create_job(queue_name, queue_url, msg):
+    """Build a Job from a received SQS message, or None if the body cannot be parsed"""
+    logger.debug(f"SQS received: {msg['Body']}")
+    try:
+        job = Job(queue_name, queue_url, msg)
+    except (ValueError, AttributeError, TypeError) as e:
+        logger.error(f"Failed to parse SQS message {msg.get('MessageId')}: {e}")
+        # Don't delete message on error, let it retry
+        visibility_heartbeat.untrack(msg["ReceiptHandle"])
+        job_counters.unparseable(queue_name)
+        return None
+    job_counters.started(job)
+    if not check_redelivery(job):
+        return None
+    if not job.resume:
+        check_result_cache(job)
+    return job
+
+
+def recover_jobs():
+    """Rebuild the jobs of journaled prompts, reattached to the prompts their ComfyUI backend still has"""
+    jobs = []
+    for entry in job_ledger.prompts():
+        prompt_id = entry["prompt_id"]
+        members = []
+        for message in entry["messages"]:
+            msg = {"ReceiptHandle": message["receipt_handle"], "Body": message["body"],
+                   "MessageId": message["message_id"]}
+            member = Job(message["queue_name"], message["queue_url"], msg)
+            # The message may have been received again after this handle was issued, then the heartbeat drops it
+            visibility_heartbeat.track(member.queue_url, member.receipt_handle)
+            job_counters.started(member)
+            if check_redelivery(member):
+                members.append(member)
+                recovered_jobs[member.tti_input.id] = member
+        ids = ", ".join(member.tti_input.id for member in members)
+
+        if members and members[0].resume:
+            # Publishing had started, so every job's render is in the ledger
+            jobs.extend(members)
+            job_ledger.remove_prompt(prompt_id)
+            continue
+        if len(members) < len(entry["messages"]):
+            # Some were published but the rest have no render to resume from
+            job_ledger.remove_prompt(prompt_id)
+            jobs.extend(members)
+            continue
+
+        job = members[0]
+        for member in members[1:]:
+            job.add_to_batch(member)
+        backend = next((b for b in backend_pool.backends if b.url == entry["backend"]), None)
+        try:
+            reattach = backend is not None and backend.has_prompt(prompt_id)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"Could not look up prompt {prompt_id} on {entry['backend']}: {e}")
+            reattach = False
+        if not reattach:
+            logger.info(f"Prompt {prompt_id} is no longer on {entry['backend']}, rendering {ids} again")
+            job_ledger.remove_prompt(prompt_id)
+            jobs.append(job)
+            continue
+
+        job.backend = backend
+        job.prompt_id = prompt_id
+        job.seed = entry["seed"]
+        job.submitted_at = entry["submitted_at"]
+        with backend.lock:
+            backend.in_flight.add(job)
+        logger.info(f"Reattached to prompt {prompt_id} ({entry['stage']}) on {backend.url} for {ids}")
+        jobs.append(job)
+
+    if jobs:
+        # Journaled receipt handles may be close to their visibility timeout
+        try:
+            visibility_heartbeat.extend_all()
+        except Exception as e:
+            logger.error(f"Failed to extend SQS message visibility: {e}")
+    return jobs
+
+
+def prepare_job(job):
+    """Load the model workflow and mapping and apply the job's parameters"""
+    tti_input = job.tti_input
+    prepare_start = time.time()
+    try:
+        template = workflow_registry.get(tti_input.model)
+    except FileNotFoundError as e:
+        logger.error(f"Workflow file not found for model {tti_input.model}: {e}. Please ensure it exists.")
+        # Don't delete message on error, let it retry
+        return False
+
+    # A batch is one prompt with one seed, chosen for its first job; ComfyUI
+    # varies the images by their index in the batch
+    job.seed = choose_seed(tti_input)
+    job.workflow = template.instantiate(build_input_values(tti_input, job.seed, len(job.batch)))
+    if len(job.batch) > 1:
+        logger.info(f"Batching {len(job.batch)} jobs into one prompt: {', '.join(m.tti_input.id for m in job.batch)}")
+    logger.debug(f"Prepared {tti_input.model} workflow for {tti_input.id} ({len(template.setters)} inputs set)")
+    stage_latency["prepare"].record(time.time() - prepare_start)
+    return True
+
+
+def submit_job(job):
+    """Submit the prepared workflow to the least loaded ComfyUI backend and record the prompt_id"""
+    job.backend = backend_pool.acquire(job)
+    if job.backend is None:
+        # Don't delete message when no backend is available, let it retry
+        breakers["comfyui"].record_failure("no healthy backend")
+        return False
+
+    prompt = {"prompt": job.workflow, "client_id": COMFYUI_CLIENT_ID}
+    data = json.dumps(prompt).encode("utf-8")
+    logger.info(f"using prompt: {job.tti_input.prompt}")
+    logger.debug(f"Sending workflow to ComfyUI at {job.backend.url}: {data}")
+    comfy_url = f"{job.backend.url}/prompt"
+    submit_start = time.time()
+    response = requests.post(
+        comfy_url,
+        headers={"Content-Type": "application/json"},
+        data=data,
+        timeout=30  # Add timeout for ComfyUI request
+    )
+    stage_latency["submit"].record(time.time() - submit_start)
+    return accept_prompt_response(job, response.status_code, response.text)
+
+
+def accept_prompt_response(job, status_code, text):
+    """Record the prompt_id from ComfyUI's /prompt response, or log why it was rejected"""
+    # Check if ComfyUI request was successful
+    if status_code != 200:
+        logger.error(f"ComfyUI request failed with status {status_code}: {text}")
+        # A 400 is a problem with the workflow, anything else with the backend
+        if status_code != 400:
+            backend_pool.record_failure(job.backend)
+        # Don't delete message on error, let it retry
+        return False
+
+    job.prompt_id = json.loads(text).get("prompt_id")
+    if not job.prompt_id:
+        logger.error("ComfyUI response missing prompt_id")
+        backend_pool.record_failure(job.backend)
+        # Don't delete message on error, let it retry
+        return False
+    backend_pool.record_submit(job)
+    job_ledger.record_submitted(job)
+    return True
+
+
+def await_job(job):
+    """Wait for ComfyUI to finish the job's prompt and check its outputs"""
+    # Measure time for polling ComfyUI history
+    poll_start_time = time.time()
+    poll_response = wait_for_comfyui_prompt(job.prompt_id, job.backend)
+    job.poll_elapsed = time.time() - poll_start_time
+    backend_pool.release(job)
+    return accept_history(job, poll_response)
+
+
+def accept_history(job, poll_response):
+    """Check a finished prompt's outputs and keep them on the job"""
+    # Check if polling was successful
+    if poll_response is None:
+        logger.error(f"Failed to get ComfyUI history for prompt_id: {job.prompt_id} from {job.backend.url}")
+        backend_pool.record_failure(job.backend)
+        # Don't delete message on error, let it retry
+        return False
+
+    logger.debug(f"Poll response: {poll_response}")
+    logger.info(f"ComfyUI polling completed in {job.poll_elapsed:.2f} seconds")
+
+    # Check if expected output exists
+    if "9" not in poll_response or len(poll_response["9"].get("images", [])) < len(job.batch):
+        # The prompt failed in ComfyUI, which says nothing about the backend
+        logger.error("ComfyUI output missing expected image data")
+        # Don't delete message on error, let it retry
+        return False
+
+    backend_pool.record_success(job)
+    job.poll_response = poll_response
+    job_ledger.record_prompt_stage(job.prompt_id, "rendered")
+    return True
+
+
+# S3 publishing. A job's output JSON, image and final metadata are written
+# concurrently on a shared pool; large images use multipart transfers.
+S3_PUBLISH_CONCURRENCY = int(os.getenv("S3_PUBLISH_CONCURRENCY", "8"))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+S3_MULTIPART_THRESHOLD_MB = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8"))
+S3_MULTIPART_CHUNKSIZE_MB = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", "8"))
+S3_TRANSFER_CONCURRENCY = int(os.getenv("S3_TRANSFER_CONCURRENCY", "4"))
+# Parts buffered in memory while streaming an image that is not on local disk
+S3_STREAM_BUFFER_CHUNKS = int(os.getenv("S3_STREAM_BUFFER_CHUNKS", "4"))
+
+# How rendered images reach S3: "file" reads them from OUTPUT_FOLDER on a
+# volume shared with ComfyUI, "stream" pipes ComfyUI's /view response into S3.
+IMAGE_TRANSFER_MODE = os.getenv("IMAGE_TRANSFER_MODE", "file")
+
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
+)
+# Not exposed by boto3's TransferConfig constructor, but honoured by s3transfer
+s3_transfer_config.max_in_memory_upload_chunks = S3_STREAM_BUFFER_CHUNKS
+
+
+class S3Publisher:
+    """Runs S3 writes on a shared thread pool and records per-object latency"""
+
+    def __init__(self, max_workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="s3-publish")
+        self.publish_stats = stage_latency["publish"]
+        self.end_to_end_stats = stage_latency["end_to_end"]
+        self.last_report = time.time()
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Run fn on the pool, timing it under the given object kind"""
+        return self.executor.submit(self._timed, kind, fn, args, kwargs)
+
+    def _timed(self, kind, fn, args, kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stage_latency["s3_" + kind].record(time.time() - start)
+
+    def record_job(self, publish_elapsed, end_to_end):
+        self.publish_stats.record(publish_elapsed)
+        self.end_to_end_stats.record(end_to_end)
+        if time.time() - self.last_report >= STATS_REPORT_INTERVAL:
+            self.last_report = time.time()
+            self.report()
+
+    def report(self):
+        """Log per-object S3 latency and the S3 share of end-to-end job time"""
+        for stage, stats in sorted(stage_latency.items()):
+            if not stage.startswith("s3_"):
+                continue
+            kind = stage[len("s3_"):]
+            summary = stats.summary()
+            logger.info(f"S3 {kind}: {summary['count']} writes, p50 {summary['p50']:.2f}s, p95 {summary['p95']:.2f}s")
+        if self.end_to_end_stats.total:
+            share = self.publish_stats.total / self.end_to_end_stats.total
+            logger.info(f"S3 publishing is {share:.0%} of end-to-end job time")
+
+
+s3_publisher = S3Publisher(S3_PUBLISH_CONCURRENCY)
+
+
+# Watcher metrics are written to {METRICS_HOSTNAME}-watcher.json in the
+# metrics bucket, next to the {hostname}.json host metrics and list.json.
+METRICS_BUCKET = os.getenv("METRICS_BUCKET")
+METRICS_HOSTNAME = os.getenv("METRICS_HOSTNAME") or socket.gethostname()
+METRICS_PUBLISH_INTERVAL = int(os.getenv("METRICS_PUBLISH_INTERVAL", "30"))
+
+
+class MetricsPublisher:
+    """Periodically publishes the stage latency histograms to the metrics bucket"""
+
+    def __init__(self, bucket, hostname):
+        self.bucket = bucket
+        self.key = f"{hostname}-watcher.json"
+        self.hostname = hostname
+        self.last_counts = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+        thread.start()
+        logger.info(f"Publishing watcher metrics to s3://{self.bucket}/{self.key} every {METRICS_PUBLISH_INTERVAL}s")
+
+    def document(self):
+        return {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat() + "Z",
+            "hostname": self.hostname,
+            "stages": {stage: stats.snapshot() for stage, stats in sorted(stage_latency.items())},
+        }
+
+    def publish(self):
+        """Write the metrics document unless no stage has recorded anything since the last write"""
+        counts = {stage: stats.count for stage, stats in list(stage_latency.items())}
+        if counts == self.last_counts:
+            return
+        s3.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(self.document()),
+            ContentType='application/json'
+        )
+        self.last_counts = counts
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_PUBLISH_INTERVAL)
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Failed to publish watcher metrics to s3://{self.bucket}/{self.key}: {e}")
+
+
+def put_json_object(key, data):
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=key,
+        Body=json.dumps(data),
+        ContentType='application/json'
+    )
+
+
+def update_request_seed(job_id, seed, batch_index=0, batch_size=1):
+    """Update the original request JSON with the actual seed used"""
+    try:
+        original_json_key = f"{job_id}.json"
+        # Read the original JSON
+        original_response = s3.get_object(Bucket=S3_BUCKET, Key=original_json_key)
+        original_data = json.loads(original_response['Body'].read())
+        # Update with actual seed
+        original_data['seed'] = seed
+        if batch_size > 1:
+            # The seed alone reproduces the first image of the batch only
+            original_data['batch_index'] = batch_index
+            original_data['batch_size'] = batch_size
+        # Write back to S3
+        put_json_object(original_json_key, original_data)
+        logger.debug(f"Updated original request JSON with actual seed: {seed}")
+    except Exception as e:
+        logger.error(f"Failed to update original request JSON with seed: {e}")
+        # This is non-critical, don't fail the whole process
+
+
+def stream_image_to_s3(image, s3_key, base_url=None):
+    """Stream an output image from ComfyUI's /view endpoint into a (multipart) S3 upload"""
+    if base_url is None:
+        base_url = COMFYUI_URLS[0]
+    params = {
+        "filename": image["filename"],
+        "subfolder": image.get("subfolder", ""),
+        "type": image.get("type", "output"),
+    }
+    with requests.get(f"{base_url}/view", params=params, stream=True, timeout=30) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        extra_args = {}
+        if resp.headers.get("Content-Type"):
+            extra_args["ContentType"] = resp.headers["Content-Type"]
+        s3.upload_fileobj(resp.raw, S3_BUCKET, s3_key, ExtraArgs=extra_args, Config=s3_transfer_config)
+
+
+def upload_output_image(image, s3_key, base_url=None):
+    """Copy a rendered image to S3 using the configured IMAGE_TRANSFER_MODE"""
+    if IMAGE_TRANSFER_MODE == "stream":
+        stream_image_to_s3(image, s3_key, base_url)
+    else:
+        image_path = os.path.join(OUTPUT_FOLDER, image["filename"])
+        s3.upload_file(image_path, S3_BUCKET, s3_key, Config=s3_transfer_config)
+
+
+# Result cache. A job with an explicit seed whose fully mapped workflow is
+# identical to an earlier job's renders the same image, so it is published by
+# copying that job's image and output JSON within S3 instead of rendering.
+# Entries are keyed by the SHA-256 of the canonical workflow JSON and stored
+# in the ledger database and under RESULT_CACHE_PREFIX in S3, which all
+# watchers share.
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "cache/")
+
+
+def result_cache_key(tti_input):
+    """SHA-256 of the job's fully mapped workflow, or None if its result can't be reused"""
+    # Seeds assigned by the watcher differ from job to job
+    if not RESULT_CACHE_ENABLED or tti_input.seed == 0:
+        return None
+    try:
+        template = workflow_registry.get(tti_input.model)
+    except FileNotFoundError:
+        return None
+    workflow = template.instantiate(build_input_values(tti_input, tti_input.seed))
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def s3_object_missing(e):
+    return isinstance(e, ClientError) and e.response["Error"]["Code"] in ("NoSuchKey", "404", "NotFound")
+
+
+class ResultCache:
+    """Published renders by workflow hash, with hit counts for the status endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def lookup(self, key):
+        """The entry of an earlier render whose image is still in S3, or None"""
+        entry = job_ledger.get_result(key)
+        if entry is None:
+            try:
+                response = s3.get_object(Bucket=S3_BUCKET, Key=f"{RESULT_CACHE_PREFIX}{key}.json")
+                entry = json.loads(response["Body"].read())
+            except Exception as e:
+                if not s3_object_missing(e):
+                    logger.warning(f"Could not read result cache entry {key}: {e}")
+        if entry is not None:
+            try:
+                s3.head_object(Bucket=S3_BUCKET, Key=entry["s3_key"])
+                job_ledger.record_result(key, entry)
+            except Exception as e:
+                if s3_object_missing(e):
+                    logger.info(f"Cached render {entry['s3_key']} was deleted, rendering again")
+                    self.forget(key)
+                else:
+                    logger.warning(f"Could not check cached render {entry['s3_key']}: {e}")
+                entry = None
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+        return entry
+
+    def record(self, key, job, s3_key):
+        """Index a published render so later identical jobs can copy it"""
+        entry = {
+            "job_id": job.tti_input.id,
+            "s3_key": s3_key,
+            "render_seconds": round(job.render_seconds if job.render_seconds is not None else job.poll_elapsed, 2),
+            "created_at": int(time.time()),
+        }
+        job_ledger.record_result(key, entry)
+        s3_publisher.submit("cache_index", put_json_object, f"{RESULT_CACHE_PREFIX}{key}.json", entry)
+
+    def forget(self, key):
+        job_ledger.forget_result(key)
+        try:
+            s3.delete_object(Bucket=S3_BUCKET, Key=f"{RESULT_CACHE_PREFIX}{key}.json")
+        except Exception as e:
+            logger.warning(f"Could not delete result cache entry {key}: {e}")
+
+    def record_hit(self, entry):
+        with self.lock:
+            self.hits += 1
+            self.saved_seconds += entry["render_seconds"]
+            hits, lookups, saved = self.hits, self.hits + self.misses, self.saved_seconds
+        logger.info(f"Result cache: {hits} of {lookups} lookups hit ({hits / lookups:.0%}), {saved:.0f}s of rendering saved")
+
+
+result_cache = ResultCache()
+
+
+def check_result_cache(job):
+    """Set up publishing a job with an explicit seed from an identical earlier render"""
+    try:
+        job.cache_key = result_cache_key(job.tti_input)
+        if job.cache_key is None:
+            return
+        entry = result_cache.lookup(job.cache_key)
+    except Exception as e:
+        # Rendering is always possible, so cache problems only cost time
+        logger.warning(f"Result cache lookup failed for {job.tti_input.id}: {e}")
+        return
+    # A job's own earlier render is handled by redelivery
+    if entry is None or entry["job_id"] == job.tti_input.id:
+        return
+    job.cached = entry
+    job.seed = job.tti_input.seed
+    job.poll_elapsed = 0.0
+    logger.info(f"Result cache hit for {job.tti_input.id}: copying the render of {entry['job_id']} instead of rendering")
+
+
+def copy_s3_object(source_key, key):
+    s3.copy_object(Bucket=S3_BUCKET, Key=key, CopySource={"Bucket": S3_BUCKET, "Key": source_key})
+
+
+def publish_cached(job):
+    """Publish a job by copying an identical earlier render within S3, then delete its SQS message"""
+    publish_start = time.time()
+    entry = job.cached
+    tti_input = job.tti_input
+    metadata = final_metadata(job, job, {"filename": entry["s3_key"]})
+    metadata["cached_from"] = entry["job_id"]
+    source_output_key = f"{entry['job_id']}_output.json"
+    output_json_key = f"{tti_input.id}_output.json"
+    final_json_key = f"{tti_input.id}_final.json"
+    writes = [
+        ("output_json_copy", f"s3://{S3_BUCKET}/{source_output_key} to {output_json_key}",
+         copy_s3_object, (source_output_key, output_json_key)),
+        ("image_copy", f"s3://{S3_BUCKET}/{entry['s3_key']} to {metadata['s3_key']}",
+         copy_s3_object, (entry["s3_key"], metadata["s3_key"])),
+        ("final_json", f"final metadata to s3://{S3_BUCKET}/{final_json_key}",
+         put_json_object, (final_json_key, metadata)),
+    ]
+    started = [(kind, description, s3_publisher.submit(kind, fn, *args)) for kind, description, fn, args in writes]
+    if finish_publish(job, job, metadata, started, publish_start):
+        result_cache.record_hit(entry)
+        return True
+    # The earlier render may be gone, so the retry renders this job
+    result_cache.forget(job.cache_key)
+    return False
+
+
+def final_metadata(job, member, image):
+    """The _final.json written for one job of a (possibly batched) render"""
+    tti_input = member.tti_input
+    ext = os.path.splitext(image["filename"])[1][1:]
+    metadata = {
+        "prompt": tti_input.prompt,
+        "width": tti_input.width,
+        "height": tti_input.height,
+        "seed": job.seed,
+        "s3_key": tti_input.id + '.' + ext,
+        "cfg": tti_input.cfg,
+        "steps": tti_input.steps,
+        "model": tti_input.model,
+        "negativePrompt": tti_input.negativePrompt,
+        "filename": tti_input.id + "." + ext,
+        "status": "completed",
+        "timestamp": int(time.time()),
+        "elapsed": round(job.poll_elapsed, 2)
+    }
+    if len(job.batch) > 1:
+        # The image is reproduced by the seed together with its place in the batch
+        metadata["batch_index"] = member.batch_index
+        metadata["batch_size"] = len(job.batch)
+    return metadata
+
+
+def start_publish(job, member, image, metadata):
+    """Start the S3 writes not yet done for one job; return (kind, description, future) tuples"""
+    tti_input = member.tti_input
+    s3_key = metadata["s3_key"]
+    uploaded = job.resume["uploads"] if job.resume else set()
+
+    # The poll_response, image and final metadata are independent writes
+    output_json_key = f"{tti_input.id}_output.json"
+    final_json_key = f"{tti_input.id}_final.json"
+    base_url = job.backend.url if job.backend else None
+    writes = [
+        ("output_json", f"poll_response to s3://{S3_BUCKET}/{output_json_key}",
+         put_json_object, (output_json_key, job.poll_response)),
+        ("image", f"{image['filename']} to s3://{S3_BUCKET}/{s3_key}",
+         upload_output_image, (image, s3_key, base_url)),
+        ("final_json", f"final metadata to s3://{S3_BUCKET}/{final_json_key}",
+         put_json_object, (final_json_key, metadata)),
+    ]
+    return [(kind, description, s3_publisher.submit(kind, fn, *args))
+            for kind, description, fn, args in writes if kind not in uploaded]
+
+
+def record_publish_failure(e):
+    """Count a failed S3 write against the dependency at fault, if it isn't the job's own files"""
+    if isinstance(e, requests.exceptions.RequestException):
+        # Streaming the image from ComfyUI's /view
+        breakers["comfyui"].record_failure(type(e).__name__)
+    elif isinstance(e, OSError) or s3_object_missing(e):
+        # A missing local image or copy source only affects this job
+        return
+    else:
+        breakers["s3"].record_failure(type(e).__name__)
+
+
+def finish_publish(job, member, metadata, writes, publish_start):
+    """Wait for one job's S3 writes, then delete its SQS message"""
+    tti_input = member.tti_input
+    uploaded = True
+    for kind, description, future in writes:
+        try:
+            future.result()
+            logger.debug(f"Uploaded {description}")
+            job_ledger.record_upload(tti_input.id, kind)
+        except Exception as e:
+            logger.error(f"Failed to upload {description}: {e}")
+            record_publish_failure(e)
+            uploaded = False
+    if not uploaded:
+        # Don't delete message on S3 error, let it retry
+        return False
+    breakers["s3"].record_success()
+
+    # The seed patch only makes sense once the image it describes exists. The batch
+    # placement comes from the metadata, as a resumed batch member is a job of its own
+    if seed_needs_writeback(tti_input):
+        s3_publisher.submit("seed_patch", update_request_seed, tti_input.id, job.seed,
+                            metadata.get("batch_index", 0), metadata.get("batch_size", 1))
+
+    publish_elapsed = time.time() - publish_start
+    end_to_end = time.time() - member.received_at
+    s3_publisher.record_job(publish_elapsed, end_to_end)
+
+    # Only delete the SQS message after successful processing
+    logger.info(
+        f"Successfully processed message {tti_input.id} (S3 {publish_elapsed:.2f}s of "
+        f"{end_to_end:.2f}s end-to-end), deleting from SQS queue"
+    )
+    job_ledger.record_published(tti_input.id)
+    get_queue_handle(member.queue_name).ack(member.receipt_handle)
+    job_counters.finished(member, "processed")
+    return True
+
+
+def publish_job(job):
+    """Upload the outputs and metadata of every job in the batch to S3, then delete their SQS messages"""
+    if job.cached:
+        return publish_cached(job)
+    publish_start = time.time()
+    if job.resume:
+        rendered = [(job, job.resume["image"], job.resume["metadata"])]
+    else:
+        rendered = []
+        for member, image in zip(job.batch, job.poll_response["9"]["images"]):
+            metadata = final_metadata(job, member, image)
+            # Lets a redelivery of the message publish this render instead of rendering again
+            job_ledger.record_render(member.tti_input.id, {
+                "image": image, "poll_response": job.poll_response, "metadata": metadata,
+            })
+            rendered.append((member, image, metadata))
+    pending = [(member, metadata, start_publish(job, member, image, metadata)) for member, image, metadata in rendered]
+    published = True
+    for member, metadata, writes in pending:
+        if not finish_publish(job, member, metadata, writes, publish_start):
+            published = False
+    if published:
+        job_ledger.remove_prompt(job.prompt_id)
+        if job.cache_key:
+            result_cache.record(job.cache_key, job, rendered[0][2]["s3_key"])
+    return published
+
+def record_comfyui_failure(job, e):
+    if job.backend:
+        backend_pool.record_failure(job.backend)
+    else:
+        breakers["comfyui"].record_failure(f"{type(e).__name__}")
+
+
+def record_unexpected_failure(e):
+    """Count an unexpected job stage error against S3 if boto raised it; anything else is the job's"""
+    # Job stages only talk to AWS to publish to S3
+    if isinstance(e, (ClientError, BotoCoreError)) and not s3_object_missing(e):
+        breakers["s3"].record_failure(type(e).__name__)
+
+
+def run_job_stage(stage, job):
+    """Run a single stage for a job, backing off on ComfyUI and unexpected errors"""
+    note_progress()
+    try:
+        return stage(job)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Network error communicating with ComfyUI: {e}")
+        record_comfyui_failure(job, e)
+        # Don't delete message on network error, let it retry
+        return False
+    except Exception as e:
+        logger.error(f"Unexpected error processing message {job.tti_input.id}: {e}")
+        record_unexpected_failure(e)
+        # Don't delete message on unexpected error, let it retry
+        return False
+    finally:
+        note_progress()
+
+
+JOB_STAGES = (prepare_job, submit_job, await_job, publish_job)
+
+
+def process_job(job):
+    """Run every stage for a job in sequence, stopping at the first failure"""
+    # A resumed job was rendered before its message was redelivered, a cached one by an earlier job
+    if job.resume or job.cached:
+        stages = (publish_job,)
+    # A reattached job's prompt was submitted before the watcher restarted
+    elif job.prompt_id:
+        stages = (await_job, publish_job)
+    else:
+        stages = JOB_STAGES
+    for stage in stages:
+        if not run_job_stage(stage, job):
+            release_job(job)
+            return False
+    return True
+
+
+# Model affinity: ComfyUI runs with --disable-smart-memory, so each change of
+# model reloads multi-GB checkpoints. Within the first MODEL_AFFINITY_WINDOW
+# buffered messages of the chosen queue, a job for a model some backend has
+# loaded goes ahead of older jobs, unless the oldest has been buffered for
+# MODEL_AFFINITY_MAX_DELAY seconds.
+MODEL_AFFINITY_WINDOW = int(os.getenv("MODEL_AFFINITY_WINDOW", "1"))  # 1 keeps arrival order
+MODEL_AFFINITY_MAX_DELAY = float(os.getenv("MODEL_AFFINITY_MAX_DELAY", "120"))
+
+
+# SQS receive configuration. In "prefetch" mode a background thread per queue
+# long-polls for up to SQS_MAX_MESSAGES at a time and keeps up to
+# SQS_PREFETCH_LIMIT messages buffered locally. "single" receives one message
+# per loop iteration without waiting. Buffered messages are invisible to other
+# workers, so by default a queue buffers only one job more than the backends
+# can render at once (or a full batch when batching, or the whole affinity
+# window, which can only reorder messages that are buffered).
+SQS_RECEIVE_MODE = os.getenv("SQS_RECEIVE_MODE", "prefetch")
+SQS_WAIT_TIME_SECONDS = int(os.getenv("SQS_WAIT_TIME_SECONDS", "20"))
+SQS_MAX_MESSAGES = int(os.getenv("SQS_MAX_MESSAGES", "10"))
+SQS_PREFETCH_LIMIT = int(os.getenv("SQS_PREFETCH_LIMIT", str(max(1 + len(COMFYUI_URLS), BATCH_MAX_SIZE, MODEL_AFFINITY_WINDOW))))
+SQS_VISIBILITY_TIMEOUT = int(os.getenv("SQS_VISIBILITY_TIMEOUT", "300"))
+SQS_HEARTBEAT_INTERVAL = int(os.getenv("SQS_HEARTBEAT_INTERVAL", "60"))
+
+
+class VisibilityHeartbeat:
+    """Keeps messages held by this watcher invisible to other workers until released
+
+    The same thread flushes acknowledgements that have waited SQS_ACK_MAX_DELAY.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {}  # receipt_handle -> queue_url
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="sqs-heartbeat", daemon=True)
+        thread.start()
+
+    def track(self, queue_url, receipt_handle):
+        with self.lock:
+            self.messages[receipt_handle] = queue_url
+
+    def untrack(self, receipt_handle):
+        with self.lock:
+            self.messages.pop(receipt_handle, None)
+
+    def _run(self):
+        last_extended = time.time()
+        while True:
+            time.sleep(1)
+            flush_queue_acks(due_only=True)
+            if time.time() - last_extended < SQS_HEARTBEAT_INTERVAL:
+                continue
+            last_extended = time.time()
+            try:
+                self.extend_all()
+            except Exception as e:
+                logger.error(f"Failed to extend SQS message visibility: {e}")
+                breakers["sqs"].record_failure(type(e).__name__)
+
+    def extend_all(self):
+        """Push the visibility timeout of every held message SQS_VISIBILITY_TIMEOUT into the future"""
+        self._change_visibility(self._held(), SQS_VISIBILITY_TIMEOUT)
+
+    def hand_back(self, receipt_handles=None):
+        """Make held messages (by default all of them) visible to other workers right away"""
+        held = self._held(receipt_handles)
+        with self.lock:
+            for handles in held.values():
+                for receipt_handle in handles:
+                    self.messages.pop(receipt_handle, None)
+        self._change_visibility(held, 0)
+        return sum(len(handles) for handles in held.values())
+
+    def _held(self, receipt_handles=None):
+        """Held receipt handles grouped by queue URL, optionally limited to the given ones"""
+        by_queue = {}
+        with self.lock:
+            for receipt_handle, queue_url in self.messages.items():
+                if receipt_handles is None or receipt_handle in receipt_handles:
+                    by_queue.setdefault(queue_url, []).append(receipt_handle)
+        return by_queue
+
+    def _change_visibility(self, by_queue, timeout):
+        for queue_url, receipt_handles in by_queue.items():
+            for start in range(0, len(receipt_handles), 10):
+                chunk = receipt_handles[start:start + 10]
+                response = sqs.change_message_visibility_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {"Id": str(i), "ReceiptHandle": receipt_handle, "VisibilityTimeout": timeout}
+                        for i, receipt_handle in enumerate(chunk)
+                    ],
+                )
+                for failure in response.get("Failed", []):
+                    # The handle expired or the message was already deleted
+                    logger.warning(f"Could not set visibility of message to {timeout}s: {failure.get('Message')}")
+                    self.untrack(chunk[int(failure["Id"])])
+            logger.debug(f"Set visibility of {len(receipt_handles)} messages on {queue_url} to {timeout}s")
+
+
+visibility_heartbeat = VisibilityHeartbeat()
+
+
+def receive_messages(queue_url, max_messages, wait_time_seconds):
+    """Receive messages from a queue and keep them invisible while this watcher holds them"""
+    receive_start = time.time()
+    try:
+        response = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_time_seconds,
+            VisibilityTimeout=SQS_VISIBILITY_TIMEOUT,
+            AttributeNames=["SentTimestamp", "ApproximateReceiveCount"],
+        )
+    except Exception as e:
+        breakers["sqs"].record_failure(type(e).__name__)
+        raise
+    breakers["sqs"].record_success()
+    messages = response.get("Messages", [])
+    if messages:
+        # Empty long polls only measure how long the queue was idle
+        stage_latency["sqs_receive"].record(time.time() - receive_start)
+    for msg in messages:
+        visibility_heartbeat.track(queue_url, msg["ReceiptHandle"])
+    return messages
+
+
+def hand_back_job(job):
+    """Return a job that was never started to SQS so another worker can take it immediately"""
+    for member in job.batch:
+        job_counters.finished(member, "returned")
+    visibility_heartbeat.hand_back({member.receipt_handle for member in job.batch})
+    backend_pool.release(job)
+    job_ledger.remove_prompt(job.prompt_id)
+
+
+def release_job(job):
+    """Stop extending a failed job's message visibility so it is retried after the timeout"""
+    for member in job.batch:
+        visibility_heartbeat.untrack(member.receipt_handle)
+        job_counters.finished(member, "failed")
+    backend_pool.release(job)
+    job_ledger.remove_prompt(job.prompt_id)
+
+
+class QueuePrefetcher:
+    """Long-polls one SQS queue in the background and buffers its messages locally"""
+
+    def __init__(self, queue_name, work_available):
+        self.queue_name = queue_name
+        self.work_available = work_available
+        self.buffer = collections.deque()  # (queue_url, msg, received_at)
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"prefetch-{self.queue_name}", daemon=True)
+        self.thread.start()
+
+    def head_sent_at(self):
+        """Send time of the oldest buffered message"""
+        queue_url, msg, received_at = self.buffer[0]
+        return message_sent_at(msg, received_at)
+
+    def _run(self):
+        while not self.stopped:
+            with self.work_available:
+                while len(self.buffer) >= SQS_PREFETCH_LIMIT and not self.stopped:
+                    self.work_available.wait()
+                if self.stopped:
+                    return
+                room = SQS_PREFETCH_LIMIT - len(self.buffer)
+
+            queue_url = get_sqs_url_by_name(self.queue_name)
+            if not queue_url:
+                logger.debug(f"Queue URL not found for '{self.queue_name}'.")
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            if not breakers["sqs"].allow():
+                time.sleep(min(breakers["sqs"].delay(), 1))
+                continue
+            try:
+                messages = receive_messages(queue_url, min(SQS_MAX_MESSAGES, room), SQS_WAIT_TIME_SECONDS)
+            except Exception as e:
+                logger.error(f"Failed to receive from '{self.queue_name}': {e}")
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            if messages:
+                logger.debug(f"Prefetched {len(messages)} messages from '{self.queue_name}'")
+                with self.work_available:
+                    stopped = self.stopped
+                    if not stopped:
+                        self.buffer.extend((queue_url, msg, time.time()) for msg in messages)
+                        self.work_available.notify_all()
+                if stopped:
+                    # The receive finished after shutdown started
+                    visibility_heartbeat.hand_back({msg["ReceiptHandle"] for msg in messages})
+
+
+# Queue scheduling in prefetch mode. When several queues have buffered work
+# they are served by smooth weighted round robin; a queue whose oldest message
+# has waited longer than its max wait is served first. A weight of 0 only
+# serves that queue when no other queue has work (or it is starving).
+FAST_QUEUE_WEIGHT = int(os.getenv("FAST_QUEUE_WEIGHT", "3"))
+SLOW_QUEUE_WEIGHT = int(os.getenv("SLOW_QUEUE_WEIGHT", "1"))
+FAST_QUEUE_MAX_WAIT = float(os.getenv("FAST_QUEUE_MAX_WAIT", "0"))  # 0 disables starvation protection
+SLOW_QUEUE_MAX_WAIT = float(os.getenv("SLOW_QUEUE_MAX_WAIT", "600"))
+FAST_QUEUE_TARGET_WAIT = float(os.getenv("FAST_QUEUE_TARGET_WAIT", "30"))
+SLOW_QUEUE_TARGET_WAIT = float(os.getenv("SLOW_QUEUE_TARGET_WAIT", "900"))
+
+
+def message_sent_at(msg, default):
+    """When SQS accepted the message, from its SentTimestamp attribute"""
+    sent = msg.get("Attributes", {}).get("SentTimestamp")
+    return int(sent) / 1000.0 if sent else default
+
+
+class QueuePolicy:
+    """Scheduling weight, starvation limit and latency target for one queue"""
+
+    def __init__(self, queue_name, weight, max_wait, target_wait):
+        self.queue_name = queue_name
+        self.weight = weight
+        self.max_wait = max_wait
+        self.target_wait = target_wait
+        self.credit = 0
+        self.wait_stats = LatencyStats()
+
+
+class QueueScheduler:
+    """Picks which queue's buffered message runs next"""
+
+    def __init__(self, policies):
+        self.policies = {policy.queue_name: policy for policy in policies}
+        self.last_report = time.time()
+        self.affinity_picks = 0  # messages taken ahead of older ones for model affinity
+
+    def choose(self, prefetchers, now):
+        """Return the prefetcher to take from, or None if none has work"""
+        candidates = [prefetcher for prefetcher in prefetchers if prefetcher.buffer]
+        if not candidates:
+            return None
+
+        # Starvation protection: the most overdue queue goes first
+        overdue = None
+        for prefetcher in candidates:
+            policy = self.policies[prefetcher.queue_name]
+            waited = now - prefetcher.head_sent_at()
+            if policy.max_wait and waited >= policy.max_wait:
+                if overdue is None or waited - policy.max_wait > overdue[0]:
+                    overdue = (waited - policy.max_wait, prefetcher)
+        if overdue:
+            logger.debug(f"Queue '{overdue[1].queue_name}' exceeded its max wait, serving it next")
+            return overdue[1]
+
+        weighted = [p for p in candidates if self.policies[p.queue_name].weight > 0]
+        if not weighted:
+            return candidates[0]
+
+        # Smooth weighted round robin over the queues that have work
+        total = 0
+        best = None
+        for prefetcher in weighted:
+            policy = self.policies[prefetcher.queue_name]
+            policy.credit += policy.weight
+            total += policy.weight
+            if best is None or policy.credit > self.policies[best.queue_name].credit:
+                best = prefetcher
+        self.policies[best.queue_name].credit -= total
+        return best
+
+    def record_dispatch(self, queue_name, msg, now):
+        """Record how long a message waited between being sent and starting"""
+        policy = self.policies[queue_name]
+        waited = max(0.0, now - message_sent_at(msg, now))
+        policy.wait_stats.record(waited)
+        stage_latency["queue_wait"].record(waited)
+        if now - self.last_report >= STATS_REPORT_INTERVAL:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        """Log per-queue wait statistics against each queue's target"""
+        for policy in self.policies.values():
+            stats = policy.wait_stats.summary()
+            if not stats["count"]:
+                continue
+            status = "meeting" if stats["p95"] <= policy.target_wait else "MISSING"
+            logger.info(
+                f"Queue '{policy.queue_name}' wait: {stats['count']} jobs, p50 {stats['p50']:.1f}s, "
+                f"p95 {stats['p95']:.1f}s, max {stats['max']:.1f}s ({status} target {policy.target_wait:.0f}s)"
+            )
+        if MODEL_AFFINITY_WINDOW > 1:
+            logger.info(f"Model affinity took {self.affinity_picks} jobs ahead of older ones")
+
+
+def message_model(msg):
+    """Model requested by a raw SQS message, or None if its body can't be parsed"""
+    try:
+        return TTI_input(json.loads(msg["Body"])).model
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+# Trello cards are ingested by the ai-trello-to-sqs Lambda, which a background
+# thread invokes every TRELLO_INGEST_INTERVAL seconds of wall-clock time,
+# independent of how long renders take. While the job queues hold at least
+# TRELLO_INGEST_BACKLOG messages the interval doubles, up to
+# TRELLO_INGEST_MAX_INTERVAL, since new cards would only wait behind them;
+# a shorter backlog brings it back. "Event" invokes the Lambda without
+# waiting for its result.
+TRELLO_INGEST_INTERVAL = float(os.getenv("TRELLO_INGEST_INTERVAL", "20"))  # 0 disables ingest
+TRELLO_INGEST_MAX_INTERVAL = float(os.getenv("TRELLO_INGEST_MAX_INTERVAL", "300"))
+TRELLO_INGEST_BACKLOG = int(os.getenv("TRELLO_INGEST_BACKLOG", "20"))
+TRELLO_INVOCATION_TYPE = os.getenv("TRELLO_INVOCATION_TYPE", "RequestResponse")
+
+
+class TrelloIngestScheduler:
+    """Invokes the Trello Lambda on its own cadence, off the job processing path"""
+
+    def __init__(self):
+        self.interval = TRELLO_INGEST_INTERVAL
+        self.latency = LatencyStats()
+        self.invocations = collections.Counter()  # by "success" or "failure"
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="trello-ingest", daemon=True)
+        thread.start()
+        logger.info(
+            f"Invoking the Trello Lambda ({TRELLO_INVOCATION_TYPE}) every {TRELLO_INGEST_INTERVAL:g}s, "
+            f"up to every {TRELLO_INGEST_MAX_INTERVAL:g}s while {TRELLO_INGEST_BACKLOG} or more messages are queued"
+        )
+
+    def queue_backlog(self):
+        """Messages waiting on both job queues, or None if SQS cannot tell us right now"""
+        # Only look at the breaker: allow() would take the half-open probe the receivers need
+        if breakers["sqs"].state != "closed":
+            return None
+        backlog = 0
+        try:
+            for queue_name in (FAST_QUEUE, SLOW_QUEUE):
+                response = sqs.get_queue_attributes(
+                    QueueUrl=get_sqs_url_by_name(queue_name),
+                    AttributeNames=["ApproximateNumberOfMessages"],
+                )
+                backlog += int(response["Attributes"]["ApproximateNumberOfMessages"])
+        except Exception as e:
+            logger.warning(f"Could not read the SQS backlog for Trello ingest: {e}")
+            return None
+        return backlog
+
+    def next_interval(self, backlog):
+        """Stretch the interval while the backlog is deep, keep it when unknown"""
+        if backlog is None:
+            return self.interval
+        if backlog >= TRELLO_INGEST_BACKLOG:
+            return min(self.interval * 2, TRELLO_INGEST_MAX_INTERVAL)
+        return TRELLO_INGEST_INTERVAL
+
+    def ingest(self):
+        start = time.time()
+        ok = invoke_trello_lambda(TRELLO_INVOCATION_TYPE)
+        self.latency.record(time.time() - start)
+        self.invocations["success" if ok else "failure"] += 1
+
+    def _run(self):
+        next_run = time.monotonic()
+        # No new cards once the watcher is draining
+        while not graceful_shutdown.requested.is_set():
+            self.ingest()
+            interval = self.next_interval(self.queue_backlog())
+            if interval != self.interval:
+                logger.info(f"Trello ingest interval is now {interval:g}s")
+                self.interval = interval
+            # Scheduled from the previous run, so slow invocations do not shift the cadence
+            next_run = max(next_run + self.interval, time.monotonic())
+            graceful_shutdown.requested.wait(next_run - time.monotonic())
+
+
+trello_ingest = TrelloIngestScheduler()
+
+
+class PrefetchReceiver:
+    """Hands out prefetched messages in the order chosen by the queue scheduler"""
+
+    def __init__(self, policies):
+        self.work_available = threading.Condition()
+        self.prefetchers = [QueuePrefetcher(policy.queue_name, self.work_available) for policy in policies]
+        self.scheduler = QueueScheduler(policies)
+
+    def start(self):
+        for prefetcher in self.prefetchers:
+            prefetcher.start()
+        logger.info(
+            f"Prefetching up to {SQS_PREFETCH_LIMIT} messages per queue "
+            f"(long poll {SQS_WAIT_TIME_SECONDS}s, visibility {SQS_VISIBILITY_TIMEOUT}s)"
+        )
+
+    def take(self, timeout):
+        """Return the next (queue_name, queue_url, msg), waiting up to timeout for one to arrive"""
+        deadline = time.time() + timeout
+        with self.work_available:
+            while True:
+                now = time.time()
+                prefetcher = self.scheduler.choose(self.prefetchers, now)
+                if prefetcher:
+                    queue_url, msg, received_at = self._pop_next(prefetcher, now)
+                    self.work_available.notify_all()
+                    self.scheduler.record_dispatch(prefetcher.queue_name, msg, now)
+                    return prefetcher.queue_name, queue_url, msg
+                remaining = deadline - now
+                if remaining <= 0:
+                    return None
+                self.work_available.wait(remaining)
+
+    def stop(self):
+        """Stop prefetching and hand every buffered message back to SQS; return how many there were"""
+        with self.work_available:
+            receipt_handles = set()
+            for prefetcher in self.prefetchers:
+                prefetcher.stopped = True
+                receipt_handles.update(msg["ReceiptHandle"] for queue_url, msg, received_at in prefetcher.buffer)
+                prefetcher.buffer.clear()
+            self.work_available.notify_all()
+        return visibility_heartbeat.hand_back(receipt_handles)
+
+    def join(self, timeout):
+        """Wait for long polls still running after stop to finish and hand back what they received"""
+        deadline = time.time() + timeout
+        for prefetcher in self.prefetchers:
+            if prefetcher.thread:
+                prefetcher.thread.join(max(0.0, deadline - time.time()))
+
+    def _pop_next(self, prefetcher, now):
+        """Pop the oldest buffered message, or a newer one for a loaded model within the affinity window"""
+        buffer = prefetcher.buffer
+        index = 0
+        # The head is the longest-buffered message, so it bounds every job's delay
+        if MODEL_AFFINITY_WINDOW > 1 and now - buffer[0][2] < MODEL_AFFINITY_MAX_DELAY:
+            loaded = backend_pool.loaded_models()
+            models = [message_model(msg) for queue_url, msg, received_at in
+                      itertools.islice(buffer, MODEL_AFFINITY_WINDOW)]
+            if models[0] not in loaded:
+                index = next((i for i, model in enumerate(models) if model in loaded), 0)
+                if index:
+                    self.scheduler.affinity_picks += 1
+        item = buffer[index]
+        del buffer[index]
+        return item
+
+    def take_matching(self, matches, limit, timeout):
+        """Take up to limit buffered messages for which matches(msg) is true, waiting up to timeout to fill up"""
+        taken = []
+        deadline = time.time() + timeout
+        with self.work_available:
+            while True:
+                now = time.time()
+                for prefetcher in self.prefetchers:
+                    for item in list(prefetcher.buffer):
+                        queue_url, msg, received_at = item
+                        if len(taken) < limit and matches(msg):
+                            prefetcher.buffer.remove(item)
+                            self.scheduler.record_dispatch(prefetcher.queue_name, msg, now)
+                            taken.append((prefetcher.queue_name, queue_url, msg))
+                if taken:
+                    self.work_available.notify_all()
+                remaining = deadline - now
+                if len(taken) >= limit or remaining <= 0:
+                    return taken
+                self.work_available.wait(remaining)
+
+
+def next_job(receiver, timeout):
+    """Take the next prefetched message as a Job, batched with compatible buffered messages"""
+    item = receiver.take(timeout)
+    if item is None:
+        return None
+    job = create_job(*item)
+    if job is None:
+        return None
+    key = batch_key(job.tti_input) if not job.resume else None
+    if key is not None:
+        def matches(msg):
+            # Jobs with a render in the ledger are resumed on their own
+            return message_batch_key(msg) == key and job_ledger.get(message_job_id(msg)) is None
+
+        for item in receiver.take_matching(matches, BATCH_MAX_SIZE - 1, BATCH_MAX_WAIT):
+            member = create_job(*item)
+            if member:
+                job.add_to_batch(member)
+    return job
+
+
+def dispatch_next_message(receiver, pipeline, timeout):
+    """Take the next prefetched message and process it, or hand it to the pipeline"""
+    if pipeline and not pipeline.wait_for_room(timeout):
+        return
+    job = next_job(receiver, timeout)
+    if job is None:
+        return
+    if pipeline:
+        pipeline.submit_queue.put(job)
+    else:
+        process_job(job)
+
+
+def receive_sqs_messages(queue_name):
+    queue_url = get_sqs_url_by_name(queue_name)
+    if not queue_url:
+        logger.debug(f"Queue URL not found for '{queue_name}'.")
+        return
+
+    if not breakers["sqs"].allow():
+        return
+    try:
+        messages = receive_messages(queue_url, 1, 0)
+    except Exception as e:
+        logger.error(f"Failed to receive from '{queue_name}': {e}")
+        return
+
+    for msg in messages:
+        job = create_job(queue_name, queue_url, msg)
+        if job:
+            process_job(job)
+
+
+# Staged pipeline configuration. Each stage hands jobs to the next through a
+# bounded queue so that publishing job N overlaps with rendering job N+1.
+PIPELINE_ENABLED = os.getenv("PIPELINE_ENABLED", "false").lower() == "true"
+PIPELINE_SUBMIT_DEPTH = int(os.getenv("PIPELINE_SUBMIT_DEPTH", "1"))
+# By default keep one job rendering (and one waiting) per ComfyUI backend
+PIPELINE_RENDER_DEPTH = int(os.getenv("PIPELINE_RENDER_DEPTH", str(len(COMFYUI_URLS))))
+PIPELINE_PUBLISH_DEPTH = int(os.getenv("PIPELINE_PUBLISH_DEPTH", "4"))
+PIPELINE_SUBMIT_WORKERS = int(os.getenv("PIPELINE_SUBMIT_WORKERS", "1"))
+PIPELINE_RENDER_WORKERS = int(os.getenv("PIPELINE_RENDER_WORKERS", str(len(COMFYUI_URLS))))
+PIPELINE_PUBLISH_WORKERS = int(os.getenv("PIPELINE_PUBLISH_WORKERS", "2"))
+
+
+class JobPipeline:
+    """Receive -> submit -> await -> publish pipeline with bounded hand-off queues"""
+
+    def __init__(self):
+        self.submit_queue = queue.Queue(maxsize=PIPELINE_SUBMIT_DEPTH)
+        self.render_queue = queue.Queue(maxsize=PIPELINE_RENDER_DEPTH)
+        self.publish_queue = queue.Queue(maxsize=PIPELINE_PUBLISH_DEPTH)
+        self.room_available = threading.Condition()
+        self.stages = [
+            ("submit", self.submit_queue, PIPELINE_SUBMIT_WORKERS, self._submit),
+            ("render", self.render_queue, PIPELINE_RENDER_WORKERS, self._render),
+            ("publish", self.publish_queue, PIPELINE_PUBLISH_WORKERS, self._publish),
+        ]
+        self.workers = {}
+
+    def start(self):
+        """Start the worker threads for every stage"""
+        for name, stage_queue, count, handler in self.stages:
+            self.workers[name] = []
+            for i in range(count):
+                worker = threading.Thread(
+                    target=self._worker_loop,
+                    args=(stage_queue, handler),
+                    name=f"pipeline-{name}-{i}",
+                    daemon=True,
+                )
+                worker.start()
+                self.workers[name].append(worker)
+        logger.info(
+            f"Started job pipeline: submit={PIPELINE_SUBMIT_WORKERS}/{PIPELINE_SUBMIT_DEPTH}, "
+            f"render={PIPELINE_RENDER_WORKERS}/{PIPELINE_RENDER_DEPTH}, "
+            f"publish={PIPELINE_PUBLISH_WORKERS}/{PIPELINE_PUBLISH_DEPTH} (workers/depth)"
+        )
+
+    def stop(self):
+        """Hand jobs that were not started back to SQS, then drain each stage in order"""
+        while True:
+            try:
+                job = self.submit_queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                hand_back_job(job)
+        for name, stage_queue, count, handler in self.stages:
+            for _ in range(count):
+                stage_queue.put(None)
+            for worker in self.workers.get(name, []):
+                worker.join()
+        logger.info("Job pipeline stopped")
+
+    def receive(self, queue_name):
+        """Receive stage: pull a message into the pipeline if the submit stage has room"""
+        if self.submit_queue.full():
+            logger.debug(f"Submit stage full, not receiving from '{queue_name}'")
+            return
+
+        queue_url = get_sqs_url_by_name(queue_name)
+        if not queue_url:
+            logger.debug(f"Queue URL not found for '{queue_name}'.")
+            return
+
+        if not breakers["sqs"].allow():
+            return
+        try:
+            messages = receive_messages(queue_url, 1, 0)
+        except Exception as e:
+            logger.error(f"Failed to receive from '{queue_name}': {e}")
+            return
+        for msg in messages:
+            job = create_job(queue_name, queue_url, msg)
+            if job:
+                self.submit_queue.put(job)
+
+    def wait_for_room(self, timeout):
+        """Wait up to timeout for the submit stage to have room for another job"""
+        with self.room_available:
+            if self.submit_queue.full():
+                self.room_available.wait(timeout)
+            return not self.submit_queue.full()
+
+    def _worker_loop(self, stage_queue, handler):
+        while True:
+            job = stage_queue.get()
+            if stage_queue is self.submit_queue:
+                with self.room_available:
+                    self.room_available.notify()
+            if job is None:
+                break
+            handler(job)
+
+    def _submit(self, job):
+        if job.resume or job.cached:
+            self.publish_queue.put(job)
+        elif job.prompt_id:
+            self.render_queue.put(job)
+        elif run_job_stage(prepare_job, job) and run_job_stage(submit_job, job):
+            self.render_queue.put(job)
+        else:
+            release_job(job)
+
+    def _render(self, job):
+        if run_job_stage(await_job, job):
+            self.publish_queue.put(job)
+        else:
+            release_job(job)
+
+    def _publish(self, job):
+        if not run_job_stage(publish_job, job):
+            release_job(job)
+
+
+# Execution engine. "threads" runs jobs on the main loop or the pipeline's
+# worker threads. "asyncio" runs every job as a task on one event loop, with
+# aiohttp for ComfyUI and boto3 calls on a small thread pool.
+WATCHER_ENGINE = os.getenv("WATCHER_ENGINE", "threads")
+ASYNC_MAX_JOBS = int(os.getenv("ASYNC_MAX_JOBS", str(2 * len(COMFYUI_URLS))))
+ASYNC_AWS_WORKERS = int(os.getenv("ASYNC_AWS_WORKERS", "8"))
+
+
+class AsyncEngine:
+    """Keeps up to ASYNC_MAX_JOBS jobs in flight as tasks on one asyncio event loop"""
+
+    def __init__(self, receiver=None, recovered=()):
+        self.receiver = receiver
+        self.recovered = list(recovered)
+        self.aws_executor = concurrent.futures.ThreadPoolExecutor(ASYNC_AWS_WORKERS, thread_name_prefix="async-aws")
+        self.session = None
+        self.slots = None
+        self.tasks = set()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.slots = asyncio.Semaphore(ASYNC_MAX_JOBS)
+        async with aiohttp.ClientSession() as self.session:
+            logger.info(f"Started asyncio engine with up to {ASYNC_MAX_JOBS} jobs in flight")
+            for job in self.recovered:
+                await self.slots.acquire()
+                self.start(job)
+            while not graceful_shutdown.requested.is_set():
+                note_progress()
+
+                # While ComfyUI or S3 is failing no job is started, except a probe when one is due
+                delay = job_start_delay()
+                if delay:
+                    await asyncio.to_thread(graceful_shutdown.requested.wait, delay)
+                else:
+                    await self.slots.acquire()
+                    jobs = await self.next_jobs()
+                    if not jobs:
+                        self.slots.release()
+                    for i, job in enumerate(jobs):
+                        if i:
+                            await self.slots.acquire()
+                        self.start(job)
+
+                # Waiting on the prefetch buffers replaces the fixed sleep
+                if not self.receiver:
+                    await asyncio.to_thread(graceful_shutdown.requested.wait, POLL_INTERVAL)
+
+            if self.tasks:
+                logger.info(f"Waiting for {len(self.tasks)} jobs in flight")
+                await asyncio.wait(self.tasks)
+
+    def start(self, job):
+        """Process a job in a new task; the caller holds a slot for it"""
+        task = asyncio.create_task(self.process(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def aws(self, fn, *args):
+        """Run a blocking boto3 call on the engine's thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.aws_executor, fn, *args)
+
+    async def next_jobs(self):
+        """The next prefetched job, or a message from each queue when not prefetching"""
+        if self.receiver:
+            # Blocks on the prefetch buffers, so kept off the AWS pool
+            job = await asyncio.to_thread(next_job, self.receiver, POLL_INTERVAL)
+            return [job] if job else []
+        jobs = []
+        for queue_name in (FAST_QUEUE, SLOW_QUEUE):
+            queue_url = await self.aws(get_sqs_url_by_name, queue_name)
+            if not queue_url:
+                logger.debug(f"Queue URL not found for '{queue_name}'.")
+                continue
+            if not breakers["sqs"].allow():
+                break
+            try:
+                messages = await self.aws(receive_messages, queue_url, 1, 0)
+            except Exception as e:
+                logger.error(f"Failed to receive from '{queue_name}': {e}")
+                continue
+            for msg in messages:
+                # Redelivered messages may be checked against S3
+                job = await self.aws(create_job, queue_name, queue_url, msg)
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    async def process(self, job):
+        """Render and publish a job, releasing its message if any stage fails"""
+        try:
+            published = (job.resume or job.cached or await self.render(job)) and await self.aws(run_job_stage, publish_job, job)
+            if not published:
+                release_job(job)
+        finally:
+            self.slots.release()
+
+    async def render(self, job):
+        """Prepare, submit and wait for the job's prompt"""
+        # A reattached job's prompt was submitted before the watcher restarted
+        stages = (self.wait,) if job.prompt_id else (self.prepare, self.submit, self.wait)
+        for stage in stages:
+            if not await self.run_stage(stage, job):
+                return False
+        return True
+
+    async def run_stage(self, stage, job):
+        """Run a single stage for a job, backing off on ComfyUI and unexpected errors"""
+        note_progress()
+        try:
+            return await stage(job)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Network error communicating with ComfyUI: {e}")
+            record_comfyui_failure(job, e)
+            # Don't delete message on network error, let it retry
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected error processing message {job.tti_input.id}: {e}")
+            record_unexpected_failure(e)
+            # Don't delete message on unexpected error, let it retry
+            return False
+        finally:
+            note_progress()
+
+    async def prepare(self, job):
+        return prepare_job(job)
+
+    async def submit(self, job):
+        job.backend = await self.acquire_backend(job)
+        if job.backend is None:
+            # Don't delete message when no backend is available, let it retry
+            breakers["comfyui"].record_failure("no healthy backend")
+            return False
+
+        prompt = {"prompt": job.workflow, "client_id": COMFYUI_CLIENT_ID}
+        logger.info(f"using prompt: {job.tti_input.prompt}")
+        submit_start = time.time()
+        async with self.session.post(
+            f"{job.backend.url}/prompt", json=prompt, timeout=aiohttp.ClientTimeout(total=30)
+        ) as response:
+            text = await response.text()
+        stage_latency["submit"].record(time.time() - submit_start)
+        return accept_prompt_response(job, response.status, text)
+
+    async def acquire_backend(self, job):
+        """backend_pool.acquire with every backend's /queue read concurrently"""
+        if COMFYUI_BALANCE_MODE != "queue" or len(backend_pool.backends) < 2:
+            return backend_pool.acquire(job)
+        healthy = [backend for backend in backend_pool.backends if backend.healthy]
+        results = await asyncio.gather(*(self.queue_depth(backend) for backend in healthy), return_exceptions=True)
+        queue_depths = {}
+        for backend, result in zip(healthy, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to read queue of ComfyUI backend {backend.url}: {result}")
+                backend_pool.record_failure(backend)
+            else:
+                queue_depths[backend] = result
+        return backend_pool.acquire(job, queue_depths)
+
+    async def queue_depth(self, backend):
+        async with self.session.get(f"{backend.url}/queue", timeout=aiohttp.ClientTimeout(total=5)) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+
+    async def wait(self, job):
+        poll_start_time = time.time()
+        poll_response = await self.wait_for_prompt(job.prompt_id, job.backend)
+        job.poll_elapsed = time.time() - poll_start_time
+        backend_pool.release(job)
+        return accept_history(job, poll_response)
+
+    async def wait_for_prompt(self, prompt_id, backend):
+        """wait_for_comfyui_prompt without blocking a thread per job"""
+        listener = backend.listener
+        base_url = f"{backend.url}/history/"
+        deadline = time.time() + COMFYUI_RENDER_TIMEOUT
+        while listener and listener.connected.is_set() and time.time() < deadline:
+            status = await listener.wait_async(prompt_id, min(COMFYUI_WS_RECHECK_INTERVAL, deadline - time.time()))
+            note_progress()
+            # Check history even without an event in case one was missed during a reconnect
+            retval = await self.fetch_history(prompt_id, base_url)
+            if retval is not None:
+                return retval
+            if status is not None:
+                logger.debug(f"Prompt {prompt_id} finished with status {status} but has no history yet")
+                break
+
+        delay = 1
+        for i in range(600):
+            note_progress()
+            retval = await self.fetch_history(prompt_id, base_url)
+            if retval is not None:
+                logger.debug(f"History for {prompt_id} received after {i+1} polls.")
+                return retval
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)  # Exponential backoff, max 10 seconds
+        logger.debug(f"Timeout: No history for {prompt_id} after 600 polls.")
+        return None
+
+    async def fetch_history(self, prompt_id, base_url):
+        """fetch_comfyui_history over the engine's aiohttp session"""
+        try:
+            async with self.session.get(base_url + str(prompt_id), timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                if resp.status != 200:
+                    logger.debug(f"Non-200 response: {resp.status}")
+                    return None
+                data = await resp.json(content_type=None)
+            if data:
+                return data[prompt_id]["outputs"]
+        except Exception as e:
+            logger.debug(f"Error polling history: {e}")
+        return None
+
+
+# Graceful shutdown. On SIGTERM or SIGINT the watcher stops receiving, hands
+# prefetched messages back to SQS, lets jobs in flight finish and flushes S3
+# writes and acks. Messages still held after SHUTDOWN_DRAIN_TIMEOUT seconds,
+# or after a second signal, are handed back before exiting.
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "120"))
+
+
+class GracefulShutdown:
+    """Drains the watcher when it is asked to stop"""
+
+    def __init__(self):
+        self.requested = threading.Event()
+        self.done = threading.Event()
+        self.receiver = None
+
+    def install(self, receiver):
+        """Handle SIGTERM and SIGINT; must be called from the main thread"""
+        self.receiver = receiver
+        signal.signal(signal.SIGTERM, self._handle)
+        signal.signal(signal.SIGINT, self._handle)
+
+    def _handle(self, signum, frame):
+        name = signal.Signals(signum).name
+        if self.requested.is_set():
+            logger.warning(f"Received {name} again, exiting without waiting for jobs in flight")
+            raise KeyboardInterrupt
+        logger.info(f"Received {name}, draining for up to {SHUTDOWN_DRAIN_TIMEOUT}s")
+        self.requested.set()
+        # Signal handlers interrupt the main thread anywhere, so the work happens elsewhere
+        threading.Thread(target=self._drain, name="shutdown", daemon=True).start()
+
+    def _drain(self):
+        if self.receiver:
+            try:
+                returned = self.receiver.stop()
+                logger.info(f"Handed {returned} prefetched messages back to SQS")
+            except Exception as e:
+                logger.error(f"Failed to hand prefetched messages back to SQS: {e}")
+        if not self.done.wait(SHUTDOWN_DRAIN_TIMEOUT):
+            logger.error(f"Jobs still in flight after {SHUTDOWN_DRAIN_TIMEOUT}s, handing their messages back to SQS")
+            flush_queue_acks()
+            visibility_heartbeat.hand_back()
+            os._exit(1)
+
+    def finish(self, pipeline):
+        """Once the main loop has stopped: wait for jobs in flight, then flush S3 writes and acks"""
+        if pipeline:
+            pipeline.stop()
+        if self.receiver:
+            self.receiver.join(SQS_WAIT_TIME_SECONDS + 5)
+        # Seed patches are written after the job's message is acknowledged
+        s3_publisher.executor.shutdown(wait=True)
+        flush_queue_acks()
+        leftover = visibility_heartbeat.hand_back()
+        if leftover:
+            logger.warning(f"Handed {leftover} messages still held back to SQS")
+        self.done.set()
+        logger.info("Drained, exiting")
+
+
+graceful_shutdown = GracefulShutdown()
+
+
+# Status endpoint: /metrics in Prometheus text format, /healthz (liveness)
+# and /readyz (readiness). The watcher counts as stalled when neither the
+# main loop nor any job stage has made progress for STATUS_STALL_TIMEOUT.
+STATUS_PORT = int(os.getenv("STATUS_PORT", "8080"))  # 0 disables the endpoint
+STATUS_STALL_TIMEOUT = int(os.getenv("STATUS_STALL_TIMEOUT", "900"))
+last_progress_at = time.time()
+
+
+def note_progress():
+    """Record that the main loop or a job stage is still moving"""
+    global last_progress_at
+    last_progress_at = time.time()
+
+
+def health_checks():
+    """Liveness and readiness checks, each (ok, detail)"""
+    now = time.time()
+    stalled_for = now - last_progress_at
+    live = (stalled_for < STATUS_STALL_TIMEOUT, f"last progress {stalled_for:.0f}s ago")
+    credentials = (
+        credentials_expiration is not None and credentials_expiration > now,
+        f"expire in {credentials_expiration - now:.0f}s" if credentials_expiration else "not assumed",
+    )
+    healthy_backends = sum(1 for backend in backend_pool.backends if backend.healthy)
+    comfyui = (healthy_backends > 0, f"{healthy_backends}/{len(backend_pool.backends)} backends healthy")
+    # Half-open breakers are already probing, so only open ones make the watcher unready
+    open_breakers = [name for name, breaker in breakers.items() if breaker.state == "open"]
+    circuits = (not open_breakers, f"open: {', '.join(open_breakers)}" if open_breakers else "closed")
+    draining = graceful_shutdown.requested.is_set()
+    running = (not draining, "draining" if draining else "running")
+    return {"live": live}, {
+        "live": live, "credentials": credentials, "comfyui": comfyui, "circuits": circuits, "running": running,
+    }
+
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics():
+    """Current watcher state in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    def histogram(name, help_text, label, stats_by_label):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for value, stats in stats_by_label:
+            with stats.lock:
+                buckets, count, total = list(stats.buckets), stats.count, stats.total
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {round(total, 6)}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {count}')
+
+    now = time.time()
+    with job_counters.lock:
+        outcomes = sorted(job_counters.outcomes.items())
+        in_flight = job_counters.in_flight
+        last_success_at = job_counters.last_success_at
+
+    metric("comfy_watcher_jobs_total", "counter", "Jobs finished by queue, model and outcome",
+           [({"queue": queue_name, "model": model, "outcome": outcome}, count)
+            for (queue_name, model, outcome), count in outcomes])
+    metric("comfy_watcher_jobs_in_flight", "gauge", "Jobs taken from SQS and not yet finished",
+           [({}, in_flight)])
+    metric("comfy_watcher_messages_held", "gauge", "SQS messages kept invisible by this watcher, including prefetched ones",
+           [({}, len(visibility_heartbeat.messages))])
+    metric("comfy_watcher_circuit_state", "gauge", "Circuit breaker state per dependency: 0 closed, 1 half-open, 2 open",
+           [({"dependency": name}, ("closed", "half_open", "open").index(breaker.state))
+            for name, breaker in breakers.items()])
+    metric("comfy_watcher_circuit_opens_total", "counter", "Times a dependency's circuit breaker opened",
+           [({"dependency": name}, breaker.opens) for name, breaker in breakers.items()])
+    if last_success_at is not None:
+        metric("comfy_watcher_last_success_age_seconds", "gauge", "Seconds since the last job was processed",
+               [({}, round(now - last_success_at, 3))])
+    if credentials_expiration is not None:
+        metric("comfy_watcher_credentials_expiry_seconds", "gauge", "Seconds until the assumed role credentials expire",
+               [({}, round(credentials_expiration - now, 3))])
+    metric("comfy_watcher_last_progress_age_seconds", "gauge", "Seconds since the main loop or a job stage made progress",
+           [({}, round(now - last_progress_at, 3))])
+    metric("comfy_watcher_backend_up", "gauge", "Whether a ComfyUI backend is in the pool (1) or ejected (0)",
+           [({"backend": backend.url}, int(backend.healthy)) for backend in backend_pool.backends])
+    metric("comfy_watcher_backend_in_flight", "gauge", "Jobs routed to a ComfyUI backend that have not finished rendering",
+           [({"backend": backend.url}, len(backend.in_flight)) for backend in backend_pool.backends])
+    metric("comfy_watcher_model_switches_total", "counter", "Prompts sent to a backend for a different model than its previous one",
+           [({}, backend_pool.model_switches)])
+    metric("comfy_watcher_result_cache_lookups_total", "counter", "Result cache lookups of jobs with an explicit seed, hits counted once published",
+           [({"result": "hit"}, result_cache.hits), ({"result": "miss"}, result_cache.misses)])
+    metric("comfy_watcher_trello_ingest_total", "counter", "Trello Lambda invocations by result",
+           [({"result": result}, trello_ingest.invocations[result]) for result in ("success", "failure")])
+    metric("comfy_watcher_trello_ingest_interval_seconds", "gauge", "Current interval between Trello Lambda invocations",
+           [({}, trello_ingest.interval)])
+    metric("comfy_watcher_result_cache_saved_seconds_total", "counter", "Render seconds saved by publishing cached results",
+           [({}, round(result_cache.saved_seconds, 3))])
+
+    histogram("comfy_watcher_stage_duration_seconds", "Duration of each job stage", "stage",
+              sorted(stage_latency.items()))
+    histogram("comfy_watcher_trello_ingest_seconds", "Duration of Trello Lambda invocations", "invocation_type",
+              [(TRELLO_INVOCATION_TYPE, trello_ingest.latency)])
+    histogram("comfy_watcher_circuit_recovery_seconds", "Time from a circuit breaker opening until it closed again",
+              "dependency", [(name, breaker.recovery_stats) for name, breaker in breakers.items()])
+    return "\n".join(lines) + "\n"
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Serves /metrics, /healthz and /readyz"""
+
+    def log_message(self, format, *args):
+        logger.debug(f"Status request: {format % args}")
+
+    def _send(self, status, body, content_type):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            self._send(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        elif path in ("/healthz", "/readyz"):
+            liveness, readiness = health_checks()
+            checks = liveness if path == "/healthz" else readiness
+            ok = all(passed for passed, detail in checks.values())
+            body = {"status": "ok" if ok else "fail",
+                    "checks": {name: {"ok": passed, "detail": detail} for name, (passed, detail) in checks.items()}}
+            self._send(200 if ok else 503, json.dumps(body), "application/json")
+        else:
+            self._send(404, json.dumps({"error": "not found"}), "application/json")
+
+
+def start_status_server(port):
+    """Serve the status endpoint from a background thread"""
+    try:
+        server = ThreadingHTTPServer(("", port), StatusHandler)
+    except OSError as e:
+        logger.error(f"Failed to start status endpoint on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="status-server", daemon=True)
+    thread.start()
+    logger.info(f"Serving /metrics, /healthz and /readyz on port {port}")
+    return server
+
+
+# Response: {'prompt_id': 'a3bf9763-4cf8-4aef-9d70-36d89d9d03d5', 'number': 0, 'node_errors': {}}
+
+
+def main():
+    # Initialize AWS role assumption
+    logger.info("Starting comfy-watcher...")
+    if not assume_dnd_role():
+        logger.error(f"Failed to assume {AWS_ROLE_NAME}. Exiting.")
+        sys.exit(1)
+
+    # The load generator only sends messages, so it needs none of the worker's background threads
+    if len(sys.argv) > 1 and sys.argv[1] == "send":
+        send_load(sys.argv[2:])
+        return
+    
+    # Credentials refresh themselves; only the SSM configuration is re-read on a timer
+    schedule_ssm_refresh()
+
+    # Keep received messages invisible to other workers while we hold them
+    visibility_heartbeat.start()
+
+    check_seed_mode()
+
+    if METRICS_BUCKET:
+        MetricsPublisher(METRICS_BUCKET, METRICS_HOSTNAME).start()
+    
+    if len(sys.argv) > 1:
+        if sys.argv[1] in ("recv", "receive"):
+            # Check both queues when receiving
+            receive_sqs_messages(FAST_QUEUE)
+            receive_sqs_messages(SLOW_QUEUE)
+            flush_queue_acks()
+            return
+    else:
+        # Before the listeners connect, so events of journaled prompts reach them
+        restore_comfyui_client_id()
+
+        # Watch backend health and listen for ComfyUI completion events
+        backend_pool.start()
+        start_comfy_listener()
+
+        if STATUS_PORT:
+            start_status_server(STATUS_PORT)
+
+        # Trello cards are ingested in the background, not between jobs
+        if TRELLO_INGEST_INTERVAL:
+            trello_ingest.start()
+
+        engine = WATCHER_ENGINE
+        if engine == "asyncio" and aiohttp is None:
+            logger.warning("aiohttp is not installed, using the threads engine")
+            engine = "threads"
+
+        # Before receiving, so redelivered messages of these jobs are merged into them
+        recovered = recover_jobs()
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} jobs from the journal")
+
+        # In pipeline mode the main loop only feeds the receive stage
+        pipeline = None
+        if PIPELINE_ENABLED and engine == "threads":
+            pipeline = JobPipeline()
+            pipeline.start()
+
+        # In prefetch mode messages are long-polled into local buffers
+        receiver = None
+        if SQS_RECEIVE_MODE == "prefetch":
+            receiver = PrefetchReceiver([
+                QueuePolicy(FAST_QUEUE, FAST_QUEUE_WEIGHT, FAST_QUEUE_MAX_WAIT, FAST_QUEUE_TARGET_WAIT),
+                QueuePolicy(SLOW_QUEUE, SLOW_QUEUE_WEIGHT, SLOW_QUEUE_MAX_WAIT, SLOW_QUEUE_TARGET_WAIT),
+            ])
+            receiver.start()
+
+        graceful_shutdown.install(receiver)
+        if engine == "asyncio":
+            AsyncEngine(receiver, recovered).run()
+            graceful_shutdown.finish(pipeline)
+            return
+
+        for job in recovered:
+            if pipeline:
+                pipeline.submit_queue.put(job)
+            else:
+                process_job(job)
+
+        while not graceful_shutdown.requested.is_set():
+            note_progress()
+            
+            # While ComfyUI or S3 is failing no job is started, except a probe when one is due
+            delay = job_start_delay()
+            if delay:
+                graceful_shutdown.requested.wait(delay)
+            # Check both queues in the main loop
+            elif receiver:
+                dispatch_next_message(receiver, pipeline, POLL_INTERVAL)
+            elif pipeline:
+                pipeline.receive(FAST_QUEUE)
+                pipeline.receive(SLOW_QUEUE)
+            else:
+                receive_sqs_messages(FAST_QUEUE)
+                receive_sqs_messages(SLOW_QUEUE)
+            
+            # Waiting on the prefetch buffers replaces the fixed sleep
+            if not receiver:
+                graceful_shutdown.requested.wait(POLL_INTERVAL)
+
+        graceful_shutdown.finish(pipeline)
+
+
+# Acknowledged messages are deleted in batches once SQS_ACK_BATCH_SIZE are
+# pending or the oldest has waited SQS_ACK_MAX_DELAY seconds.
+SQS_ACK_BATCH_SIZE = min(int(os.getenv("SQS_ACK_BATCH_SIZE", "10")), 10)
+SQS_ACK_MAX_DELAY = float(os.getenv("SQS_ACK_MAX_DELAY", "2"))
+
+
+class QueueHandle:
+    """A queue's resolved URL and the acknowledgements waiting to be deleted"""
+
+    def __init__(self, queue_name):
+        self.queue_name = queue_name
+        self.url = None
+        self.lock = threading.Lock()
+        self.pending_acks = []
+        self.oldest_ack = None
+
+    def resolve(self):
+        """Look up the queue URL once and reuse it"""
+        if self.url is None:
+            try:
+                response = sqs.get_queue_url(QueueName=self.queue_name)
+                self.url = response["QueueUrl"]
+                logger.debug(f"SQS URL for '{self.queue_name}': {self.url}")
+            except Exception as e:
+                logger.debug(f"Error getting SQS URL for '{self.queue_name}': {e}")
+        return self.url
+
+    def ack(self, receipt_handle):
+        """Queue a processed message for deletion, flushing when the batch is full"""
+        with self.lock:
+            if not self.pending_acks:
+                self.oldest_ack = time.time()
+            self.pending_acks.append(receipt_handle)
+            full = len(self.pending_acks) >= SQS_ACK_BATCH_SIZE
+        if full:
+            self.flush_acks()
+
+    def flush_acks(self, due_only=False):
+        """Delete pending acknowledgements with delete_message_batch"""
+        with self.lock:
+            if not self.pending_acks:
+                return
+            if due_only and time.time() - self.oldest_ack < SQS_ACK_MAX_DELAY:
+                return
+            receipt_handles = self.pending_acks
+            self.pending_acks = []
+
+        queue_url = self.resolve()
+        for start in range(0, len(receipt_handles), 10):
+            chunk = receipt_handles[start:start + 10]
+            try:
+                response = sqs.delete_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{"Id": str(i), "ReceiptHandle": receipt_handle} for i, receipt_handle in enumerate(chunk)],
+                )
+            except Exception as e:
+                logger.error(f"Failed to delete {len(chunk)} messages from '{self.queue_name}': {e}")
+                breakers["sqs"].record_failure(type(e).__name__)
+                # Keep the handles for the next flush; the heartbeat keeps them invisible
+                with self.lock:
+                    if not self.pending_acks:
+                        self.oldest_ack = time.time()
+                    self.pending_acks.extend(chunk)
+                continue
+
+            for failure in response.get("Failed", []):
+                logger.error(f"Failed to delete message from '{self.queue_name}': {failure.get('Message')}")
+            for receipt_handle in chunk:
+                visibility_heartbeat.untrack(receipt_handle)
+            logger.debug(f"Deleted {len(chunk)} messages from '{self.queue_name}'")
+
+
+queue_handles = {}
+queue_handles_lock = threading.Lock()
+
+
+def get_queue_handle(queue_name):
+    with queue_handles_lock:
+        handle = queue_handles.get(queue_name)
+        if handle is None:
+            handle = queue_handles[queue_name] = QueueHandle(queue_name)
+        return handle
+
+
+def flush_queue_acks(due_only=False):
+    """Flush pending acknowledgements on every queue"""
+    with queue_handles_lock:
+        handles = list(queue_handles.values())
+    for handle in handles:
+        handle.flush_acks(due_only=due_only)
+
+
+# Utility to look up SQS URL by queue name
+def get_sqs_url_by_name(queue_name):
+    return get_queue_handle(queue_name).resolve()
+
+
+def fetch_comfyui_history(prompt_id, base_url=None):
+    """Fetch a prompt's outputs from ComfyUI history once, or None if it has not finished"""
+    if base_url is None:
+        base_url = f"{COMFYUI_URLS[0]}/history/"
+    url = base_url + str(prompt_id)
+    try:
+        resp = requests.get(url, timeout=10)
+        if resp.status_code == 200:
+            try:
+                data = resp.json()
+            except Exception:
+                data = resp.text
+                logger.debug(f"Error parsing JSON response: {data}")
+            if data != {}:
+                return data[prompt_id]["outputs"]
+        else:
+            logger.debug(f"Non-200 response: {resp.status_code}")
+    except Exception as e:
+        logger.debug(f"Error polling history: {e}")
+    return None
+
+
+def poll_comfyui_history(prompt_id, base_url=None) -> dict:
+    delay = 1
+    for i in range(600):
+        note_progress()
+        retval = fetch_comfyui_history(prompt_id, base_url)
+        if retval is not None:
+            logger.debug(
+                f"History for {prompt_id} received after {i+1} polls."
+            )
+            return retval
+        time.sleep(delay)
+        delay = min(delay * 2, 10)  # Exponential backoff, max 10 seconds
+    logger.debug(f"Timeout: No history for {prompt_id} after 600 polls.")
+    return None
+
+
+# Completion notification: "websocket" listens on ComfyUI's /ws endpoint and
+# falls back to history polling whenever the socket is down, "poll" only polls.
+# ComfyUI sends a prompt's events to the client id it was submitted with, so
+# a generated id is kept in STATE_DIR/comfyui-client-id for reattached prompts.
+COMFYUI_COMPLETION_MODE = os.getenv("COMFYUI_COMPLETION_MODE", "websocket")
+COMFYUI_CLIENT_ID = os.getenv("COMFYUI_CLIENT_ID") or uuid.uuid4().hex
+COMFYUI_RENDER_TIMEOUT = int(os.getenv("COMFYUI_RENDER_TIMEOUT", "3600"))
+COMFYUI_WS_RECHECK_INTERVAL = int(os.getenv("COMFYUI_WS_RECHECK_INTERVAL", "30"))
+
+
+def restore_comfyui_client_id():
+    """Reuse the client id of the previous run, or keep this run's one for the next"""
+    global COMFYUI_CLIENT_ID
+    if os.getenv("COMFYUI_CLIENT_ID") or not STATE_DIR:
+        return
+    path = os.path.join(STATE_DIR, "comfyui-client-id")
+    try:
+        with open(path) as f:
+            client_id = f.read().strip()
+        if client_id:
+            COMFYUI_CLIENT_ID = client_id
+            return
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Ignoring ComfyUI client id file {path}: {e}")
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(COMFYUI_CLIENT_ID)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not write ComfyUI client id file {path}: {e}")
+
+
+class AsyncEvent:
+    """Stands in for a threading.Event so the listener thread can wake a coroutine"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class ComfyEventListener:
+    """Listens for ComfyUI websocket events and wakes jobs waiting on their prompt_id"""
+
+    def __init__(self, base_url, client_id):
+        self.ws_url = base_url.replace("http", "ws", 1).rstrip("/") + f"/ws?clientId={client_id}"
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.waiters = {}  # prompt_id -> threading.Event
+        self.finished = collections.OrderedDict()  # prompt_id -> completion status
+        self.stopped = False
+        self.ws = None
+
+    def start(self):
+        """Connect in a background thread, reconnecting whenever the socket drops"""
+        thread = threading.Thread(target=self._run, name="comfy-ws", daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.ws:
+            self.ws.close()
+
+    def wait(self, prompt_id, timeout):
+        """Block until the prompt finishes, the socket drops or timeout; return its status or None"""
+        with self.lock:
+            if prompt_id in self.finished:
+                return self.finished[prompt_id]
+            event = self.waiters.setdefault(prompt_id, threading.Event())
+        event.wait(timeout)
+        with self.lock:
+            self.waiters.pop(prompt_id, None)
+            return self.finished.get(prompt_id)
+
+    async def wait_async(self, prompt_id, timeout):
+        """Like wait, but awaited on an event loop instead of blocking a thread"""
+        with self.lock:
+            if prompt_id in self.finished:
+                return self.finished[prompt_id]
+            event = self.waiters.setdefault(prompt_id, AsyncEvent(asyncio.get_running_loop()))
+        try:
+            await asyncio.wait_for(asyncio.shield(event.future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self.lock:
+            self.waiters.pop(prompt_id, None)
+            return self.finished.get(prompt_id)
+
+    def _run(self):
+        delay = 1
+        while not self.stopped:
+            try:
+                self.ws = websocket.create_connection(self.ws_url, timeout=10)
+            except Exception as e:
+                logger.debug(f"ComfyUI websocket connect to {self.ws_url} failed: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+
+            logger.info(f"Connected to ComfyUI websocket at {self.ws_url}")
+            delay = 1
+            self.connected.set()
+            try:
+                while not self.stopped:
+                    try:
+                        message = self.ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    if not message:
+                        break
+                    if isinstance(message, str):
+                        self._handle(message)
+            except Exception as e:
+                logger.debug(f"ComfyUI websocket error: {e}")
+            finally:
+                self.connected.clear()
+                self.ws.close()
+                self._wake_all()
+            if not self.stopped:
+                logger.warning("ComfyUI websocket disconnected, falling back to history polling")
+
+    def _handle(self, message):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        event_type = event.get("type")
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+
+        if event_type == "progress":
+            logger.debug(f"Prompt {prompt_id} progress: {data.get('value')}/{data.get('max')}")
+        elif event_type == "executing" and data.get("node") is None:
+            # ComfyUI sends this after the prompt's history has been stored
+            self._finish(prompt_id, "success")
+        elif event_type in ("execution_error", "execution_interrupted"):
+            self._finish(prompt_id, event_type)
+
+    def _finish(self, prompt_id, status):
+        with self.lock:
+            self.finished[prompt_id] = status
+            while len(self.finished) > 1000:
+                self.finished.popitem(last=False)
+            event = self.waiters.get(prompt_id)
+        if event:
+            event.set()
+
+    def _wake_all(self):
+        with self.lock:
+            for event in self.waiters.values():
+                event.set()
+
+
+# Backend pool. Each job goes to the healthy backend with the least work, by
+# its /queue ("queue") or by the watcher's own in-flight count ("inflight").
+# A backend is ejected after COMFYUI_EJECT_FAILURES consecutive failures and
+# re-admitted once its /system_stats answers again.
+COMFYUI_BALANCE_MODE = os.getenv("COMFYUI_BALANCE_MODE", "queue")
+COMFYUI_EJECT_FAILURES = int(os.getenv("COMFYUI_EJECT_FAILURES", "3"))
+COMFYUI_HEALTH_INTERVAL = int(os.getenv("COMFYUI_HEALTH_INTERVAL", "10"))
+
+
+class ComfyBackend:
+    """One ComfyUI process and the watcher's counters for it"""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.in_flight = set()  # jobs routed here that have not finished rendering
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.routed = 0
+        self.completed = 0
+        self.failed = 0
+        self.ejections = 0
+        self.render_stats = LatencyStats()
+        self.loaded_model = None  # model of the last prompt submitted, which ComfyUI runs in order
+        self.last_completed_at = 0.0
+        self.listener = None
+
+    def queue_depth(self):
+        """Prompts running or pending on the backend according to its /queue"""
+        resp = requests.get(f"{self.url}/queue", timeout=5)
+        resp.raise_for_status()
+        data = resp.json()
+        return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+
+    def load(self, queue_depth=None):
+        """Work on the backend, fetching its /queue depth unless one is given"""
+        with self.lock:
+            in_flight = len(self.in_flight)
+        if COMFYUI_BALANCE_MODE == "queue":
+            if queue_depth is None:
+                queue_depth = self.queue_depth()
+            # Jobs routed here but not yet submitted are not on /queue yet
+            return max(queue_depth, in_flight)
+        return in_flight
+
+    def has_prompt(self, prompt_id):
+        """Whether the prompt is running, pending or finished on the backend"""
+        resp = requests.get(f"{self.url}/queue", timeout=5)
+        resp.raise_for_status()
+        data = resp.json()
+        # Queue entries are [number, prompt_id, prompt, extra_data, outputs]
+        if any(item[1] == prompt_id for item in data.get("queue_running", []) + data.get("queue_pending", [])):
+            return True
+        # Checked second so a prompt that finishes in between is still found
+        resp = requests.get(f"{self.url}/history/{prompt_id}", timeout=10)
+        return resp.status_code == 200 and bool(resp.json())
+
+    def check_health(self):
+        try:
+            return requests.get(f"{self.url}/system_stats", timeout=5).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+
+class BackendPool:
+    """Routes jobs to the least loaded healthy ComfyUI backend"""
+
+    def __init__(self, urls):
+        self.backends = [ComfyBackend(url) for url in urls]
+        self.started_at = time.time()
+        self.last_report = time.time()
+        self.model_switches = 0
+        # Render time per model, split by whether the model had to be loaded first
+        self.model_render = collections.defaultdict(lambda: {"warm": LatencyStats(), "cold": LatencyStats()})
+
+    def start(self):
+        """Start re-admitting ejected backends in the background"""
+        thread = threading.Thread(target=self._health_loop, name="comfy-health", daemon=True)
+        thread.start()
+        logger.info(f"Using {len(self.backends)} ComfyUI backend(s): {', '.join(b.url for b in self.backends)}")
+
+    def loaded_models(self):
+        """Models of the last prompts submitted to the healthy backends"""
+        return {backend.loaded_model for backend in self.backends if backend.healthy and backend.loaded_model}
+
+    def acquire(self, job, queue_depths=None):
+        """Pick a backend for the job and count it in flight there, or None if all are ejected
+
+        queue_depths maps backends to /queue depths the caller already fetched;
+        backends missing from it are skipped.
+        """
+        best, best_load = None, None
+        for backend in self.backends:
+            if not backend.healthy:
+                continue
+            try:
+                if queue_depths is not None:
+                    if backend not in queue_depths:
+                        continue
+                    load = backend.load(queue_depths[backend])
+                else:
+                    # With a single backend there is nothing to compare
+                    load = backend.load() if len(self.backends) > 1 else 0
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"Failed to read queue of ComfyUI backend {backend.url}: {e}")
+                self.record_failure(backend)
+                continue
+            # Among equally loaded backends prefer one that already has the model loaded
+            load = (load, backend.loaded_model != job.tti_input.model)
+            if best is None or load < best_load:
+                best, best_load = backend, load
+        if best is None:
+            logger.error("No healthy ComfyUI backend available")
+            return None
+        with best.lock:
+            best.in_flight.add(job)
+            best.routed += 1
+        logger.debug(f"Routing {job.tti_input.id} to {best.url} (load {best_load[0]})")
+        return best
+
+    def release(self, job):
+        """Stop counting the job against its backend; safe to call more than once"""
+        if job.backend:
+            with job.backend.lock:
+                job.backend.in_flight.discard(job)
+
+    def record_submit(self, job):
+        """Note which model the backend will run next and whether that is a model switch"""
+        backend = job.backend
+        model = job.tti_input.model
+        job.submitted_at = time.time()
+        with backend.lock:
+            job.model_switch = backend.loaded_model is not None and backend.loaded_model != model
+            backend.loaded_model = model
+        if job.model_switch:
+            self.model_switches += 1
+            logger.debug(f"{backend.url} switching to model {model}")
+
+    def record_success(self, job):
+        breakers["comfyui"].record_success()
+        backend = job.backend
+        now = time.time()
+        with backend.lock:
+            backend.completed += 1
+            backend.consecutive_failures = 0
+            # Prompts run one at a time, so a job's render starts when the previous one finishes
+            render_start = max(job.submitted_at, backend.last_completed_at)
+            backend.last_completed_at = now
+        render_seconds = now - render_start
+        job.render_seconds = render_seconds
+        backend.render_stats.record(render_seconds)
+        stage_latency["comfy_queue_wait"].record(render_start - job.submitted_at)
+        stage_latency["render"].record(render_seconds)
+        self.model_render[job.tti_input.model]["cold" if job.model_switch else "warm"].record(render_seconds)
+        if time.time() - self.last_report >= STATS_REPORT_INTERVAL:
+            self.last_report = time.time()
+            self.report()
+
+    def record_failure(self, backend):
+        """Count a backend failure, ejecting it after COMFYUI_EJECT_FAILURES in a row"""
+        with backend.lock:
+            backend.failed += 1
+            backend.consecutive_failures += 1
+            eject = backend.healthy and backend.consecutive_failures >= COMFYUI_EJECT_FAILURES
+            if eject:
+                backend.healthy = False
+                backend.ejections += 1
+        if eject:
+            logger.warning(
+                f"Ejecting ComfyUI backend {backend.url} after {backend.consecutive_failures} consecutive failures"
+            )
+        # A single bad backend is only ejected; the breaker would stop the healthy ones too
+        if all(not other.healthy or other.consecutive_failures for other in self.backends):
+            breakers["comfyui"].record_failure(f"a failure of {backend.url}")
+
+    def _health_loop(self):
+        while True:
+            time.sleep(COMFYUI_HEALTH_INTERVAL)
+            for backend in self.backends:
+                if not backend.healthy and backend.check_health():
+                    with backend.lock:
+                        backend.healthy = True
+                        backend.consecutive_failures = 0
+                    logger.info(f"Re-admitting ComfyUI backend {backend.url}")
+
+    def report(self):
+        """Log throughput, render latency and failures for each backend"""
+        minutes = max(time.time() - self.started_at, 1) / 60
+        for backend in self.backends:
+            summary = backend.render_stats.summary()
+            state = "healthy" if backend.healthy else "ejected"
+            logger.info(
+                f"ComfyUI {backend.url} ({state}): {backend.completed} completed ({backend.completed / minutes:.1f}/min), "
+                f"{backend.failed} failed, {backend.ejections} ejections, {len(backend.in_flight)} in flight, "
+                f"render p50 {summary['p50']:.2f}s, p95 {summary['p95']:.2f}s"
+            )
+
+        # Time lost to switches: extra render time of jobs that had to load their model
+        lost = 0.0
+        details = []
+        for model, stats in sorted(self.model_render.items()):
+            warm, cold = stats["warm"].summary(), stats["cold"].summary()
+            if warm["count"] and cold["count"]:
+                lost += cold["count"] * max(0.0, cold["mean"] - warm["mean"])
+                details.append(f"{model} p50 {cold['p50']:.1f}s after a switch vs {warm['p50']:.1f}s")
+        jobs = sum(backend.completed for backend in self.backends)
+        logger.info(
+            f"Model switches: {self.model_switches} for {jobs} jobs, about {lost:.0f}s lost to model loads"
+            + (f" ({'; '.join(details)})" if details else "")
+        )
+
+
+backend_pool = BackendPool(COMFYUI_URLS)
+
+
+def start_comfy_listener():
+    """Start a websocket listener per ComfyUI backend if websocket completion is enabled"""
+    if COMFYUI_COMPLETION_MODE != "websocket":
+        logger.info("Using ComfyUI history polling for job completion")
+        return
+    if websocket is None:
+        logger.warning("websocket-client is not installed, using ComfyUI history polling for job completion")
+        return
+    for backend in backend_pool.backends:
+        backend.listener = ComfyEventListener(backend.url, COMFYUI_CLIENT_ID)
+        backend.listener.start()
+
+
+def wait_for_comfyui_prompt(prompt_id, backend):
+    """Wait for a prompt to finish, woken by websocket events with history polling as fallback"""
+    listener = backend.listener
+    base_url = f"{backend.url}/history/"
+    deadline = time.time() + COMFYUI_RENDER_TIMEOUT
+    while listener and listener.connected.is_set() and time.time() < deadline:
+        status = listener.wait(prompt_id, min(COMFYUI_WS_RECHECK_INTERVAL, deadline - time.time()))
+        # A long render is still progress as far as /healthz is concerned
+        note_progress()
+        # Check history even without an event in case one was missed during a reconnect
+        retval = fetch_comfyui_history(prompt_id, base_url)
+        if retval is not None:
+            return retval
+        if status is not None:
+            logger.debug(f"Prompt {prompt_id} finished with status {status} but has no history yet")
+            break
+    return poll_comfyui_history(prompt_id, base_url)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("Received interrupt signal, shutting down...")
+        # Delete messages that were already processed, then let other workers take the rest
+        flush_queue_acks()
+        visibility_heartbeat.hand_back()
+        # Cancel the SSM refresh timer
+        if ssm_refresh_timer:
+            ssm_refresh_timer.cancel()
+        sys.exit(0)
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        try:
+            flush_queue_acks()
+            visibility_heartbeat.hand_back()
+        except Exception as e:
+            logger.error(f"Failed to hand messages back to SQS: {e}")
+        # Cancel the SSM refresh timer
+        if ssm_refresh_timer:
+            ssm_refresh_timer.cancel()
         sys.exit(1)
@@ -0,0 +1,478 @@
+"""Publish host CPU, memory, swap and GPU metrics for the website's MetricsWidget.
+
+Writes {hostname}.json (schema: sample-outputs/sample-metrics.json) to the
+metrics bucket every HOST_METRICS_INTERVAL seconds and keeps this host's
+entry in list.json current. Run it next to comfy-watcher:
+
+    METRICS_BUCKET=my-metrics-bucket python host-metrics.py
+    HOST_METRICS_SOURCE=fake python host-metrics.py --dry-run
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Configure logging
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(
+    level=getattr(logging, log_level, logging.INFO),
+    format="%(asctime)s %(levelname)s %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+AWS_REGION = os.getenv("COMFY_AWS_DEFAULT_REGION") or os.getenv("AWS_DEFAULT_REGION", "us-west-2")
+METRICS_BUCKET = os.getenv("METRICS_BUCKET")
+METRICS_HOSTNAME = os.getenv("METRICS_HOSTNAME") or socket.gethostname()
+# "proc" reads /proc, /sys and nvidia-smi; "fake" generates values for testing
+HOST_METRICS_SOURCE = os.getenv("HOST_METRICS_SOURCE", "proc")
+HOST_METRICS_INTERVAL = float(os.getenv("HOST_METRICS_INTERVAL", "1"))
+# Skip an upload when every headline value moved less than this many points
+HOST_METRICS_TOLERANCE = float(os.getenv("HOST_METRICS_TOLERANCE", "1.0"))
+# Upload at least this often even when nothing changed
+HOST_METRICS_MAX_AGE = float(os.getenv("HOST_METRICS_MAX_AGE", "30"))
+# How often this host's timestamp in list.json is refreshed
+HOST_METRICS_LIST_INTERVAL = float(os.getenv("HOST_METRICS_LIST_INTERVAL", "30"))
+LIST_KEY = "list.json"
+
+
+def read_secret(secret_file_path):
+    try:
+        with open(secret_file_path, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def create_s3_client():
+    """S3 client from Docker secrets if present, otherwise boto3's default credential chain"""
+    access_key = read_secret("/run/secrets/aws_access_key_id")
+    secret_key = read_secret("/run/secrets/aws_secret_access_key")
+    if access_key and secret_key:
+        return boto3.client("s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+                            region_name=AWS_REGION)
+    return boto3.client("s3", region_name=AWS_REGION)
+
+
+def timestamp():
+    """Timestamp in the format of the existing metrics files"""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat() + "Z"
+
+
+def read_file(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+class NvidiaSmiGpu:
+    """Reads GPU stats from one long-running nvidia-smi instead of spawning it every sample"""
+
+    FIELDS = ("index", "name", "memory.total", "memory.used", "memory.free", "utilization.gpu",
+              "utilization.memory", "temperature.gpu", "power.draw", "fan.speed")
+
+    def __init__(self, interval):
+        self.interval_ms = max(100, int(interval * 1000))
+        self.lock = threading.Lock()
+        self.gpus = {}  # index -> latest gpu entry
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="nvidia-smi", daemon=True)
+        thread.start()
+
+    def sample(self):
+        with self.lock:
+            return [self.gpus[index] for index in sorted(self.gpus)]
+
+    def _run(self):
+        command = ["nvidia-smi", f"--query-gpu={','.join(self.FIELDS)}", "--format=csv,noheader,nounits",
+                   f"--loop-ms={self.interval_ms}"]
+        delay = 1
+        while True:
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            except OSError as e:
+                logger.info(f"nvidia-smi not available, not reporting GPU metrics: {e}")
+                return
+            for line in process.stdout:
+                gpu = self.parse(line)
+                if gpu:
+                    with self.lock:
+                        self.gpus[gpu["index"]] = gpu
+                    delay = 1
+            process.wait()
+            logger.warning(f"nvidia-smi exited with status {process.returncode}, restarting in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    @staticmethod
+    def parse(line):
+        """Convert one CSV line (MiB, %, C, W) to the metrics file's GPU entry"""
+        values = [value.strip() for value in line.split(",")]
+        if len(values) != len(NvidiaSmiGpu.FIELDS):
+            return None
+
+        def number(value):
+            try:
+                return float(value)
+            except ValueError:
+                return None  # "[N/A]" or "[Not Supported]"
+
+        index, name, total, used, free, util_gpu, util_mem, temperature, power, fan = values
+        total, used, free = (number(value) for value in (total, used, free))
+        mib = 1024 * 1024
+        return {
+            "index": int(index),
+            "name": name,
+            "memory": {
+                "total": int(total * mib) if total is not None else None,
+                "used": int(used * mib) if used is not None else None,
+                "free": int(free * mib) if free is not None else None,
+                "percent": used / total * 100 if total and used is not None else 0.0,
+            },
+            "utilization": {"gpu": number(util_gpu), "memory": number(util_mem)},
+            "temperature": number(temperature),
+            "power_usage_watts": number(power),
+            "fan_speed_percent": number(fan),
+        }
+
+
+class ProcHostSource:
+    """Samples CPU, memory and swap from /proc and /sys, and GPUs from nvidia-smi"""
+
+    def __init__(self, interval):
+        self.previous_times = self._cpu_times()
+        self.count_logical = len(self.previous_times) - 1
+        self.count_physical = self._count_physical() or self.count_logical
+        self.freq_min, self.freq_max = self._freq_limits()
+        self.sensors = self._find_sensors()
+        self.gpu = NvidiaSmiGpu(interval)
+        self.gpu.start()
+
+    def sample(self):
+        return {"cpu": self._cpu(), "memory": self._memory(), "gpu": self.gpu.sample()}
+
+    @staticmethod
+    def _cpu_times():
+        """(busy, total) jiffies for the aggregate line and each core of /proc/stat"""
+        times = []
+        for line in read_file("/proc/stat").splitlines():
+            if not line.startswith("cpu"):
+                break
+            fields = [int(value) for value in line.split()[1:9]]
+            idle = fields[3] + fields[4]  # idle + iowait
+            times.append((sum(fields) - idle, sum(fields)))
+        return times
+
+    def _cpu(self):
+        times = self._cpu_times()
+        usage = []
+        for (busy, total), (previous_busy, previous_total) in zip(times, self.previous_times):
+            elapsed = total - previous_total
+            usage.append(round((busy - previous_busy) / elapsed * 100, 1) if elapsed > 0 else 0.0)
+        self.previous_times = times
+        return {
+            "usage_percent": usage[0],
+            "usage_per_core": usage[1:],
+            "frequency": {"current": self._freq_current(), "min": self.freq_min, "max": self.freq_max},
+            "count_logical": self.count_logical,
+            "count_physical": self.count_physical,
+            "temperatures": self._temperatures(),
+        }
+
+    @staticmethod
+    def _count_physical():
+        cores = set()
+        physical_id = None
+        for line in read_file("/proc/cpuinfo").splitlines():
+            key, _, value = line.partition(":")
+            key = key.strip()
+            if key == "physical id":
+                physical_id = value.strip()
+            elif key == "core id":
+                cores.add((physical_id, value.strip()))
+        return len(cores)
+
+    @staticmethod
+    def _freq_limits():
+        limits = []
+        for name in ("cpuinfo_min_freq", "cpuinfo_max_freq"):
+            try:
+                limits.append(int(read_file(f"/sys/devices/system/cpu/cpu0/cpufreq/{name}")) / 1000.0)
+            except (OSError, ValueError):
+                limits.append(0.0)
+        return limits
+
+    @staticmethod
+    def _freq_current():
+        speeds = [float(line.split(":")[1]) for line in read_file("/proc/cpuinfo").splitlines()
+                  if line.startswith("cpu MHz")]
+        return sum(speeds) / len(speeds) if speeds else 0.0
+
+    @staticmethod
+    def _find_sensors():
+        """(sensor name, input path, high, critical) for every hwmon temperature input"""
+        sensors = []
+        for hwmon in sorted(glob.glob("/sys/class/hwmon/hwmon*")):
+            try:
+                chip = read_file(os.path.join(hwmon, "name")).strip()
+            except OSError:
+                continue
+            for input_path in sorted(glob.glob(os.path.join(hwmon, "temp*_input"))):
+                prefix = input_path[:-len("_input")]
+
+                def attribute(suffix):
+                    try:
+                        return read_file(f"{prefix}_{suffix}").strip()
+                    except OSError:
+                        return None
+
+                label = attribute("label") or os.path.basename(prefix)
+                high, critical = attribute("max"), attribute("crit")
+                sensors.append((f"{chip}_{label}", input_path,
+                                int(high) / 1000.0 if high else None, int(critical) / 1000.0 if critical else None))
+        return sensors
+
+    def _temperatures(self):
+        temperatures = []
+        for sensor, input_path, high, critical in self.sensors:
+            try:
+                temperature = int(read_file(input_path)) / 1000.0
+            except (OSError, ValueError):
+                continue
+            temperatures.append({"sensor": sensor, "temperature": temperature, "high": high, "critical": critical})
+        return temperatures
+
+    @staticmethod
+    def _memory():
+        info = {}
+        for line in read_file("/proc/meminfo").splitlines():
+            key, _, value = line.partition(":")
+            info[key] = int(value.split()[0]) * 1024
+        total = info.get("MemTotal", 0)
+        available = info.get("MemAvailable", info.get("MemFree", 0))
+        cached = info.get("Cached", 0) + info.get("SReclaimable", 0)
+        free = info.get("MemFree", 0)
+        buffers = info.get("Buffers", 0)
+        swap_total = info.get("SwapTotal", 0)
+        swap_free = info.get("SwapFree", 0)
+        return {
+            "virtual": {
+                "total": total,
+                "available": available,
+                "used": max(0, total - free - buffers - cached),
+                "percent": round((total - available) / total * 100, 1) if total else 0.0,
+                "free": free,
+                "active": info.get("Active", 0),
+                "inactive": info.get("Inactive", 0),
+                "buffers": buffers,
+                "cached": cached,
+            },
+            "swap": {
+                "total": swap_total,
+                "used": swap_total - swap_free,
+                "free": swap_free,
+                "percent": round((swap_total - swap_free) / swap_total * 100, 1) if swap_total else 0.0,
+            },
+        }
+
+
+class FakeHostSource:
+    """Random-walk metrics for tests and for running without /proc or a GPU"""
+
+    def __init__(self, interval=None, seed=None, step=2.0, cores=4):
+        self.random = random.Random(seed)
+        self.step = step
+        self.cores = cores
+        self.values = {"cpu": 20.0, "memory": 50.0, "swap": 5.0, "gpu_memory": 30.0, "gpu_temperature": 45.0}
+
+    def _walk(self, name, low=0.0, high=100.0):
+        value = self.values[name] + self.random.uniform(-self.step, self.step)
+        self.values[name] = min(high, max(low, value))
+        return round(self.values[name], 1)
+
+    def sample(self):
+        gib = 1024 ** 3
+        memory = self._walk("memory")
+        swap = self._walk("swap")
+        gpu_memory = self._walk("gpu_memory")
+        return {
+            "cpu": {
+                "usage_percent": self._walk("cpu"),
+                "usage_per_core": [round(self.values["cpu"], 1)] * self.cores,
+                "frequency": {"current": 2400.0, "min": 800.0, "max": 4200.0},
+                "count_logical": self.cores,
+                "count_physical": self.cores,
+                "temperatures": [],
+            },
+            "memory": {
+                "virtual": {"total": 64 * gib, "used": int(64 * gib * memory / 100), "percent": memory},
+                "swap": {"total": 8 * gib, "used": int(8 * gib * swap / 100), "percent": swap},
+            },
+            "gpu": [{
+                "index": 0,
+                "name": "Fake GPU",
+                "memory": {"total": 24 * gib, "used": int(24 * gib * gpu_memory / 100), "percent": gpu_memory},
+                "utilization": {"gpu": 0, "memory": 0},
+                "temperature": self._walk("gpu_temperature", 20.0, 90.0),
+                "power_usage_watts": 0.0,
+                "fan_speed_percent": 0,
+            }],
+        }
+
+
+SOURCES = {"proc": ProcHostSource, "fake": FakeHostSource}
+
+
+def headline_values(metrics):
+    """The values the MetricsWidget displays, which decide whether a sample is worth uploading"""
+    values = [metrics["cpu"]["usage_percent"], metrics["memory"]["virtual"]["percent"],
+              metrics["memory"]["swap"]["percent"]]
+    for gpu in metrics["gpu"]:
+        values += [gpu["memory"]["percent"], gpu["temperature"] or 0.0]
+    return values
+
+
+class HostMetricsPublisher:
+    """Uploads {hostname}.json when values change and keeps list.json current with conditional writes"""
+
+    def __init__(self, client, bucket, hostname, source):
+        self.client = client
+        self.bucket = bucket
+        self.hostname = hostname
+        self.key = f"{hostname}.json"
+        self.source = source
+        self.last_values = None
+        self.last_upload = 0.0
+        self.last_list_update = 0.0
+        self.samples = 0
+        self.uploads = 0
+
+    def tick(self):
+        """Take one sample and upload it unless it is within tolerance of the last upload"""
+        sample = self.source.sample()
+        self.samples += 1
+        now = time.time()
+        values = headline_values(sample)
+        unchanged = (
+            self.last_values is not None
+            and len(values) == len(self.last_values)
+            and all(abs(a - b) <= HOST_METRICS_TOLERANCE for a, b in zip(values, self.last_values))
+        )
+        if unchanged and now - self.last_upload < HOST_METRICS_MAX_AGE:
+            return False
+
+        metrics = {"timestamp": timestamp(), "hostname": self.hostname}
+        metrics.update(sample)
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(metrics),
+            ContentType="application/json",
+            CacheControl="no-cache",
+        )
+        self.uploads += 1
+        self.last_values = values
+        self.last_upload = now
+        if now - self.last_list_update >= HOST_METRICS_LIST_INTERVAL:
+            if self.update_list(metrics["timestamp"]):
+                self.last_list_update = now
+        return True
+
+    def update_list(self, updated_at, attempts=5):
+        """Set this host's timestamp in list.json, retrying if another host wrote it in between"""
+        for attempt in range(attempts):
+            try:
+                response = self.client.get_object(Bucket=self.bucket, Key=LIST_KEY)
+                hosts = json.loads(response["Body"].read())
+                condition = {"IfMatch": response["ETag"]}
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                    raise
+                hosts = {}
+                condition = {"IfNoneMatch": "*"}
+
+            hosts[self.hostname] = updated_at
+            try:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=LIST_KEY,
+                    Body=json.dumps(hosts),
+                    ContentType="application/json",
+                    CacheControl="no-cache",
+                    **condition,
+                )
+                return True
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                    raise
+                logger.debug(f"{LIST_KEY} changed while updating it (attempt {attempt + 1}), retrying")
+                time.sleep(random.uniform(0, 0.2 * (attempt + 1)))
+        logger.warning(f"Gave up updating {LIST_KEY} after {attempts} conflicting writes")
+        return False
+
+    def run(self):
+        logger.info(
+            f"Publishing {HOST_METRICS_SOURCE} metrics to s3://{self.bucket}/{self.key} every "
+            f"{HOST_METRICS_INTERVAL}s (tolerance {HOST_METRICS_TOLERANCE}, max age {HOST_METRICS_MAX_AGE}s)"
+        )
+        next_tick = time.time()
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Failed to publish host metrics: {e}")
+            if self.samples % 300 == 0:
+                logger.info(f"Uploaded {self.uploads} of {self.samples} samples")
+            next_tick += HOST_METRICS_INTERVAL
+            time.sleep(max(0.0, next_tick - time.time()))
+
+
+class PrintClient:
+    """Stands in for the S3 client with --dry-run"""
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        print(f"{Key}: {Body}")
+
+    def get_object(self, Bucket, Key):
+        raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish host metrics for the MetricsWidget")
+    parser.add_argument("--dry-run", action="store_true", help="Print metrics instead of uploading them")
+    parser.add_argument("--once", action="store_true", help="Publish a single sample and exit")
+    args = parser.parse_args()
+
+    if HOST_METRICS_SOURCE not in SOURCES:
+        logger.error(f"Unknown HOST_METRICS_SOURCE '{HOST_METRICS_SOURCE}', expected one of {', '.join(SOURCES)}")
+        return 1
+    if not METRICS_BUCKET and not args.dry_run:
+        logger.error("METRICS_BUCKET is not set")
+        return 1
+
+    source = SOURCES[HOST_METRICS_SOURCE](HOST_METRICS_INTERVAL)
+    client = PrintClient() if args.dry_run else create_s3_client()
+    publisher = HostMetricsPublisher(client, METRICS_BUCKET, METRICS_HOSTNAME, source)
+    if args.once:
+        # CPU usage needs two readings
+        time.sleep(HOST_METRICS_INTERVAL)
+        publisher.tick()
+        return 0
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        logger.info(f"Stopping after {publisher.uploads} uploads of {publisher.samples} samples")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,70 @@
+"""Fixtures that load comfy-watcher.py against the in-process fakes of bench/"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+from fake_aws import FAST_QUEUE, FakeAWS  # noqa: E402
+from fake_comfyui import FakeComfyUI  # noqa: E402
+from watcher_module import load_watcher  # noqa: E402
+
+
+@pytest.fixture
+def load(tmp_path, monkeypatch):
+    """Load a fresh watcher module with its state and output under tmp_path and the given settings"""
+    def load(**env):
+        settings = {"STATE_DIR": str(tmp_path / "state"), "OUTPUT_FOLDER": str(tmp_path / "output")}
+        settings.update(env)
+        for name, value in settings.items():
+            monkeypatch.setenv(name, str(value))
+        os.makedirs(settings["OUTPUT_FOLDER"], exist_ok=True)
+        return load_watcher()
+    return load
+
+
+@pytest.fixture
+def watcher(load):
+    return load()
+
+
+@pytest.fixture
+def aws(watcher):
+    """Fake AWS services installed into the watcher, with its SSM configuration applied"""
+    fakes = FakeAWS()
+    fakes.install(watcher)
+    assert watcher.assume_dnd_role()
+    return fakes
+
+
+@pytest.fixture
+def receive(watcher, aws):
+    """Put a job on a fake queue like the website does; return the received (queue_name, queue_url, msg)"""
+    def receive(body, queue_name=FAST_QUEUE):
+        queue_url = aws.sqs.queue_url(queue_name)
+        aws.s3._store(f"{body['id']}.json", json.dumps(body))
+        aws.sqs._send(queue_url, json.dumps(body), body["id"])
+        msg = aws.sqs.receive_message(QueueUrl=queue_url, VisibilityTimeout=300)["Messages"][0]
+        return queue_name, queue_url, msg
+    return receive
+
+
+@pytest.fixture
+def comfyui(tmp_path):
+    """A fake ComfyUI writing its images to the watcher's OUTPUT_FOLDER; load the watcher with its url"""
+    fake = FakeComfyUI(render_time=0.05, output_dir=str(tmp_path / "output")).start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def listeners(watcher):
+    """The watcher's websocket listeners, connected to every backend"""
+    watcher.start_comfy_listener()
+    for backend in watcher.backend_pool.backends:
+        assert backend.listener.connected.wait(5)
+    yield watcher.backend_pool.backends
+    for backend in watcher.backend_pool.backends:
+        backend.listener.stop()
@@ -0,0 +1,49 @@
+import json
+import time
+
+import pytest
+
+from fake_aws import FAST_QUEUE
+
+
+@pytest.fixture
+def watcher(load, comfyui):
+    return load(COMFYUI_URL=comfyui.url, BATCH_MAX_SIZE=3, BATCH_MAX_WAIT=0)
+
+
+def test_batch_is_split_back_into_its_jobs(watcher, aws, comfyui, receive):
+    receiver = watcher.PrefetchReceiver([watcher.QueuePolicy(FAST_QUEUE, 1, 0, 30)])
+    for i, prompt in enumerate(["a cat", "a cat", "a dog", "a cat"]):
+        queue_name, queue_url, msg = receive({"id": f"job-{i}", "model": "flux", "prompt": prompt, "seed": 0})
+        receiver.prefetchers[0].buffer.append((queue_url, msg, time.time()))
+
+    job = watcher.next_job(receiver, 0)
+    assert [member.tti_input.id for member in job.batch] == ["job-0", "job-1", "job-3"]
+    assert [member.batch_index for member in job.batch] == [0, 1, 2]
+    # The job for another prompt stays buffered
+    assert len(receiver.prefetchers[0].buffer) == 1
+
+    assert watcher.process_job(job)
+    assert comfyui.completed == 1
+    watcher.s3_publisher.executor.shutdown(wait=True)
+    images = set()
+    for index, job_id in enumerate(["job-0", "job-1", "job-3"]):
+        final = json.loads(aws.s3.objects[f"{job_id}_final.json"][0])
+        assert (final["seed"], final["batch_index"], final["batch_size"]) == (job.seed, index, 3)
+        assert final["s3_key"] in aws.s3.objects
+        images.add(final["s3_key"])
+        request = json.loads(aws.s3.objects[f"{job_id}.json"][0])
+        assert (request["seed"], request["batch_index"], request["batch_size"]) == (job.seed, index, 3)
+    assert len(images) == 3
+
+    watcher.flush_queue_acks()
+    remaining = [json.loads(message["Body"])["id"] for message in aws.sqs.queues[FAST_QUEUE].messages]
+    assert remaining == ["job-2"]
+
+
+def test_jobs_with_explicit_seeds_are_not_batched(watcher, receive):
+    receiver = watcher.PrefetchReceiver([watcher.QueuePolicy(FAST_QUEUE, 1, 0, 30)])
+    for i in range(2):
+        queue_name, queue_url, msg = receive({"id": f"job-{i}", "model": "flux", "prompt": "a cat", "seed": 5})
+        receiver.prefetchers[0].buffer.append((queue_url, msg, time.time()))
+    assert len(watcher.next_job(receiver, 0).batch) == 1
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def watcher(load):
+    return load(BREAKER_FAILURE_THRESHOLD=2, BREAKER_RESET_TIMEOUT=0.05, BREAKER_MAX_RESET_TIMEOUT=0.1)
+
+
+def test_breaker_opens_probes_and_closes(watcher):
+    breaker = watcher.CircuitBreaker("comfyui")
+    breaker.record_failure("first")
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure("second")
+    assert breaker.state == "open" and not breaker.allow()
+    assert breaker.delay() > 0
+
+    time.sleep(0.06)
+    assert breaker.delay() == 0
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Only one probe at a time
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.recovery_stats.summary()["count"] == 1
+
+
+def test_failed_probe_doubles_reset_timeout_up_to_the_maximum(watcher):
+    breaker = watcher.CircuitBreaker("s3")
+    breaker.record_failure("first")
+    breaker.record_failure("second")
+    for expected in (0.1, 0.1):
+        breaker.retry_at = 0.0
+        assert breaker.allow()
+        breaker.record_failure("probe")
+        assert breaker.state == "open"
+        assert breaker.reset_timeout == expected
+
+
+def test_job_start_delay_hands_back_the_probe_when_the_other_breaker_refuses(watcher, monkeypatch):
+    comfyui, s3 = watcher.breakers["comfyui"], watcher.breakers["s3"]
+    for breaker in (comfyui, s3):
+        breaker.record_failure("first")
+        breaker.record_failure("second")
+    time.sleep(0.06)
+    # Another thread takes the S3 probe between the delay check and allow()
+    real_allow = s3.allow
+    monkeypatch.setattr(s3, "allow", lambda: real_allow() and False)
+
+    assert watcher.job_start_delay() > 0
+    assert comfyui.state == "half_open"
+    assert comfyui.delay() == 0
+    assert comfyui.allow()
+
+
+def test_job_start_delay_takes_both_probes(watcher):
+    for breaker in watcher.breakers.values():
+        breaker.record_failure("first")
+        breaker.record_failure("second")
+    assert watcher.job_start_delay() > 0
+    time.sleep(0.06)
+    assert watcher.job_start_delay() == 0
+    assert watcher.breakers["comfyui"].state == watcher.breakers["s3"].state == "half_open"
+    assert watcher.job_start_delay() > 0
+
+
+def test_one_failing_backend_does_not_open_the_comfyui_breaker(watcher):
+    pool = watcher.BackendPool(["http://comfyui-1:8188", "http://comfyui-2:8188"])
+    bad, good = pool.backends
+    for _ in range(5):
+        pool.record_failure(bad)
+    assert not bad.healthy
+    assert watcher.breakers["comfyui"].state == "closed"
+
+    # Once every backend is failing or ejected the breaker opens
+    pool.record_failure(good)
+    pool.record_failure(good)
+    assert watcher.breakers["comfyui"].state == "open"
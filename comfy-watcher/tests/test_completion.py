@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def watcher(load, comfyui):
+    return load(COMFYUI_URL=comfyui.url, COMFYUI_WS_RECHECK_INTERVAL=30)
+
+
+def submitted_job(watcher, receive):
+    job = watcher.create_job(*receive({"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 7}))
+    assert watcher.prepare_job(job)
+    assert watcher.submit_job(job)
+    return job
+
+
+def test_websocket_event_wakes_the_waiting_job(watcher, receive, listeners):
+    job = submitted_job(watcher, receive)
+    start = time.time()
+    assert watcher.await_job(job)
+    # Well within the recheck interval, so the job was woken by the event
+    assert time.time() - start < 5
+    assert listeners[0].listener.finished[job.prompt_id] == "success"
+    assert len(job.poll_response["9"]["images"]) == 1
+
+
+def test_dropped_websocket_falls_back_to_history(watcher, comfyui, receive, listeners, monkeypatch):
+    # The socket closes after the render is stored, and the completion event is lost
+    comfyui.ws_drop_every = 1
+    send = comfyui._send
+    monkeypatch.setattr(comfyui, "_send", lambda client_id, event_type, data:
+                        event_type != "executing" and send(client_id, event_type, data))
+    job = submitted_job(watcher, receive)
+    start = time.time()
+    assert watcher.await_job(job)
+    assert time.time() - start < 5
+    assert job.prompt_id not in listeners[0].listener.finished
+    assert len(job.poll_response["9"]["images"]) == 1
+
+
+def test_history_polling_without_a_websocket(watcher, receive):
+    job = submitted_job(watcher, receive)
+    assert watcher.backend_pool.backends[0].listener is None
+    assert watcher.await_job(job)
+    assert len(job.poll_response["9"]["images"]) == 1
@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from fake_aws import FAST_QUEUE
+
+
+@pytest.mark.parametrize("body", ["[1, 2]", "5", '"text"', "not json"])
+def test_create_job_skips_bodies_that_are_not_json_objects(watcher, aws, body):
+    msg = {"ReceiptHandle": "r", "Body": body, "MessageId": "m"}
+    assert watcher.create_job(FAST_QUEUE, aws.sqs.queue_url(FAST_QUEUE), msg) is None
+    assert watcher.job_counters.outcomes[(FAST_QUEUE, "unknown", "failed")] == 1
+    assert watcher.message_job_id(msg) is None
+    assert watcher.message_model(msg) is None
+    assert watcher.message_batch_key(msg) is None
+
+
+def test_create_job_parses_object_body(watcher, aws):
+    body = json.dumps({"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 7})
+    job = watcher.create_job(FAST_QUEUE, aws.sqs.queue_url(FAST_QUEUE), {"ReceiptHandle": "r", "Body": body})
+    assert job.tti_input.id == "job-1"
+    assert job.tti_input.model == "flux"
@@ -0,0 +1,21 @@
+def stats_with(watcher, samples):
+    stats = watcher.LatencyStats()
+    for sample in samples:
+        stats.record(sample)
+    return stats
+
+
+def test_percentile_is_nearest_rank_for_odd_sample_count(watcher):
+    stats = stats_with(watcher, [5, 1, 4, 2, 3])
+    assert stats.percentile(50) == 3
+    assert stats.percentile(20) == 1
+    assert stats.percentile(21) == 2
+    assert stats.percentile(100) == 5
+
+
+def test_percentile_even_sample_count_and_bounds(watcher):
+    stats = stats_with(watcher, [1, 2, 3, 4])
+    assert stats.percentile(50) == 2
+    assert stats.percentile(0) == 1
+    assert stats.percentile(99) == 4
+    assert watcher.LatencyStats().percentile(50) == 0.0
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+from fake_aws import FAST_QUEUE
+
+
+@pytest.fixture
+def watcher(load, comfyui):
+    return load(COMFYUI_URL=comfyui.url, COMFYUI_WS_RECHECK_INTERVAL=30)
+
+
+def redeliver(aws, queue_url):
+    """Let SQS hand out every in-flight message again"""
+    queue = aws.sqs._queue(queue_url)
+    for message in queue.messages:
+        message["VisibleAt"] = 0.0
+    return aws.sqs.receive_message(QueueUrl=queue_url, VisibilityTimeout=300)["Messages"][0]
+
+
+def test_published_job_is_acked_without_rendering(watcher, aws, receive):
+    queue_name, queue_url, msg = receive({"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 7})
+    watcher.job_ledger.record_published("job-1")
+    msg = redeliver(aws, queue_url)
+    assert msg["Attributes"]["ApproximateReceiveCount"] == "2"
+
+    assert watcher.create_job(queue_name, queue_url, msg) is None
+    assert watcher.job_counters.outcomes[(queue_name, "flux", "duplicate")] == 1
+    watcher.flush_queue_acks()
+    assert aws.sqs.queues[FAST_QUEUE].messages == []
+
+
+def test_interrupted_publish_of_a_batch_member_resumes(watcher, aws, receive):
+    body = {"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 0}
+    queue_name, queue_url, msg = receive(body)
+    image = {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+    with open(os.path.join(watcher.OUTPUT_FOLDER, image["filename"]), "wb") as f:
+        f.write(b"png")
+    metadata = {"id": "job-1", "seed": 2 ** 64 - 1, "s3_key": "job-1.png", "elapsed": 1.0,
+                "batch_index": 2, "batch_size": 3}
+    watcher.job_ledger.record_render("job-1", {"image": image, "poll_response": {"9": {"images": [image]}},
+                                               "metadata": metadata})
+    watcher.job_ledger.record_upload("job-1", "output_json")
+
+    job = watcher.create_job(queue_name, queue_url, redeliver(aws, queue_url))
+    assert job.resume and job.seed == 2 ** 64 - 1
+    assert watcher.process_job(job)
+    watcher.s3_publisher.executor.shutdown(wait=True)
+
+    # Only the missing uploads were done
+    assert "job-1_output.json" not in aws.s3.objects
+    assert aws.s3.objects["job-1.png"][0] == b"png"
+    assert json.loads(aws.s3.objects["job-1_final.json"][0])["batch_index"] == 2
+    # The request keeps pointing at the member's image in the batch
+    request = json.loads(aws.s3.objects["job-1.json"][0])
+    assert (request["seed"], request["batch_index"], request["batch_size"]) == (2 ** 64 - 1, 2, 3)
+    assert watcher.job_ledger.get("job-1")["state"] == "published"
+
+
+def test_journal_keeps_64_bit_seeds(watcher, aws, receive):
+    job = watcher.create_job(*receive({"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 0}))
+    job.backend = watcher.backend_pool.backends[0]
+    job.prompt_id = "prompt-1"
+    job.seed = 2 ** 64 - 1
+    job.submitted_at = time.time()
+    watcher.job_ledger.record_submitted(job)
+    [entry] = watcher.job_ledger.prompts()
+    assert entry["seed"] == 2 ** 64 - 1
+    assert entry["messages"][0]["body"] == job.body
+
+
+def test_restart_reattaches_to_the_journaled_prompt(load, watcher, aws, comfyui, receive):
+    comfyui.render_time = 1.0
+    watcher.restore_comfyui_client_id()
+    job = watcher.create_job(*receive({"id": "job-1", "model": "flux", "prompt": "a cat", "seed": 0}))
+    assert watcher.prepare_job(job) and watcher.submit_job(job)
+
+    # A new process with the same STATE_DIR
+    restarted = load(COMFYUI_URL=comfyui.url, COMFYUI_WS_RECHECK_INTERVAL=30)
+    aws.install(restarted)
+    assert restarted.assume_dnd_role()
+    restarted.restore_comfyui_client_id()
+    assert restarted.COMFYUI_CLIENT_ID == watcher.COMFYUI_CLIENT_ID
+    restarted.start_comfy_listener()
+    listener = restarted.backend_pool.backends[0].listener
+    assert listener.connected.wait(5)
+
+    [recovered] = restarted.recover_jobs()
+    assert (recovered.prompt_id, recovered.seed) == (job.prompt_id, job.seed)
+    start = time.time()
+    assert restarted.process_job(recovered)
+    listener.stop()
+    # Woken by the prompt's own completion event, not the recheck interval
+    assert time.time() - start < 5
+    assert listener.finished[job.prompt_id] == "success"
+    assert comfyui.completed == 1
+    assert "job-1_final.json" in aws.s3.objects
+    assert restarted.job_ledger.prompts() == []
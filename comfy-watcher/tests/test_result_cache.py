@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def watcher(load, comfyui):
+    return load(COMFYUI_URL=comfyui.url, RESULT_CACHE_ENABLED="true")
+
+
+def body(job_id, seed=42):
+    return {"id": job_id, "model": "flux", "prompt": "a cat", "seed": seed}
+
+
+def test_identical_request_copies_the_earlier_render(watcher, aws, comfyui, receive):
+    first = watcher.create_job(*receive(body("job-a")))
+    assert first.cache_key and first.cached is None
+    assert watcher.process_job(first)
+
+    second = watcher.create_job(*receive(body("job-b")))
+    assert second.cached["job_id"] == "job-a"
+    assert watcher.process_job(second)
+    assert comfyui.completed == 1
+    final = json.loads(aws.s3.objects["job-b_final.json"][0])
+    assert final["cached_from"] == "job-a"
+    assert aws.s3.objects["job-b.png"][0] == aws.s3.objects["job-a.png"][0]
+    assert "job-b_output.json" in aws.s3.objects
+    assert (watcher.result_cache.hits, watcher.result_cache.misses) == (1, 1)
+
+
+def test_other_seed_or_watcher_assigned_seed_misses(watcher, receive):
+    assert watcher.process_job(watcher.create_job(*receive(body("job-a"))))
+    assert watcher.create_job(*receive(body("job-b", seed=43))).cached is None
+    job = watcher.create_job(*receive(body("job-c", seed=0)))
+    assert job.cache_key is None and job.cached is None
+
+
+def test_deleted_render_is_forgotten_and_rendered_again(watcher, aws, receive):
+    first = watcher.create_job(*receive(body("job-a")))
+    assert watcher.process_job(first)
+    watcher.s3_publisher.executor.shutdown(wait=True)
+    del aws.s3.objects["job-a.png"]
+
+    assert watcher.create_job(*receive(body("job-b"))).cached is None
+    assert watcher.job_ledger.get_result(first.cache_key) is None
+    assert f"{watcher.RESULT_CACHE_PREFIX}{first.cache_key}.json" not in aws.s3.objects
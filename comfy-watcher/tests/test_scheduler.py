@@ -0,0 +1,43 @@
+import threading
+
+
+def buffered(watcher, queue_name, count, sent_at):
+    """A prefetcher holding count messages sent at sent_at"""
+    prefetcher = watcher.QueuePrefetcher(queue_name, threading.Condition())
+    for i in range(count):
+        msg = {"ReceiptHandle": f"{queue_name}-{i}", "Body": "{}",
+               "Attributes": {"SentTimestamp": str(int(sent_at * 1000))}}
+        prefetcher.buffer.append(("url", msg, sent_at))
+    return prefetcher
+
+
+def take(scheduler, prefetchers, now, count):
+    order = []
+    for _ in range(count):
+        prefetcher = scheduler.choose(prefetchers, now)
+        if prefetcher is None:
+            break
+        prefetcher.buffer.popleft()
+        order.append(prefetcher.queue_name)
+    return order
+
+
+def test_queues_are_served_by_weight(watcher):
+    scheduler = watcher.QueueScheduler([watcher.QueuePolicy("fast", 3, 0, 30), watcher.QueuePolicy("slow", 1, 0, 900)])
+    prefetchers = [buffered(watcher, "fast", 20, 1000.0), buffered(watcher, "slow", 20, 1000.0)]
+    # Smooth round robin interleaves the slow queue instead of serving it in bursts
+    assert take(scheduler, prefetchers, 1000.0, 8) == ["fast", "fast", "slow", "fast"] * 2
+
+
+def test_starving_queue_is_served_first(watcher):
+    scheduler = watcher.QueueScheduler([watcher.QueuePolicy("fast", 3, 0, 30), watcher.QueuePolicy("slow", 1, 60, 900)])
+    prefetchers = [buffered(watcher, "fast", 20, 1000.0), buffered(watcher, "slow", 2, 1000.0)]
+    assert take(scheduler, prefetchers, 1059.0, 1) == ["fast"]
+    # Past its max wait the slow queue goes ahead until it is drained
+    assert take(scheduler, prefetchers, 1061.0, 4) == ["slow", "slow", "fast", "fast"]
+
+
+def test_zero_weight_queue_only_runs_when_the_others_are_idle(watcher):
+    scheduler = watcher.QueueScheduler([watcher.QueuePolicy("fast", 1, 0, 30), watcher.QueuePolicy("slow", 0, 0, 900)])
+    prefetchers = [buffered(watcher, "fast", 3, 1000.0), buffered(watcher, "slow", 2, 1000.0)]
+    assert take(scheduler, prefetchers, 1000.0, 10) == ["fast"] * 3 + ["slow"] * 2
@@ -23,6 +23,34 @@ interface MetricsData {
   }>
 }
 
+interface StageLatency {
+  count: number
+  mean: number
+  p50: number
+  p95: number
+  p99: number
+  max: number
+}
+
+interface WatcherMetrics {
+  timestamp: string
+  hostname: string
+  stages: {
+    [stage: string]: StageLatency
+  }
+}
+
+// Watcher stages shown under the host metrics, in job order
+const WATCHER_STAGES: Array<[string, string]> = [
+  ['queue_wait', 'Queue wait'],
+  ['render', 'Render'],
+  ['publish', 'S3 publish'],
+  ['end_to_end', 'End-to-end'],
+]
+
+const formatSeconds = (seconds: number) =>
+  seconds >= 60 ? `${(seconds / 60).toFixed(1)}m` : `${seconds.toFixed(1)}s`
+
 interface MetricsList {
   [key: string]: string // hostname -> timestamp
 }
@@ -31,6 +59,10 @@ interface MetricsCollection {
   [hostname: string]: MetricsData
 }
 
+interface WatcherCollection {
+  [hostname: string]: WatcherMetrics
+}
+
 interface MetricBarProps {
   label: string
   value: number
@@ -69,6 +101,7 @@ const MetricBar: React.FC<MetricBarProps> = ({ label, value, unit, max = 100, mi
 export default function MetricsWidget() {
   const [metricsList, setMetricsList] = useState<MetricsList | null>(null)
   const [metricsCollection, setMetricsCollection] = useState<MetricsCollection>({})
+  const [watcherCollection, setWatcherCollection] = useState<WatcherCollection>({})
   const [error, setError] = useState<string | null>(null)
   const [lastUpdate, setLastUpdate] = useState<Date | null>(null)
   const [retryCount, setRetryCount] = useState(0)
@@ -167,6 +200,34 @@ export default function MetricsWidget() {
     }
   }
 
+  // Hosts running comfy-watcher with METRICS_BUCKET set also publish {hostname}-watcher.json
+  const fetchWatcherMetricsForHost = async (hostname: string) => {
+    try {
+      const baseUrl = process.env.NEXT_PUBLIC_METRICS_BUCKET_BASE
+      if (!baseUrl) return
+
+      const response = await fetch(`${baseUrl}/${hostname}-watcher.json`, {
+        method: 'GET',
+        mode: 'cors',
+        headers: {
+          'Accept': 'application/json',
+        },
+        cache: 'no-cache'
+      })
+
+      // Not every host runs a watcher
+      if (!response.ok) return
+
+      const data: WatcherMetrics = await response.json()
+      setWatcherCollection(prev => ({
+        ...prev,
+        [hostname]: data
+      }))
+    } catch (err) {
+      console.warn(`Failed to fetch watcher metrics for ${hostname}:`, err)
+    }
+  }
+
   const fetchAllMetrics = useCallback(async () => {
     if (!metricsList) return
     
@@ -178,6 +239,19 @@ export default function MetricsWidget() {
     await Promise.allSettled(promises)
   }, [metricsList])
 
+  useEffect(() => {
+    if (isPaused || !metricsList) return
+
+    const fetchAllWatcherMetrics = () => {
+      Object.keys(metricsList).forEach(hostname => fetchWatcherMetricsForHost(hostname))
+    }
+    fetchAllWatcherMetrics()
+
+    // The watcher publishes every 30 seconds by default
+    const watcherInterval = setInterval(fetchAllWatcherMetrics, 30000)
+    return () => clearInterval(watcherInterval)
+  }, [metricsList, isPaused])
+
   useEffect(() => {
     if (isPaused) return
     
@@ -277,6 +351,7 @@ export default function MetricsWidget() {
   }
 
   const gpu = currentMetrics.gpu?.[0] // Use first GPU if available
+  const watcher = selectedHost ? watcherCollection[selectedHost] : null
 
   return (
     <div className={styles.widget}>
@@ -352,6 +427,21 @@ export default function MetricsWidget() {
           </>
         )}
       </div>
+
+      {watcher && (
+        <div className={styles.watcher}>
+          {WATCHER_STAGES.map(([stage, label]) => {
+            const latency = watcher.stages[stage]
+            if (!latency || latency.count === 0) return null
+            return (
+              <div key={stage} className={styles.watcherStage} title={`${latency.count} jobs`}>
+                {label}: {formatSeconds(latency.p50)} / {formatSeconds(latency.p95)} / {formatSeconds(latency.p99)}
+              </div>
+            )
+          })}
+          <div className={styles.watcherLegend}>p50 / p95 / p99</div>
+        </div>
+      )}
       
       <div className={styles.footer}>
         Host: {currentMetrics.hostname}